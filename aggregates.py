@@ -0,0 +1,241 @@
+# local modules
+import helper
+
+# other libraries
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# PER-KEY AGGREGATE FEATURES
+#
+# With --aggregate, a source with columns configured with aggregate in its dictionary is reduced to one row per key of
+# its first join-group (by join precedence, e.g. VariationID in the submission summary), so it joins one to one onto
+# the other sources instead of repeating their rows for each of its rows. The aggregate column of the dictionary lists
+# the aggregations of a column, separated by ';':
+#
+#   count     the number of rows with each value of the column, as '<prefix>_<column>_<value>'
+#   distinct  the number of distinct values of the column, as '<prefix>_<column>_distinct'
+#   conflict  1 if the rows have values of more than one of the groups of values of the column, else 0, as
+#             '<prefix>_<column>_conflict'; the groups are given as conflict=<value>+<value>|<value>+<value>, e.g.
+#             conflict=Pathogenic+Likely pathogenic|Benign+Likely benign, and values in no group (e.g. Uncertain
+#             significance) never conflict. Without groups, every distinct value is a group of its own.
+#   newest    the latest date of the column, parsed with the format of the column, as '<prefix>_<column>_newest'
+#   oldest    the earliest date of the column, as '<prefix>_<column>_oldest'
+#
+# and '<prefix>_rows' is the number of rows of each key. The rows passing the filters are aggregated a chunk at a
+# time as they are read, with vectorized group by: the counts of each chunk are summed, and the distinct values and
+# dates of each chunk combined, so only the partial aggregates of the chunks read are held, not the rows. The dates
+# are written as YYYY-MM-DD (or '-' when missing), so --days and --age encode them. Rows without a key are left out;
+# the other columns of the source, and its template, are not output.
+#
+#########################
+
+AGGREGATE_PREFIX = 'agg'
+AGGREGATIONS = ['count', 'distinct', 'conflict', 'newest', 'oldest']
+# aggregations giving numbers, used as features
+NUMERIC = ['count', 'distinct', 'conflict']
+SEPARATOR = ';'
+# separators of the groups of values of conflict=, and of the values of each group
+GROUP_SEPARATOR = '|'
+VALUE_SEPARATOR = '+'
+DATE_FORMAT = '%Y-%m-%d'
+MISSING_DATE = '-'
+# partial aggregates of the chunks held before they are combined
+COMBINE_CHUNKS = 16
+
+
+# the aggregations configured for a column in the dictionary, as (name, argument) with the text after '=', if any
+def parse(value):
+    if pd.isna(value) or value is False or str(value).strip().upper() in ('', 'FALSE'):
+        return []
+    aggregations = []
+    for a in str(value).split(SEPARATOR):
+        name, equals, argument = a.partition('=')
+        if len(name.strip()) > 0:
+            aggregations.append((name.strip().lower(), argument.strip() if equals else None))
+    unknown = [a for a, argument in aggregations if a not in AGGREGATIONS]
+    if len(unknown) > 0:
+        raise helper.PipelineError("unknown aggregations {} (supported: {})".format(unknown, ', '.join(AGGREGATIONS)))
+    with_argument = [a for a, argument in aggregations if argument is not None and a != 'conflict']
+    if len(with_argument) > 0:
+        raise helper.PipelineError("aggregations {} take no groups of values".format(with_argument))
+    return aggregations
+
+
+# the group of each value of the conflict=<groups> argument, compared without case
+def conflict_groups(argument):
+    groups = {}
+    for i, group in enumerate(argument.split(GROUP_SEPARATOR)):
+        for value in group.split(VALUE_SEPARATOR):
+            if len(value.strip()) > 0:
+                groups[value.strip().lower()] = i
+    if len(set(groups.values())) < 2:
+        raise helper.PipelineError("conflict={} needs at least two groups of values separated by '{}'".format(
+            argument, GROUP_SEPARATOR))
+    return groups
+
+
+# sum the partial counts indexed by key (and value)
+def combine_counts(parts):
+    if len(parts) <= 1:
+        return parts
+    counts = pd.concat(parts)
+    return [counts.groupby(level=list(range(counts.index.nlevels)), sort=False).sum()]
+
+
+class Aggregation:
+
+    def __init__(self, dic, key):
+        self.key = key
+        self.aggregations = {}
+        self.formats = {}
+        # the group of each value of the columns with conflict groups
+        self.groups = {}
+        for i, r in dic.iterrows():
+            aggregations = parse(r.get('aggregate'))
+            if len(aggregations) > 0:
+                self.aggregations[r['column']] = [a for a, argument in aggregations]
+                self.formats[r['column']] = None if pd.isna(r.get('format')) else r.get('format')
+                self.groups.update((r['column'], conflict_groups(argument)) for a, argument in aggregations
+                                   if argument is not None)
+        self.dictionary = self.output_dictionary(dic)
+        # the keys in the order first read, and the partial aggregates of the chunks read
+        self.keys = []
+        self.rows = []
+        self.counts = {c: [] for c in self.aggregations}
+        self.values = {c: [] for c in self.aggregations}
+        self.conflicts = {c: [] for c in self.aggregations}
+        self.dates = {c: [] for c in self.aggregations}
+        self.chunks = 0
+
+    def __repr__(self):
+        return "aggregation by {} of {}".format(self.key, self.aggregations)
+
+    def name(self, *parts):
+        return '_'.join([AGGREGATE_PREFIX] + [str(p) for p in parts])
+
+    def add_column(self, column, comment):
+        row = {c: (False if self.dictionary[c].dtype == bool else np.nan) for c in self.dictionary.columns}
+        self.dictionary.loc[len(self.dictionary)] = dict(row, column=column, comment=comment, aggregate='count',
+                                                         output=True)
+
+    # the dictionary of the aggregated rows: the key column, then a column for each aggregate
+    def output_dictionary(self, dic):
+        rows = [dic.loc[dic['column'] == self.key].iloc[0].to_dict()]
+        empty = {c: (False if dic[c].dtype == bool else np.nan) for c in dic.columns}
+        rows.append(dict(empty, column=self.name('rows'), comment="number of rows of the {}".format(self.key),
+                         aggregate='count', output=True))
+        for column, aggregations in self.aggregations.items():
+            for a in aggregations:
+                if a in ('newest', 'oldest'):
+                    rows.append(dict(empty, column=self.name(column, a), comment="{} {}".format(a, column),
+                                     format=DATE_FORMAT, aggregate=a, output=True))
+                elif a != 'count':
+                    rows.append(dict(empty, column=self.name(column, a), comment="{} of {}".format(a, column),
+                                     aggregate=a, output=True))
+        return pd.DataFrame(rows, columns=dic.columns)
+
+    # add the partial aggregates of a chunk of rows
+    def add(self, chunk):
+        chunk = chunk.loc[chunk[self.key].notna()]
+        if len(chunk) == 0:
+            return
+        keys = chunk[self.key]
+        # the keys of --compact chunks, as read
+        if isinstance(keys.dtype, pd.CategoricalDtype):
+            keys = keys.astype(keys.cat.categories.dtype)
+        self.keys.append(pd.Series(keys.unique()))
+        self.rows.append(keys.value_counts(sort=False))
+        for column, aggregations in self.aggregations.items():
+            if column not in chunk:
+                continue
+            values = chunk[column].astype(object)
+            present = values.notna()
+            if 'count' in aggregations:
+                self.counts[column].append(chunk.loc[present].groupby([self.key, values[present]], sort=False,
+                                                                      observed=True).size())
+            if 'distinct' in aggregations or ('conflict' in aggregations and column not in self.groups):
+                self.values[column].append(pd.DataFrame({'key': keys[present], 'value': values[present]})
+                                           .drop_duplicates())
+            if column in self.groups:
+                groups = values[present].astype(str).str.strip().str.lower().map(self.groups[column])
+                grouped = groups.notna()
+                self.conflicts[column].append(pd.DataFrame({'key': keys[present][grouped],
+                                                            'value': groups[grouped].astype(np.int64)})
+                                              .drop_duplicates())
+            if 'newest' in aggregations or 'oldest' in aggregations:
+                dates = self.parse_dates(values, self.formats[column])
+                by_key = dates.groupby(keys, sort=False)
+                self.dates[column].append(pd.DataFrame({'newest': by_key.max(), 'oldest': by_key.min()}))
+        self.chunks += 1
+        if self.chunks % COMBINE_CHUNKS == 0:
+            self.combine()
+
+    @staticmethod
+    def parse_dates(values, date_format):
+        if date_format is None:
+            return pd.to_datetime(values, errors='coerce', format='mixed')
+        return pd.to_datetime(values, errors='coerce', format=date_format)
+
+    # combine the partial aggregates of the chunks read so far
+    def combine(self):
+        if len(self.keys) > 1:
+            self.keys = [pd.Series(pd.concat(self.keys).unique())]
+        self.rows = combine_counts(self.rows)
+        for column in self.aggregations:
+            self.counts[column] = combine_counts(self.counts[column])
+            if len(self.values[column]) > 1:
+                self.values[column] = [pd.concat(self.values[column]).drop_duplicates()]
+            if len(self.conflicts[column]) > 1:
+                self.conflicts[column] = [pd.concat(self.conflicts[column]).drop_duplicates()]
+            if len(self.dates[column]) > 1:
+                dates = pd.concat(self.dates[column]).groupby(level=0, sort=False)
+                self.dates[column] = [pd.DataFrame({'newest': dates['newest'].max(), 'oldest': dates['oldest'].min()})]
+
+    # the aggregated rows, one per key in the order the keys were first read; the columns of the counts of each
+    # value are added to the dictionary
+    def frame(self):
+        self.combine()
+        if len(self.keys) == 0:
+            return pd.DataFrame(columns=list(self.dictionary['column']))
+        keys = self.keys[0]
+        index = pd.Index(keys, name=self.key)
+        columns = {self.key: keys.to_numpy(), self.name('rows'): self.rows[0].reindex(index).to_numpy()}
+        for column, aggregations in self.aggregations.items():
+            for a in aggregations:
+                if a == 'count':
+                    counts = self.counts[column][0] if len(self.counts[column]) > 0 else pd.Series(dtype='int64')
+                    if len(counts) > 0:
+                        table = counts.unstack(fill_value=0)
+                        for value in table.columns:
+                            columns[self.name(column, value)] = table[value].reindex(index, fill_value=0).to_numpy()
+                            self.add_column(self.name(column, value), "number of rows with {} {}".format(column,
+                                                                                                         value))
+                elif a in ('distinct', 'conflict'):
+                    # the distinct values, or for conflict with groups the distinct groups of the values
+                    partial = self.conflicts if a == 'conflict' and column in self.groups else self.values
+                    values = partial[column][0] if len(partial[column]) > 0 else None
+                    distinct = pd.Series(0, index=index) if values is None else \
+                        values.groupby('key', sort=False).size().reindex(index, fill_value=0)
+                    columns[self.name(column, a)] = (distinct.to_numpy() if a == 'distinct' else
+                                                     (distinct.to_numpy() > 1).astype(np.int64))
+                else:
+                    # missing dates are '-', as in the ClinVar files
+                    dates = self.dates[column][0][a] if len(self.dates[column]) > 0 else \
+                        pd.Series(pd.NaT, index=index)
+                    columns[self.name(column, a)] = dates.reindex(index).dt.strftime(DATE_FORMAT).fillna(
+                        MISSING_DATE).to_numpy()
+        helper.debug("Aggregated", len(index), "keys of", self.key, "into", len(columns), "columns")
+        return pd.DataFrame(columns)
+
+
+# the aggregation of a source with the dictionary dic, or None without --aggregate or aggregate columns
+def aggregation(args, dic):
+    if not args.aggregate or 'aggregate' not in dic or all(len(parse(v)) == 0 for v in dic['aggregate']):
+        return None
+    join_columns = dic.loc[dic['join-group'].notnull(), ['column', 'join-group']]
+    if len(join_columns) == 0:
+        raise helper.PipelineError("aggregate columns need a join-group column to aggregate by")
+    precedence = join_columns['join-group'].map(helper.get_join_precedence)
+    return Aggregation(dic, join_columns['column'].iloc[int(np.argmin(precedence.to_numpy()))])
@@ -6,8 +6,12 @@ import argparse
 #
 #########################
 
+# options given as comma separated text on the command line, held as a list or as text
+LIST_OPTIONS = {'sources', 'columns'}
+TEXT_OPTIONS = {'gene', 'variant'}
 
-def parse():
+
+def parser():
     parser = argparse.ArgumentParser(
         prog='clingen-dosage-ai-tools',
         description='Prepares ClinVar, ClinGen, and GenCC sources for use by ML and LLM analysis.',
@@ -18,10 +22,22 @@ def parse():
     # logging level
     parser.add_argument('--loglevel', action='store', type=str, default="WARN",
                         help="Set logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    parser.add_argument('--event-log', action='store', dest='event_log', type=str, default=None,
+                        help="Append a JSON lines event for each stage of the run (rows, columns, seconds) to the "
+                             "file.")
 
     # encoding options
     parser.add_argument('--template', action='store_true',
                         help="Generate template output column '<source-name>-template' if specified in config.yml.")
+    parser.add_argument('--template-engine', action='store', dest='template_engine', choices=['compiled', 'genshi'],
+                        default='compiled',
+                        help="Render templates with templates compiled into Python functions (compiled), or with "
+                             "Genshi for each row (genshi). Default=compiled.")
+    parser.add_argument('--template-dedup', action='store_true', dest='template_dedup',
+                        help="Write each distinct template text to --template-output once.")
+    parser.add_argument('--template-check', action='store_true', dest='template_check',
+                        help="Render the template of each source with both template engines for the rows passing "
+                             "the filters, and report the rows rendered differently.")
     parser.add_argument('--onehot', action='store_true',
                         help="Generate one-hot encodings for columns that support it.")
     parser.add_argument('--categories', action='store_true',
@@ -37,9 +53,48 @@ def parse():
     parser.add_argument('--age', action='store_true',
                         help="Generate output column transforming date column to days since date value.")
 
+    parser.add_argument('--scale', action='store', type=str, default=None,
+                        choices=['zscore', 'minmax', 'log1p', 'robust'],
+                        help="Generate a scaled output column '<scale>_<column>' for columns configured as continuous, "
+                             "with parameters fitted once on the whole data file.")
+
+    parser.add_argument('--hash', action='store_true',
+                        help="Generate hash encodings into --hash-buckets buckets for columns configured with hash.")
+    parser.add_argument('--hash-buckets', action='store', dest='hash_buckets', type=int, default=64,
+                        help="Number of buckets of --hash encodings. Default=64.")
+    parser.add_argument('--hash-format', action='store', dest='hash_format', choices=['dense', 'sparse'],
+                        default='dense',
+                        help="Output --hash encodings as one count column per bucket (dense), or one column of the "
+                             "'|' separated buckets of each row (sparse). Default=dense.")
+
+    parser.add_argument('--compact', action='store_true',
+                        help="Reduce memory use by holding text as pyarrow strings, columns with few distinct values "
+                             "as categoricals, and numbers in the smallest numeric type holding them exactly. The "
+                             "output files are the same as without --compact.")
+
     # configuration management
     parser.add_argument('--force', action='store_true',
                         help="Download datafiles even if present and overwrite.")
+    parser.add_argument('--download-connections', action='store', dest='download_connections', type=int, default=4,
+                        help="Maximum number of files downloaded at the same time from one host. Default=4.")
+    parser.add_argument('--download-retries', action='store', dest='download_retries', type=int, default=3,
+                        help="Number of times to retry a failed download, waiting longer each time. Default=3.")
+    parser.add_argument('--data-cache', action='store', dest='data_cache', type=str, default=None,
+                        help="Directory shared by runs to download the data files of each source into, fetching each "
+                             "file once however many runs start at the same time. Default: the source directories.")
+    parser.add_argument('--db', action='store', type=str, default=None,
+                        help="SQLite database of the sources built with --build-db, to read the sources from instead "
+                             "of their data files, looking up the keys of the filters in its indexes.")
+    parser.add_argument('--build-db', action='store_true', dest='build_db',
+                        help="Load the sources into the --db database, one table per source with indexed join-group "
+                             "columns, and exit.")
+    parser.add_argument('--cache', action='store_true',
+                        help="Keep output files in a result cache and reuse them when run again with the same options, "
+                             "source data files and configuration.")
+    parser.add_argument('--cache-size', action='store', dest='cache_size', type=int, default=2048,
+                        help="Maximum size of the result cache in megabytes. Default=2048.")
+    parser.add_argument('--cache-age', action='store', dest='cache_age', type=int, default=30,
+                        help="Days after which unused result cache entries are removed. Default=30.")
     parser.add_argument('--counts', action='store_true',
                         help="Print unique value counts for columns (helpful for deciding on mappings and categories).")
 
@@ -52,15 +107,112 @@ def parse():
                         type=lambda s: [str(item) for item in s.split(',')])  # validate against configured dictionaries
     parser.add_argument('--joined-output',  action='store', dest='output', type=str, default=None,
                         help='The desired output file name.')
+    parser.add_argument('--aggregate-join', action='store_true', dest='aggregate_join',
+                        help="Collapse each source joined to --joined-output to one row per join key, with a count "
+                             "column and '|' separated distinct values, instead of one output row per matching row.")
+    parser.add_argument('--aggregate', action='store_true',
+                        help="Reduce each source with aggregate columns in its dictionary to one row per key, with "
+                             "the counts, distinct values and newest and oldest dates of the rows of the key.")
+    parser.add_argument('--explain', action='store_true',
+                        help="Print the plan of the joins of --joined-output with estimated and actual row counts.")
+    parser.add_argument('--max-memory', action='store', dest='max_memory', type=int,
+                        help="Megabytes of joined rows held in memory at a time for --joined-output, joining the rows "
+                             "of the first source in blocks spilled to disk.")
     parser.add_argument('--variant',  action='store', type=str,
                         help='Filter to a specific variant (CV VariationID). Variable must be tagged in join-group.')
     parser.add_argument('--gene',  action='store', type=str,
                         help='Filter to a specific gene (symbol). Variable must be tagged in join-group.')
+    parser.add_argument('--region', action='append', type=str, default=None,
+                        help="Filter to variants overlapping a genomic region chr:start-end[@assembly] (default "
+                             "assembly GRCh38) using the variant summary coordinates. May be repeated.")
+    parser.add_argument('--related', action='store_true',
+                        help="Resolve --gene, --variant and --region keys to the related keys of other join-groups "
+                             "(e.g. the genes of a variant) using the key graph, to filter and join sources without "
+                             "the requested join-group.")
+    parser.add_argument('--filter', action='store', type=str, default=None,
+                        help="Filter rows with an expression over dictionary columns and join-groups, e.g. "
+                             "\"ClinicalSignificance in ('Pathogenic','Likely pathogenic')\". Quote names with "
+                             "spaces or hyphens in backticks (`GENE SYMBOL`, `variation-id`).")
+    parser.add_argument('--sample', action='store', type=int, default=None,
+                        help="Read a uniform random sample of this many rows of each source passing the filters, in "
+                             "one pass over the data file.")
+    parser.add_argument('--sample-seed', action='store', dest='sample_seed', type=int, default=None,
+                        help="Seed of --sample, to sample the same rows on every run. Default: a new seed each run.")
+    parser.add_argument('--sample-by', action='store', dest='sample_by', type=str, default=None,
+                        help="Stratify --sample by a dictionary column, sampling --sample rows for each of its values.")
+    parser.add_argument('--sample-key', action='store', dest='sample_key', type=str, default=None,
+                        help="Sample the sources with a column in this join-group by key, keeping all the rows of "
+                             "--sample keys chosen the same in every source, so sampled sources still join.")
+    parser.add_argument('--chunk-size', action='store', dest='chunk_size', type=int, default=100000,
+                        help="Number of rows to read at a time while filtering and expanding source files.")
+    parser.add_argument('--writers', action='store', type=int, default=2,
+                        help="Number of background threads writing the outputs of each source while the next source "
+                             "is processed. 0 writes them in the main thread. Default=2.")
+    parser.add_argument('--shared-store', action='store_true', dest='shared_store',
+                        help="Read sources from memory mapped Arrow files saved next to the data files, so parallel "
+                             "runs share one copy of each source in memory. Built on first use.")
+    parser.add_argument('--text-store', action='store_true', dest='text_store',
+                        help="Assemble --template-output from templates pre-rendered once per data release and looked "
+                             "up by --gene, --variant and --region keys, instead of running the full pipeline.")
+    parser.add_argument('--shards', action='store', type=int, default=None,
+                        help="Partition the rows of the sources into this many shards by --shard-key, run each shard "
+                             "as a separate process and merge their outputs.")
+    parser.add_argument('--shard-key', action='store', dest='shard_key', type=str, default='variation-id',
+                        choices=['variation-id', 'gene-symbol', 'chromosome'],
+                        help="Join-group to shard by, or the chromosome of the variant. Default=variation-id.")
+    parser.add_argument('--shard-index', action='store', dest='shard_index', type=int, default=None,
+                        help="Run only this shard (0 to --shards - 1), e.g. as a separate job, writing its partial "
+                             "outputs under --shard-dir.")
+    parser.add_argument('--shard-merge', action='store_true', dest='shard_merge',
+                        help="Merge the partial outputs of shards run separately with --shard-index.")
+    parser.add_argument('--shard-dir', action='store', dest='shard_dir', type=str, default='shards',
+                        help="Directory for the partial outputs of each shard. Default=shards.")
+    parser.add_argument('--features', action='store_true',
+                        help="Also write the numeric encoded columns of each output as a memory mappable .npy feature "
+                             "matrix with a JSON file describing its columns.")
+    parser.add_argument('--feature-dtype', action='store', dest='feature_dtype', default='float32',
+                        choices=['float16', 'float32', 'float64'],
+                        help="Type of the values of the --features matrix. Default=float32.")
     parser.add_argument('--template-output', action='store', dest='text_output', type=str, default=None,
                         help="Generate text output file using template values to specified file.")
 
-    args = parser.parse_args()
+    parser.add_argument('--packed-output', action='store', dest='packed_output', type=str, default=None,
+                        help="Generate a JSON lines file of template text packed into chunks per variant or gene "
+                             "within the --pack-budget, for use as LLM input documents.")
+    parser.add_argument('--pack-budget', action='store', dest='pack_budget', type=int, default=4000,
+                        help="Maximum size of a --packed-output chunk in --pack-unit units. Default=4000.")
+    parser.add_argument('--pack-unit', action='store', dest='pack_unit', choices=['tokens', 'chars'], default='tokens',
+                        help="Measure --pack-budget in approximate tokens or in characters. Default=tokens.")
+
+    return parser
+
+
+def parse():
+    args = parser().parse_args()
+    try:
+        return check(args)
+    except ValueError as exc:
+        print("ERROR:", exc)
+        exit(-1)
 
+
+# the options of a pipeline run from a library: the defaults of the command line options, replaced by the options of
+# args and the keyword options (e.g. sources=['vrs', 'gencc-submissions'], onehot=True)
+def options(args=None, **values):
+    defaults = parser().parse_args([])
+    for option, value in {**vars(args or defaults), **values}.items():
+        if option not in vars(defaults) and option not in ('join',):
+            raise ValueError("unknown option {}".format(option))
+        if option in LIST_OPTIONS and isinstance(value, str):
+            value = value.split(',')
+        elif option in TEXT_OPTIONS and isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        setattr(defaults, option, value)
+    return check(defaults)
+
+
+# set the options implied by others and check the options can be used together, raising ValueError if not
+def check(args):
     # if --join-output then set flag for joining
     if args.output is not None:
         args.join = True
@@ -71,10 +223,62 @@ def parse():
     if args.text_output is not None and not args.template:
         args.template = True
 
+    # as does --packed-output
+    if args.packed_output is not None and not args.template:
+        args.template = True
+
     # if joining, then need a list of sources in desired join order
     if args.join and not args.sources:
-        print("ERROR: must specify --sources with --joined-output. The sources list is the list of data files to join.")
-        exit(-1)
+        raise ValueError("must specify --sources with --joined-output. The sources list is the list of data files to "
+                         "join.")
+
+    if args.max_memory is not None:
+        if args.max_memory < 1:
+            raise ValueError("--max-memory must be at least 1.")
+        if args.features:
+            raise ValueError("--max-memory cannot be used with --features.")
+    if args.build_db and not args.db:
+        raise ValueError("must specify --db with --build-db.")
+    if args.db and (args.shared_store or args.text_store):
+        raise ValueError("--db cannot be used with --shared-store or --text-store.")
+    if args.sample is not None:
+        if args.sample < 1:
+            raise ValueError("--sample must be at least 1.")
+        if args.shards is not None or args.text_store:
+            raise ValueError("--sample cannot be used with --shards or --text-store.")
+    elif args.sample_seed is not None or args.sample_by or args.sample_key:
+        raise ValueError("must specify --sample with --sample-seed, --sample-by or --sample-key.")
+    if args.writers < 0:
+        raise ValueError("--writers cannot be negative.")
+    if args.hash_buckets < 1:
+        raise ValueError("--hash-buckets must be at least 1.")
+
+    # shards
+    if args.shards is not None:
+        if args.shards < 1 or (args.shard_index is not None and not 0 <= args.shard_index < args.shards):
+            raise ValueError("--shard-index must be from 0 to --shards - 1.")
+        if args.text_store or args.packed_output or args.categories or args.features:
+            raise ValueError("--shards cannot be used with --text-store, --packed-output, --categories or --features.")
+    elif args.shard_index is not None or args.shard_merge:
+        raise ValueError("must specify --shards with --shard-index or --shard-merge.")
+
+    if args.template_check and (args.shards is not None or args.text_store):
+        raise ValueError("--template-check cannot be used with --shards or --text-store.")
+    # the rows of a key may be in several shards, and the templates are not rendered for aggregated sources
+    if args.aggregate and (args.shards is not None or args.template_check):
+        raise ValueError("--aggregate cannot be used with --shards or --template-check.")
 
+    # the text store holds the templates rendered from the source columns as read, for key lookups only
+    if args.text_store:
+        if args.text_output is None:
+            raise ValueError("must specify --template-output with --text-store.")
+        options = [('--joined-output', args.output), ('--filter', args.filter), ('--columns', args.columns),
+                   ('--map', args.map), ('--onehot', args.onehot), ('--categories', args.categories),
+                   ('--days', args.days), ('--age', args.age), ('--scale', args.scale), ('--hash', args.hash),
+                   ('--na-value', args.na_value), ('--aggregate', args.aggregate),
+                   ('--packed-output', args.packed_output), ('--features', args.features)]
+        other_options = [o for o, v in options if v is not None and v is not False]
+        if len(other_options) > 0:
+            raise ValueError("--text-store cannot be used with " + ', '.join(other_options))
 
     return args
@@ -21,7 +21,7 @@ while IFS= read -r VARIANT_ID; do
     echo "Generating summary for variant ID: $VARIANT_ID"
 
     # Run main.py in the current directory
-    python main.py --loglevel=$LOGLEVEL --template \
+    python main.py --loglevel=$LOGLEVEL --template --shared-store \
         --sources="clinvar-submission-summary,clinvar-variant-summary,gencc-submissions,clingen-dosage,clingen-gene-disease,vrs" \
         --joined-output="${VARIANT_ID}.csv" --variant=$VARIANT_ID
 
@@ -25,7 +25,7 @@ mkdir -p "$output_folder"
 while IFS= read -r variant_id || [[ -n "$variant_id" ]]; do
     if [[ -n "$variant_id" ]]; then  # Ensure the line is not empty
         echo "Processing variant ID: $variant_id"
-        python main.py --loglevel=info --expand \
+        python main.py --loglevel=info --expand --text-store \
             --sources="clinvar-submission-summary,clinvar-variant-summary,vrs,gencc-submissions,clingen-gene-disease,clingen-consensus-assertions-adult,clingen-consensus-assertions-pediatric,clingen-dosage,clingen-overall-scores-adult,clingen-overall-scores-pediatric" \
             --template --template-output="${output_folder}/variant_${variant_id}.txt" \
             --variant="$variant_id"
@@ -0,0 +1,163 @@
+# local modules
+import helper
+import source
+
+# other libraries
+import hashlib
+import json
+import os
+import shutil
+import time
+from os.path import isfile
+
+#########################
+#
+# RESULT CACHE
+#
+# With --cache, the output files of a run are kept in a cache directory under a key hashing everything the outputs
+# depend on: the normalized command line options that change the output, the signatures of the source data files
+# used, the contents of their config.yml (including the template), dictionary.csv and mapping.csv files, and the
+# program itself. Repeating a run with the same key hard-links the cached files into place without running the
+# pipeline. A new data file or configuration change for a source only changes the keys of runs using that source.
+#
+# Entries not used for --cache-age days are removed, then the least recently used entries until the cache is within
+# --cache-size megabytes.
+#
+#########################
+
+MANIFEST_FILE = 'manifest.json'
+# options shown not to change the output files; options that may (e.g. --compact, --template-engine, whose engines
+# are compared by --template-check) are part of the key
+IGNORED_OPTIONS = {'loglevel', 'event_log', 'force', 'download_connections', 'download_retries', 'cache', 'cache_size',
+                   'cache_age', 'shared_store', 'writers', 'max_memory', 'data_cache'}
+# options with a list of values where the order of the values does not change the output files
+UNORDERED_OPTIONS = {'gene', 'variant', 'region', 'columns'}
+PROGRAM_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def normalize(args):
+    options = {}
+    for option, value in sorted(vars(args).items()):
+        if option in IGNORED_OPTIONS or value is None or value is False:
+            continue
+        if option in UNORDERED_OPTIONS:
+            value = sorted(set(value.split(',') if isinstance(value, str) else value))
+        options[option] = value
+    return options
+
+
+def file_hash(file_path):
+    if not isfile(file_path):
+        return None
+    with open(file_path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+# key of the outputs of a run with the options args over the named sources, or None if a data file is missing, the
+# sources are sampled at random or read from a database
+def key(args, sources_path, names):
+    if args.sample is not None and args.sample_seed is None:
+        helper.debug("Sampling with a new seed; not using result cache")
+        return None
+    if args.db:
+        helper.debug("Reading sources from a database; not using result cache")
+        return None
+    sources = {}
+    for name in sorted(names):
+        sourcefile = source.get(sources_path, name)
+        data_file = source.data_file(sourcefile)
+        if not isfile(data_file):
+            helper.debug("No data file for", name, "; not using result cache")
+            return None
+        sources[name] = {
+            'data': helper.file_signature(data_file),
+            'config': file_hash(os.path.join(sourcefile.get('path'), 'config.yml')),
+            'dictionary': file_hash(os.path.join(sourcefile.get('path'), sourcefile.get('dictionary'))),
+            'mapping': file_hash(os.path.join(sourcefile.get('path'), sourcefile.get('mapping'))),
+        }
+    program = {f: file_hash(os.path.join(PROGRAM_PATH, f)) for f in sorted(os.listdir(PROGRAM_PATH))
+               if f.endswith('.py')}
+    text = json.dumps({'options': normalize(args), 'sources': sources, 'program': program}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def entry_path(cache_path, cache_key):
+    return os.path.join(cache_path, cache_key)
+
+
+# replace the file instead of writing through a hard link into a cached copy
+def detach(file_path):
+    if isfile(file_path) and os.stat(file_path).st_nlink > 1:
+        os.remove(file_path)
+
+
+def link(from_path, to_path):
+    if os.path.lexists(to_path):
+        os.remove(to_path)
+    try:
+        os.link(from_path, to_path)
+    except OSError:
+        # different file system, or hard links not supported
+        shutil.copyfile(from_path, to_path)
+
+
+# link the cached output files into place, returning False if the key is not cached
+def serve(cache_path, cache_key):
+    entry = entry_path(cache_path, cache_key)
+    manifest_file = os.path.join(entry, MANIFEST_FILE)
+    if not isfile(manifest_file):
+        return False
+    with open(manifest_file, 'r') as fp:
+        manifest = json.load(fp)
+    if not all(isfile(os.path.join(entry, cached)) for cached in manifest['files'].values()):
+        helper.warning("Incomplete result cache entry", entry)
+        shutil.rmtree(entry, ignore_errors=True)
+        return False
+    for output_file, cached in manifest['files'].items():
+        helper.debug("Serving", output_file, "from result cache")
+        link(os.path.join(entry, cached), output_file)
+    # the modification time of an entry is its last use, for eviction
+    os.utime(entry)
+    return True
+
+
+# keep the output files of a run under the key
+def store(cache_path, cache_key, output_files):
+    entry = entry_path(cache_path, cache_key)
+    temp_entry = "{}.{}.tmp".format(entry, os.getpid())
+    os.makedirs(temp_entry, exist_ok=True)
+    manifest = {'files': {}, 'created': time.time()}
+    for i, output_file in enumerate(output_files):
+        cached = "{}-{}".format(i, os.path.basename(output_file))
+        link(output_file, os.path.join(temp_entry, cached))
+        manifest['files'][output_file] = cached
+    with open(os.path.join(temp_entry, MANIFEST_FILE), 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    # another run may have stored the same key meanwhile
+    shutil.rmtree(entry, ignore_errors=True)
+    os.rename(temp_entry, entry)
+    helper.info("Stored", len(output_files), "output files in result cache", entry)
+
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+
+# remove entries unused for max_age_days, then the least recently used until within max_size_mb
+def evict(cache_path, max_size_mb, max_age_days):
+    if not os.path.isdir(cache_path):
+        return
+    entries = [os.path.join(cache_path, e) for e in os.listdir(cache_path)
+               if isfile(os.path.join(cache_path, e, MANIFEST_FILE))]
+    entries.sort(key=os.path.getmtime)
+    oldest = time.time() - max_age_days * 86400
+    while len(entries) > 0 and os.path.getmtime(entries[0]) < oldest:
+        helper.info("Evicting result cache entry", entries[0], "unused for", max_age_days, "days")
+        shutil.rmtree(entries.pop(0), ignore_errors=True)
+    sizes = {e: entry_size(e) for e in entries}
+    total = sum(sizes.values())
+    while len(entries) > 0 and total > max_size_mb * 1024 * 1024:
+        entry = entries.pop(0)
+        helper.info("Evicting result cache entry", entry, "to keep cache within", max_size_mb, "MB")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
@@ -0,0 +1,202 @@
+# local modules
+import download
+import filters
+import helper
+import keygraph
+import source
+import store
+
+# other libraries
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+#########################
+#
+# SQLITE RELEASE DATABASE
+#
+# With --build-db, every configured source (or those of --sources) is loaded into the SQLite database --db, one table
+# per source named as the source, with a column for each column of the data file named as in dictionary.csv and a row
+# for each row in the order of the file. Each column has one type for the whole file, as in the shared source store
+# (INTEGER, REAL or TEXT). Every join-group column is indexed, and the release of each source is recorded in the
+# 'releases' table: the data file, its url, md5 checksum and download time from the download manifest, its size and
+# modification time, the number of rows and the types of the columns. A source already loaded from the same data file
+# is not loaded again.
+#
+# With --db, the sources are read from the database instead of their data files, which need not be present. The key
+# constraints of the filters (--gene, --variant, --region, --related and the join-groups of --filter) are evaluated
+# as SQL on the indexed join-group columns, so a query for a few keys only reads their rows, and the filters are then
+# applied to the rows read as they are to the rows of a data file. The rows go through the encodings, templates and
+# joins as the rows of the data files do, and the database can be queried directly for ad-hoc lookups.
+#
+#########################
+
+RELEASES_TABLE = 'releases'
+# SQLite types of the arrow types of the columns
+SQL_TYPES = {'int64': 'INTEGER', 'double': 'REAL', 'bool': 'INTEGER', 'string': 'TEXT'}
+ARROW_TYPES = {'int64': pa.int64(), 'double': pa.float64(), 'bool': pa.bool_(), 'string': pa.string()}
+
+
+def quote(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def connect(db_file):
+    connection = sqlite3.connect(db_file)
+    connection.execute("CREATE TABLE IF NOT EXISTS {} (name TEXT PRIMARY KEY, file TEXT, url TEXT, md5 TEXT, "
+                       "fetched REAL, signature TEXT, rows INTEGER, columns TEXT, built REAL)".format(RELEASES_TABLE))
+    return connection
+
+
+# the release of a source loaded in the database, or None
+def release(connection, name):
+    cursor = connection.execute("SELECT * FROM {} WHERE name = ?".format(RELEASES_TABLE), (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([d[0] for d in cursor.description], row))
+
+
+# load a source into the database, replacing any earlier release of it
+def load_source(connection, sourcefile, dic, chunksize):
+    name = sourcefile.get('name')
+    data_file = source.data_file(sourcefile)
+    signature = helper.file_signature(data_file)
+    loaded = release(connection, name)
+    if loaded is not None and loaded['signature'] == signature:
+        helper.info("Database has the release of", name, "from", data_file)
+        return False
+    helper.info("Loading", name, "into database")
+
+    # first pass finds the type of each column over the whole file, second pass inserts the rows
+    kinds = {}
+    for chunk in source.read(sourcefile, chunksize):
+        for column in chunk.columns:
+            kinds.setdefault(column, set()).add(store.kind(chunk[column]))
+    schema = pa.schema([(column, store.column_type(k)) for column, k in kinds.items()])
+
+    table = quote(name)
+    connection.execute("DROP TABLE IF EXISTS {}".format(table))
+    connection.execute("CREATE TABLE {} ({})".format(table, ', '.join(
+        "{} {}".format(quote(f.name), SQL_TYPES[str(f.type)]) for f in schema)))
+    insert = "INSERT INTO {} VALUES ({})".format(table, ', '.join('?' * len(schema)))
+    rows = 0
+    for chunk in source.read(sourcefile, chunksize):
+        batch = pa.record_batch([store.as_column(chunk[f.name], f.type) for f in schema], schema=schema)
+        connection.executemany(insert, zip(*[column.to_pylist() for column in batch.columns]))
+        rows += len(chunk)
+
+    join_columns = [c for c in dic.loc[dic['join-group'].notnull(), 'column'] if c in kinds]
+    for i, column in enumerate(join_columns):
+        connection.execute("CREATE INDEX {} ON {} ({})".format(quote("{}_{}".format(name, i)), table,
+                                                                 quote(column)))
+    fetched = download.manifest(sourcefile)
+    connection.execute("INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)".format(RELEASES_TABLE), (
+        name, sourcefile.get('file'), sourcefile.get('url'), fetched.get('md5'), fetched.get('fetched'), signature,
+        rows, json.dumps({f.name: str(f.type) for f in schema}), time.time()))
+    connection.commit()
+    helper.info("Loaded", rows, "rows of", name, "into database with", len(join_columns), "indexed join-group columns")
+    return True
+
+
+# load the sources into the database db_file; dictionaries are the dictionary of each source
+def build(db_file, source_files_df, dictionaries, chunksize):
+    connection = connect(db_file)
+    try:
+        loaded = sum(load_source(connection, sourcefile, dictionaries[sourcefile.get('name')], chunksize)
+                     for i, sourcefile in source_files_df.iterrows())
+    finally:
+        connection.close()
+    helper.info("Loaded", loaded, "of", len(source_files_df), "sources into database", db_file)
+    return loaded
+
+
+# the SQL condition and parameters selecting the rows of a source with the keys required by the filters, or (None,
+# []) if no filter constrains the keys; the rows selected include all those matching the filters
+def key_condition(row_filters, dic, columns, expand_columns):
+    header = pd.DataFrame(columns=columns)
+    join_groups = sorted(set(dic.loc[dic['column'].isin(columns), 'join-group'].dropna()))
+    conditions = []
+    parameters = []
+    for f in row_filters:
+        if isinstance(f, filters.FirstApplicable):
+            f = f.choice(header, dic)
+        if not isinstance(f, filters.Filter) or not f.applies(header, dic):
+            continue
+        for join_group in join_groups:
+            values = f.keys(join_group, dic)
+            if values is None:
+                continue
+            # as given and as text, for a key to match in columns of any type
+            values = sorted(set(v for v in values) | set(keygraph.key(v) for v in values), key=str)
+            matches = []
+            for column in dic.loc[dic['join-group'] == join_group, 'column']:
+                if column not in columns:
+                    continue
+                matches.append("{} IN (SELECT value FROM json_each(?))".format(quote(column)))
+                parameters.append(json.dumps(values))
+                # a list of keys matches once expanded
+                if column in expand_columns:
+                    matches.append("instr({}, ',') > 0".format(quote(column)))
+            conditions.append("({})".format(' OR '.join(matches) or '0'))
+    if len(conditions) == 0:
+        return None, []
+    return ' AND '.join(conditions), parameters
+
+
+def as_array(values, arrow_type):
+    if arrow_type == pa.bool_():
+        values = [None if v is None else bool(v) for v in values]
+    return pa.array(values, type=arrow_type)
+
+
+# read the rows of a source from the database in chunks, like source.read; only the rows with the keys required by
+# the filters, if given
+def read(db_file, sourcefile, chunksize, row_filters=(), dic=None, expand_columns=()):
+    name = sourcefile.get('name')
+    if not os.path.isfile(db_file):
+        raise helper.PipelineError("no database {}; build it with --build-db.".format(db_file))
+    connection = connect(db_file)
+    try:
+        loaded = release(connection, name)
+        if loaded is None:
+            raise helper.PipelineError("source {} is not in database {}; load it with --build-db.".format(name,
+                                                                                                        db_file))
+        data_file = source.data_file(sourcefile)
+        if os.path.isfile(data_file) and helper.file_signature(data_file) != loaded['signature']:
+            helper.warning("Database", db_file, "has an earlier release of", name, "than", data_file,
+                           "; load it with --build-db.")
+        types = json.loads(loaded['columns'])
+        columns = list(types)
+        condition, parameters = (None, []) if dic is None else key_condition(row_filters, dic, columns,
+                                                                             expand_columns)
+        query = "SELECT rowid, {} FROM {}".format(', '.join(quote(c) for c in columns), quote(name))
+        if condition is not None:
+            query += " WHERE " + condition
+        helper.debug("Reading", name, "from database:", query)
+        cursor = connection.execute(query + " ORDER BY rowid", parameters)
+        read_rows = 0
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if len(rows) == 0 and read_rows > 0:
+                break
+            values = list(zip(*rows)) if len(rows) > 0 else [()] * (len(columns) + 1)
+            table = pa.table([as_array(v, ARROW_TYPES[types[c]]) for c, v in zip(columns, values[1:])],
+                             names=columns)
+            chunk = table.to_pandas()
+            # the position of each row in the data file
+            chunk.index = pd.Index(np.asarray(values[0], dtype=np.int64) - 1)
+            # missing text values are NaN, as when parsed from the data file
+            for column in chunk.columns[chunk.dtypes == object]:
+                chunk[column] = chunk[column].where(chunk[column].notna(), np.nan)
+            yield chunk
+            if len(rows) == 0:
+                break
+            read_rows += len(rows)
+        helper.debug("Read", read_rows, "of", loaded['rows'], "rows of", name, "from database")
+    finally:
+        connection.close()
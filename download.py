@@ -2,100 +2,269 @@
 import helper
 
 # other libraries
+import contextlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os import access, R_OK
 from os.path import isfile
+from urllib.parse import urlparse
+import filelock
+import requests
 
 #########################
 #
 # DOWNLOAD DATA FILES
 #
+# The data files of all the sources to download, and their md5 checksum files, are fetched at the same time by a
+# pool of threads over one pooled requests session, so downloads also run from code with a running event loop (e.g.
+# a notebook using the pipeline API). At most CONNECTIONS_PER_HOST files are fetched from the same host at once,
+# failed requests are retried with exponential backoff, and the progress of each file is logged. Files are written
+# under a temporary name and renamed when complete, so an interrupted download is never taken for a data file, and
+# the temporary file of a failed download is removed. Checksums are verified and gzip files unpacked once all the
+# files are fetched.
+#
+# With --data-cache, the data files of each source are kept in a directory of the data cache named as the source
+# directory, shared by the runs of every checkout on the machine, instead of in the source directory. Runs started
+# at the same time fetch each file once: the files of a source are fetched and unpacked holding a lock file in its
+# data directory, and a run finding the lock held waits for it, then uses the files fetched by the other run (with
+# --force, those fetched after it started). The gzip file is unpacked under a temporary name and renamed when
+# complete too, so a data file is never read partly written. The url, md5 checksum (and whether it was verified) and
+# time of each fetch are recorded in a manifest in the data directory; a file failing its checksum is removed.
+#
 #########################
 
+CONNECTIONS_PER_HOST = 4
+RETRIES = 3
+BACKOFF_SECONDS = 2
+# seconds to wait to connect, and between bytes received
+TIMEOUT = (30, 300)
+PROGRESS_SECONDS = 10
+# responses worth retrying: rate limited and server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+LOCK_FILE = 'download.lock'
+MANIFEST_FILE = 'manifest.json'
 
-def all_files(source_files_df, force):
-    download_count = 0
-    for i, s in source_files_df.iterrows():
-        if download(s, force):
-            download_count = download_count + 1
 
-    if download_count > 0:
-        helper.info("Downloading complete;", download_count, "files.")
+def all_files(source_files_df, force, connections_per_host=CONNECTIONS_PER_HOST, retries=RETRIES):
+    started = time.time()
+    pending = [s for i, s in source_files_df.iterrows() if needs_download(s, force)]
+    if len(pending) > 0:
+        fetched = fetch_locked(pending, force, started, connections_per_host, retries)
+        helper.info("Downloading complete;", fetched, "files.")
     else:
         helper.info("All files present. No files to download.")
 
 
 def download(source, force):
-    # TODO: use os path join instead
+    started = time.time()
+    if not needs_download(source, force):
+        # False indicates we did not download file
+        return False
+    # True if we downloaded a file, False if another run did while we waited for it
+    return fetch_locked([source], force, started, CONNECTIONS_PER_HOST, RETRIES) > 0
+
+
+def file_path(source, file_key):
+    file = source.get(file_key)
+    return os.path.join(source.get('data_path'), file) if file else ''
+
 
+# the manifest of the files fetched into the data directory of a source, or {} if none were
+def manifest(source):
+    manifest_file = os.path.join(source.get('data_path'), MANIFEST_FILE)
+    if not isfile(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as fp:
+        return json.load(fp)
+
+
+def write_manifest(source, entry):
+    manifest_file = os.path.join(source.get('data_path'), MANIFEST_FILE)
+    with open(manifest_file + '.part', 'w') as fp:
+        json.dump(entry, fp, indent=2, sort_keys=True)
+    os.replace(manifest_file + '.part', manifest_file)
+
+
+# whether the data file of a source is to be fetched; with since, not if another run fetched it after since
+def needs_download(source, force, since=None):
     name = source.get('name')
-    source_path = source.get('path')
-    file = source.get('file')
-    file_path = ''
-    if file:
-        file_path = source_path + '/' + file
-        helper.debug("datafile specified for ", name, "as", file_path)
+    data_file_path = file_path(source, 'file')
+    if len(data_file_path) == 0:
+        raise helper.PipelineError("No datafile specified for {}!".format(name))
+    helper.debug("datafile specified for ", name, "as", data_file_path)
+
+    present = isfile(data_file_path) and access(data_file_path, R_OK)
+    if present and since is not None and manifest(source).get('fetched', 0) >= since:
+        helper.info("Using", data_file_path, "downloaded by another run")
+        return False
 
     # if not forced, let's check if the file already exists to see if we need to download or not
-    if not force:
-        if len(file_path) > 0:
-            if isfile(file_path) and access(file_path, R_OK):
-                helper.debug("Found existing readable file", file_path)
-                # False indicates we did not download file
-                return False
-        else:
-            helper.critical("No datafile specified for", name, "!")
-            exit(-1)
-
-    # we need to download the file
-    download_file = source.get('download_file')
-    download_file_path = ''
-    if download_file:
-        download_file_path = source_path + '/' + download_file
-        helper.debug("download_file specified for ", name, "as", download_file)
-    md5_file = source.get('md5_file')
-    md5_file_path = ''
-    if md5_file:
-        md5_file_path = source_path + '/' + md5_file
-    md5_hash_downloaded = ''
-    md5_url = source.get('md5_url')
-    url = source.get('url')
-    if url:
-        if download_file:
-            helper.download(url, download_file_path)
-            file_we_downloaded = download_file_path
-        else:
-            helper.download(url, file_path)
-            file_we_downloaded = file_path
-        if md5_url:  # if we are doing md5 check then get the hash for the downloaded file
-            md5_hash_downloaded = helper.get_md5(file_we_downloaded)
-        helper.info("Completed data file download;", file_we_downloaded)
-    else:
-        print("ERROR: no url for", file, "for source", source.get('name'), "; Please acquire manually.")
-        helper.critical("No url for", file, "for source", source.get('name'), "; Please acquire manually.")
-        exit(-1)
-    if md5_url:
-        if md5_file:
-            r = helper.download(md5_url, md5_file_path)
-            md5_hash_approved = r.text.split(' ')
+    if not force and present:
+        helper.debug("Found existing readable file", data_file_path)
+        return False
+
+    if not source.get('url'):
+        raise helper.PipelineError("no url for {} for source {}; Please acquire manually.".format(source.get('file'),
+                                                                                                   name))
+    return True
+
+
+# hold the download lock of a source, waiting while another run holds it
+@contextlib.contextmanager
+def locked(source):
+    os.makedirs(source.get('data_path'), exist_ok=True)
+    lock = filelock.FileLock(os.path.join(source.get('data_path'), LOCK_FILE))
+    try:
+        lock.acquire(timeout=0)
+    except filelock.Timeout:
+        helper.info("Waiting for another run downloading or building the files of", source.get('name'))
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+# fetch and unpack the files of the sources holding their locks, except those another run fetched after started;
+# returns the number of sources fetched
+def fetch_locked(sources, force, started, connections_per_host, retries):
+    with contextlib.ExitStack() as locks:
+        # locks taken in the same order by every run
+        for s in sorted(sources, key=lambda s: s.get('data_path')):
+            locks.enter_context(locked(s))
+        pending = [s for s in sources if needs_download(s, force, since=started)]
+        if len(pending) > 0:
+            fetch_all(pending, connections_per_host, retries)
+            for s in pending:
+                finish(s)
+        return len(pending)
+
+
+# (url, file path) of each file to fetch for a source: the downloaded data file and its md5 file, if any
+def downloads(source):
+    files = [(source.get('url'), file_path(source, 'download_file') or file_path(source, 'file'))]
+    if source.get('md5_url') and source.get('md5_file'):
+        files.append((source.get('md5_url'), file_path(source, 'md5_file')))
+    return files
+
+
+def fetch_all(sources, connections_per_host, retries):
+    files = [f for s in sources for f in downloads(s)]
+    hosts = set(urlparse(url).netloc for url, path in files)
+    started = time.monotonic()
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(hosts),
+                                                pool_maxsize=connections_per_host * len(hosts))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        failures = fetch_files(session, files, connections_per_host, retries)
+    if len(failures) > 0:
+        raise helper.PipelineError('; '.join("download of {} failed: {}".format(url, exc) for url, exc in failures))
+    helper.info("Fetched", len(files), "files from", len(hosts), "hosts in", round(time.monotonic() - started, 1),
+                "seconds")
+
+
+# fetch the files in a thread each, at most connections_per_host at once from each host; returns the (url, exception)
+# of each file that failed
+def fetch_files(session, files, connections_per_host, retries):
+    limits = {}
+    for url, path in files:
+        limits.setdefault(urlparse(url).netloc, threading.Semaphore(connections_per_host))
+    # enough threads for every host to use all its connections
+    with ThreadPoolExecutor(max_workers=connections_per_host * len(limits)) as pool:
+        futures = [pool.submit(fetch, session, url, path, limits[urlparse(url).netloc], retries)
+                   for url, path in files]
+    return [(url, f.exception()) for (url, path), f in zip(files, futures) if f.exception() is not None]
+
+
+def fetch(session, url, path, limit, retries):
+    with limit:
+        for attempt in range(retries + 1):
+            try:
+                return fetch_file(session, url, path)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError) as exc:
+                response = getattr(exc, 'response', None)
+                if attempt == retries or (response is not None and response.status_code not in RETRY_STATUS):
+                    raise
+                delay = BACKOFF_SECONDS * 2 ** attempt
+                helper.warning("Download of", url, "failed;", exc, "; retrying in", delay, "seconds")
+                time.sleep(delay)
+
+
+# stream url to path through a temporary file, logging progress
+def fetch_file(session, url, path):
+    temp_path = path + '.part'
+    progress = Progress(path)
+    try:
+        helper.download(url, temp_path, session=session, timeout=TIMEOUT, progress=progress.update)
+    except BaseException:
+        if isfile(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+    helper.info("Completed download of", path, ";", progress)
+    return path
+
+
+class Progress:
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.total = None
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def __str__(self):
+        seconds = time.monotonic() - self.started
+        total = "" if self.total is None else " of {:.1f}".format(self.total / 1e6)
+        return "{:.1f}{} MB in {:.1f} seconds".format(self.size / 1e6, total, seconds)
+
+    def update(self, size, total):
+        self.size = size
+        self.total = total
+        now = time.monotonic()
+        if now - self.reported >= PROGRESS_SECONDS:
+            self.reported = now
+            helper.info("Downloading", self.path, ";", self)
+
+
+# verify the md5 checksum and unpack the downloaded file as the data file, recording them in the manifest
+def finish(source):
+    name = source.get('name')
+    download_file_path = file_path(source, 'download_file') or file_path(source, 'file')
+    helper.info("Completed data file download;", download_file_path)
+    md5_hash_downloaded = helper.get_md5(download_file_path)
+    verified = False
+    if source.get('md5_url'):
+        if source.get('md5_file'):
+            with open(file_path(source, 'md5_file'), 'r') as fp:
+                md5_hash_approved = fp.read().split(' ')
             if md5_hash_downloaded in md5_hash_approved:
                 helper.info("MD5 check successful")
+                verified = True
             else:
-                helper.error("ERROR: MD5 check failed")
                 helper.error("Approved:", md5_hash_approved)
                 helper.error("Downloaded:", md5_hash_downloaded)
-                exit(-1)
+                # so the file is not taken for a data file by later runs
+                os.remove(download_file_path)
+                raise helper.PipelineError("MD5 check failed for {}".format(download_file_path))
         else:
             helper.warning("WARNING: md5_url specified but not md5_file. Not performing checksum.")
 
     # unzip the downloaded file if configured to do so and output as "file"
-    gzip_flag = source.get('gzip')
-    if gzip_flag:
-        if file != download_file:  # for gzip datafile and download file should be different
-            helper.gunzip_file(download_file_path, file_path)
+    if source.get('gzip'):
+        if source.get('file') != source.get('download_file'):  # for gzip datafile and download file should differ
+            data_file_path = file_path(source, 'file')
+            helper.gunzip_file(download_file_path, data_file_path + '.part')
+            os.replace(data_file_path + '.part', data_file_path)
         else:
             helper.error("gzip option requires differing data/download file names for", name)
 
-    # else:  if there's a future case where we need to change the name of a non-gzip downloaded file afterward
-
-    # return True since we downloaded a file
-    return True
+    write_manifest(source, {'url': source.get('url'), 'download_file': os.path.basename(download_file_path),
+                            'file': source.get('file'), 'md5': md5_hash_downloaded, 'md5_verified': verified,
+                            'fetched': time.time()})
@@ -0,0 +1,131 @@
+# local modules
+import helper
+import planner
+import source
+
+# other libraries
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+#########################
+#
+# MEMORY BOUNDED JOIN
+#
+# With --max-memory, the joined output is not built in memory. The rows of the first source are joined a block of
+# rows at a time with the other sources, and the output rows of each block are spilled to a file on disk before the
+# next block is joined. The blocks are sized for their output rows to take about half of --max-memory, starting from
+# the estimated rows of the join plan and the memory of a sample of the rows of each source, then from the memory of
+# the output rows of the blocks already joined; a block taking more than --max-memory is split in halves and joined
+# again. The spilled blocks are then appended in turn to the output file, with the types the columns would have in
+# the output joined in memory (e.g. float for an integer column with missing values in any block), so the output file
+# is the same.
+#
+# The sources are still read into memory; only the rows of the joined output, which may be many times those of the
+# sources, are bounded.
+#
+#########################
+
+SPILL_SUFFIX = '.spill'
+# rows of each source sampled to estimate the memory of an output row
+SAMPLE_ROWS = 1000
+# fraction of --max-memory the output rows of a block are sized to take
+BLOCK_TARGET = 0.5
+
+
+def memory(df):
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+
+# estimated rows of the first source per block, from the plan and a sample of the memory of the rows of each source
+def block_rows(join_plan, data, budget):
+    first = data[join_plan.steps[0].name]
+    row_memory = 0
+    for step in join_plan.steps:
+        sample = data[step.name].head(SAMPLE_ROWS)
+        row_memory += memory(sample) / max(1, len(sample))
+    fanout = join_plan.order[-1].estimate / max(1, len(first))
+    rows = int(budget * BLOCK_TARGET / max(1.0, row_memory * fanout))
+    helper.debug("Estimated", row_memory, "bytes per output row and", fanout, "output rows per row of",
+                 join_plan.steps[0].name, "for blocks of", rows, "rows")
+    return max(1, rows)
+
+
+# the output rows of the rows from start to stop of the first source, joined in halves while over budget
+def join_block(join_plan, data, key_graph, aggregate, frames, start, stop, budget):
+    out_df = planner.execute(join_plan, data, key_graph, aggregate, rows=(start, stop), frames=frames)
+    used = memory(out_df)
+    if used > budget and stop - start > 1:
+        helper.debug("Output of rows", start, "to", stop, "takes", used, "bytes, joining them in halves")
+        del out_df
+        middle = (start + stop) // 2
+        yield from join_block(join_plan, data, key_graph, aggregate, frames, start, middle, budget)
+        yield from join_block(join_plan, data, key_graph, aggregate, frames, middle, stop, budget)
+        return
+    if used > budget:
+        helper.warning("The", len(out_df), "output rows of row", start, "of", join_plan.steps[0].name, "take",
+                       used // (1024 * 1024), "MB, more than --max-memory")
+    yield out_df, stop - start
+
+
+# the output rows of the joins of the plan, a block of rows of the first source at a time; the actual rows of the
+# steps of the plan are summed over the blocks
+def blocks(join_plan, data, key_graph, aggregate, budget):
+    first = data[join_plan.steps[0].name]
+    frames = planner.right_frames(join_plan, data, aggregate)
+    rows = block_rows(join_plan, data, budget)
+    actual = {step.index: 0 for step in join_plan.steps}
+    start = 0
+    while True:
+        stop = min(len(first), start + rows)
+        used = 0
+        for out_df, block in join_block(join_plan, data, key_graph, aggregate, frames, start, stop, budget):
+            for step in join_plan.steps:
+                actual[step.index] += step.actual
+            used += memory(out_df)
+            helper.debug("Joined", block, "rows of", join_plan.steps[0].name, "into", len(out_df), "rows")
+            yield out_df
+        if stop >= len(first):
+            break
+        # size the next blocks from the memory of the output rows of this one
+        rows = max(1, int(budget * BLOCK_TARGET / max(1.0, used / (stop - start))))
+        start = stop
+    for step in join_plan.steps:
+        step.actual = actual[step.index]
+
+
+# write the output rows of the joins of the plan to output_file, spilling each block to disk, with finish(df)
+# applied to each block before it is written; returns the number of rows written
+def write(output_file, join_plan, data, key_graph, aggregate, max_memory, finish):
+    budget = max_memory * 1024 * 1024
+    spill_path = tempfile.mkdtemp(prefix=os.path.basename(output_file) + '.', suffix=SPILL_SUFFIX,
+                                  dir=os.path.dirname(output_file) or '.')
+    try:
+        spill_files = []
+        # the columns of each block without its rows, for the types of the columns of all the blocks together, and
+        # the --compact integer columns with missing values in any block, written as floats in every block
+        heads = []
+        float_columns = set()
+        for out_df in blocks(join_plan, data, key_graph, aggregate, budget):
+            spill_file = os.path.join(spill_path, "{}.pkl".format(len(spill_files)))
+            out_df.to_pickle(spill_file)
+            spill_files.append(spill_file)
+            heads.append(out_df.iloc[0:0])
+            float_columns.update(source.missing_integer_columns(out_df))
+        dtypes = pd.concat(heads).dtypes
+        helper.info("Spilled", len(spill_files), "blocks of joined rows to", spill_path)
+
+        rows = 0
+        for i, spill_file in enumerate(spill_files):
+            out_df = pd.read_pickle(spill_file)
+            os.remove(spill_file)
+            changed = {c: t for c, t in dtypes.items() if out_df[c].dtype != t}
+            if len(changed) > 0:
+                out_df = out_df.astype(changed)
+            out_df = source.as_written(finish(out_df), float_columns)
+            out_df.to_csv(output_file, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+            rows += len(out_df)
+        return rows
+    finally:
+        shutil.rmtree(spill_path, ignore_errors=True)
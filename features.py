@@ -0,0 +1,69 @@
+# local modules
+import helper
+
+# other libraries
+import json
+import os
+import numpy as np
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+#########################
+#
+# FEATURE MATRIX
+#
+# With --features, the numeric encoded columns of each source output and of the joined output (one-hot, categories,
+# map values, days and age, continuous columns, and the row counts of --aggregate-join) are also written as a
+# contiguous --feature-dtype matrix in a .npy file, one row per output row, next to a JSON file describing the
+# columns: the name of each column, the source and source column it was encoded from, and its encoding. Missing
+# values are NaN. The matrix is written a chunk of rows at a time into a memory mapped file, and renamed into place
+# when complete, so training code can memory map it (numpy.load(file, mmap_mode='r'), then torch.from_numpy) without
+# parsing or casting the CSV output.
+#
+#########################
+
+FEATURES_SUFFIX = '.features.npy'
+COLUMNS_SUFFIX = '.features.json'
+
+
+# the feature files for a CSV output file, e.g. vrs-output.features.npy and vrs-output.features.json
+def files(output_file):
+    stem = os.path.splitext(output_file)[0]
+    return stem + FEATURES_SUFFIX, stem + COLUMNS_SUFFIX
+
+
+# numeric and boolean columns, including those holding missing values as objects after a left join
+def is_feature(series):
+    if is_numeric_dtype(series.dtype) or is_bool_dtype(series.dtype):
+        return True
+    if series.dtype != object:
+        return False
+    try:
+        series.dropna().astype('float64')
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+# write the numeric columns of df described by columns, a list of {'name', 'source', 'column', 'encoding'}
+def write(output_file, df, columns, dtype, chunk_size):
+    matrix_file, columns_file = files(output_file)
+    numeric = [c for c in columns if c['name'] in df and is_feature(df[c['name']])]
+    helper.debug("Not numeric, not in feature matrix:", [c['name'] for c in columns if c not in numeric])
+    columns = numeric
+    names = [c['name'] for c in columns]
+
+    temp_file = "{}.{}.tmp.npy".format(matrix_file, os.getpid())
+    matrix = np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype, shape=(len(df), len(names)))
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size][names]
+        matrix[start:start + len(chunk)] = chunk.astype('float64').to_numpy(dtype=dtype)
+    matrix.flush()
+    del matrix
+    os.replace(temp_file, matrix_file)
+
+    with open(columns_file, 'w') as fp:
+        json.dump({'file': os.path.basename(matrix_file), 'dtype': dtype, 'shape': [len(df), len(names)],
+                   'columns': columns}, fp, indent=1)
+    helper.info("Wrote feature matrix", matrix_file, "of", len(df), "rows and", len(names), "columns")
+    helper.event('output', file=matrix_file, rows=len(df), columns=len(names))
+    return [matrix_file, columns_file]
@@ -0,0 +1,288 @@
+# local modules
+import helper
+
+# other libraries
+import ast
+import re
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+#########################
+#
+# FILTER EXPRESSIONS
+#
+# A filter is a python style boolean expression over dictionary column names and join-group names, e.g.
+#
+#   ClinicalSignificance in ('Pathogenic','Likely pathogenic') and ReviewStatus != 'no assertion criteria provided'
+#
+# Names that are not valid identifiers (spaces, hyphens, #) are quoted with backticks, e.g. `GENE SYMBOL` == 'MYH7'
+# or `variation-id` in (8602, 5760). A join-group name matches every column of the source in that join-group, and a
+# comparison is true when any of those columns match. The expression is parsed and validated once and evaluated
+# as vectorized boolean masks on each chunk while a source is read. A filter only applies to a source in which
+# every name it references can be resolved.
+#
+#########################
+
+COMPARISONS = {
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+}
+
+FUNCTIONS = {
+    'contains': lambda s, text: s.astype(str).str.contains(str(text), regex=False),
+    'startswith': lambda s, text: s.astype(str).str.startswith(str(text)),
+    'isna': lambda s: s.isna(),
+    'notna': lambda s: s.notna(),
+}
+
+
+class Unresolved(Exception):
+    pass
+
+
+# the source column(s) a name resolved to, as opposed to a list of constant values
+class Columns(list):
+    pass
+
+
+class Filter:
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.quoted = {}
+
+        # swap backtick quoted names for placeholder identifiers before parsing
+        def quote(match):
+            placeholder = '_q{}_'.format(len(self.quoted))
+            self.quoted[placeholder] = match.group(1)
+            return placeholder
+        try:
+            self.tree = ast.parse(re.sub(r'`([^`]*)`', quote, expression).strip(), mode='eval')
+        except SyntaxError as exc:
+            raise ValueError("Invalid filter expression: {} ({})".format(expression, exc.msg))
+        validate(self.tree.body)
+        helper.debug("Compiled filter", expression, "referencing", self.names())
+
+    def __repr__(self):
+        return self.expression
+
+    def name(self, node):
+        return self.quoted.get(node.id, node.id)
+
+    # the column and join-group names referenced, not the names of the functions called
+    def names(self):
+        functions = set(id(n.func) for n in ast.walk(self.tree) if isinstance(n, ast.Call))
+        return sorted(set(self.name(n) for n in ast.walk(self.tree)
+                          if isinstance(n, ast.Name) and id(n) not in functions))
+
+    # list of the source columns a name refers to; a column name takes precedence over a join-group name
+    def columns(self, name, df, dic):
+        if name in df.columns:
+            return [name]
+        if dic is not None and 'join-group' in dic:
+            cols = [c for c in dic.loc[dic['join-group'] == name, 'column'] if c in df.columns]
+            if len(cols) > 0:
+                return cols
+        raise Unresolved(name)
+
+    def applies(self, df, dic):
+        try:
+            for name in self.names():
+                self.columns(name, df, dic)
+        except Unresolved:
+            return False
+        return True
+
+    # join-group of a name, either the name itself or the join-group of the dictionary column
+    @staticmethod
+    def join_group(name, dic):
+        if dic is None:
+            return None
+        if name in set(dic['join-group'].dropna()):
+            return name
+        groups = dic.loc[dic['column'] == name, 'join-group'].dropna()
+        return groups.iloc[0] if len(groups) > 0 else None
+
+    # key values for a join-group that every matching row must have, or None if the expression does not constrain it
+    def keys(self, join_group, dic):
+        values = None
+        for node in conjuncts(self.tree.body):
+            if not (isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.left, ast.Name)):
+                continue
+            if self.join_group(self.name(node.left), dic) != join_group:
+                continue
+            if isinstance(node.ops[0], ast.Eq) and isinstance(node.comparators[0], ast.Constant):
+                node_values = {node.comparators[0].value}
+            elif isinstance(node.ops[0], ast.In) and isinstance(node.comparators[0], (ast.Tuple, ast.List, ast.Set)):
+                node_values = set(constant(node.comparators[0]))
+            else:
+                continue
+            values = node_values if values is None else values & node_values
+        return values
+
+    # boolean mask for the rows of df matching the expression, or None if the filter does not apply to df
+    def mask(self, df, dic=None):
+        if not self.applies(df, dic):
+            return None
+
+        # evaluate any key constraints first and only evaluate the full expression on matching rows
+        key_nodes = [n for n in conjuncts(self.tree.body)
+                     if isinstance(n, ast.Compare) and isinstance(n.left, ast.Name)
+                     and self.join_group(self.name(n.left), dic) is not None]
+        mask = pd.Series(True, index=df.index)
+        for node in key_nodes:
+            mask &= as_mask(self.evaluate(node, df, dic), df)
+        if len(key_nodes) > 0 and not mask.all():
+            values = mask.to_numpy(copy=True)
+            if values.any():
+                subset = df.loc[values]
+                values[values] = as_mask(self.evaluate(self.tree.body, subset, dic), subset).to_numpy()
+            return pd.Series(values, index=df.index)
+        return as_mask(self.evaluate(self.tree.body, df, dic), df)
+
+    def evaluate(self, node, df, dic):
+        if isinstance(node, ast.BoolOp):
+            masks = [as_mask(self.evaluate(v, df, dic), df) for v in node.values]
+            result = masks[0]
+            for m in masks[1:]:
+                result = (result & m) if isinstance(node.op, ast.And) else (result | m)
+            return result
+        if isinstance(node, ast.UnaryOp):
+            return ~as_mask(self.evaluate(node.operand, df, dic), df)
+        if isinstance(node, ast.Compare):
+            result = None
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                m = self.compare(left, op, right, df, dic)
+                result = m if result is None else result & m
+                left = right
+            return result
+        if isinstance(node, ast.Call):
+            args = [self.evaluate(a, df, dic) for a in node.args]
+            return any_column(args[0], lambda s: FUNCTIONS[node.func.id](s, *args[1:]), df)
+        if isinstance(node, ast.Name):
+            return Columns(df[c] for c in self.columns(self.name(node), df, dic))
+        return constant(node)
+
+    def compare(self, left, op, right, df, dic):
+        a = self.evaluate(left, df, dic)
+        b = self.evaluate(right, df, dic)
+        if isinstance(op, (ast.In, ast.NotIn)):
+            m = any_column(a, lambda s: s.isin(coerce(b, s)), df)
+            return ~m if isinstance(op, ast.NotIn) else m
+        if isinstance(a, Columns) and isinstance(b, Columns):
+            return any_column(a, lambda s: any_column(b, lambda t: COMPARISONS[type(op)](s, t), df), df)
+        if isinstance(b, Columns):
+            # constant on the left, flip the comparison around the column
+            return any_column(b, lambda s: COMPARISONS[type(op)](coerce(a, s), s), df)
+        return any_column(a, lambda s: COMPARISONS[type(op)](s, coerce(b, s)), df)
+
+
+# check the expression only uses supported syntax
+def validate(node):
+    if isinstance(node, ast.BoolOp) or isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, (ast.boolop, ast.unaryop)):
+                validate(child)
+    elif isinstance(node, ast.Compare):
+        for op, right in zip(node.ops, node.comparators):
+            if type(op) not in COMPARISONS and not isinstance(op, (ast.In, ast.NotIn)):
+                raise ValueError("Unsupported comparison in filter: {}".format(type(op).__name__))
+            if isinstance(op, (ast.In, ast.NotIn)) and isinstance(right, ast.Name):
+                raise ValueError("Expected a list of values after 'in': {}".format(ast.unparse(node)))
+        for operand in [node.left] + node.comparators:
+            if not isinstance(operand, ast.Name):
+                constant(operand)
+    elif isinstance(node, ast.Call):
+        if not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and len(node.args) > 0
+                and isinstance(node.args[0], ast.Name)):
+            raise ValueError("Unsupported function in filter: {} (supported: {})"
+                             .format(ast.unparse(node.func), ', '.join(FUNCTIONS)))
+    else:
+        raise ValueError("Unsupported filter expression: {}".format(ast.unparse(node)))
+
+
+def conjuncts(node):
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        return [c for v in node.values for c in conjuncts(v)]
+    return [node]
+
+
+def constant(node):
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return [constant(e) for e in node.elts]
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+        return -node.operand.value
+    raise ValueError("Expected a constant value in filter: {}".format(ast.unparse(node)))
+
+
+# convert constant(s) to match the column type, e.g. '8602' for a numeric VariationID column
+def coerce(value, series):
+    if isinstance(value, list):
+        return [coerce(v, series) for v in value]
+    if is_numeric_dtype(series.dtype) and isinstance(value, str):
+        try:
+            return pd.to_numeric(value)
+        except ValueError:
+            return value
+    return value
+
+
+# a name can resolve to several columns of the same join-group, in which case any matching column is a match
+def any_column(columns, fn, df):
+    if not isinstance(columns, Columns):
+        return fn(columns)
+    result = pd.Series(False, index=df.index)
+    for s in columns:
+        result |= as_mask(fn(s), df)
+    return result
+
+
+def as_mask(value, df):
+    if isinstance(value, Columns):
+        value = any_column(value, lambda s: s.astype(bool), df)
+    if not isinstance(value, pd.Series):
+        return pd.Series(bool(value), index=df.index)
+    return value.fillna(False).astype(bool)
+
+
+# filter expression matching any of the given values for a join-group (used for --gene and --variant)
+def join_group_filter(join_group, values):
+    return Filter("`{}` in [{}]".format(join_group, ', '.join(repr(v) for v in values)))
+
+
+# a choice of filters, of which the first one that applies to a source is used (e.g. the variants of a gene for
+# sources without a gene-symbol column)
+class FirstApplicable:
+
+    def __init__(self, choices):
+        self.choices = choices
+
+    def __repr__(self):
+        return ' | '.join(repr(f) for f in self.choices)
+
+    def choice(self, df, dic):
+        for f in self.choices:
+            if f.applies(df, dic):
+                return f
+        return None
+
+    def applies(self, df, dic):
+        return self.choice(df, dic) is not None
+
+    def keys(self, join_group, dic):
+        for f in self.choices:
+            values = f.keys(join_group, dic)
+            if values is not None:
+                return values
+        return None
+
+    def mask(self, df, dic=None):
+        f = self.choice(df, dic)
+        return None if f is None else f.mask(df, dic)
@@ -1,5 +1,6 @@
 # local modules
 import helper
+import source
 
 # other libraries
 import os
@@ -52,13 +53,12 @@ def config(sources_path):
         print("All data sources have a config.yml")
     else:
         helper.info("Created", cnt, "config.yml files.")
-        print("NOTICE: Created", cnt, "config.yml files. Please edit the file(s) and re-run.")
-        exit(-1)
+        raise helper.PipelineError("Created {} config.yml files. Please edit the file(s) and re-run.".format(cnt))
 
 def dictionary(srcfile):
     # TODO: analyze column data and set category, onehot, continuous, days, age, based on data types and frequency
     print("Creating dictionary template")
-    data_file = str(os.path.join(srcfile.get('path'), srcfile.get('file')))
+    data_file = source.data_file(srcfile)
     separator_type = helper.get_separator(srcfile.get('delimiter'))
     df_data_loc = pd.read_csv(data_file,
                               header=srcfile.get('header_row'), sep=separator_type,
@@ -69,14 +69,17 @@ def dictionary(srcfile):
     cols = df_data_loc.columns.tolist()
     # create dataframe with appropriate columns
     df_dic = pd.DataFrame(columns=['column', 'comment', 'join-group', 'onehot', 'category',
-                                   'continuous', 'format', 'map', 'days', 'age', 'expand', 'na-value'])
+                                   'continuous', 'format', 'map', 'days', 'age', 'expand', 'na-value', 'hash',
+                                   'separator', 'aggregate'])
     # create one row per column header
     defaults = {'comment': '', 'join-group': '', 'onehot': 'FALSE', 'category': 'FALSE', 'continuous': 'FALSE',
-                'format': '', 'map': 'FALSE', 'days': 'FALSE', 'age': 'FALSE', 'expand': 'FALSE', 'na-value': ''}
+                'format': '', 'map': 'FALSE', 'days': 'FALSE', 'age': 'FALSE', 'expand': 'FALSE', 'na-value': '',
+                'hash': 'FALSE', 'separator': '', 'aggregate': 'FALSE'}
     for field in cols:
         df_dic.loc[len(df_dic)] = [field, defaults['comment'], defaults['join-group'], defaults['onehot'],
                                    defaults['category'], defaults['continuous'], defaults['format'], defaults['map'],
-                                   defaults['days'], defaults['age'], defaults['expand']]
+                                   defaults['days'], defaults['age'], defaults['expand'], defaults['na-value'],
+                                   defaults['hash'], defaults['separator'], defaults['aggregate']]
     # save dataframe as csv
     dictionary_template = str(os.path.join(srcfile.get('path'),'dictionary.csv'))
     df_dic.to_csv(dictionary_template, index=False)
@@ -98,7 +101,6 @@ def mapping(mapping_file, data, sourcefile, dic):
             print()
             print("unique values and counts for", sourcefile['path'], sourcefile['file'], r['column'])
             value_counts_df = df[r['column']].value_counts().rename_axis('value').reset_index(name='count')
-            helper.debug(df)
             helper.debug(value_counts_df)
             print(value_counts_df)
 
@@ -0,0 +1,68 @@
+# local modules
+import keygraph
+
+# other libraries
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# HASH ENCODING
+#
+# With --hash, each column configured with hash in the dictionary is encoded into a fixed number of --hash-buckets: the
+# value of a row, or each value of the list of values of a column configured with a separator (',' for a column
+# configured to expand), is hashed with the stable hash of pandas.util.hash_array (the same for the same text on every
+# run and machine) into a bucket. The
+# dense format adds one column per bucket '<prefix>_<column>_<bucket>' with the number of values of the row in the
+# bucket; the sparse format adds one column '<prefix>_<column>' with the buckets of the row separated by '|'. The number
+# of columns is the same whatever the number of distinct values, and no pass over the values is needed first.
+#
+#########################
+
+EXPAND_SEPARATOR = ','
+BUCKET_SEPARATOR = '|'
+
+
+# bucket of each value, by the stable hash of its text
+def buckets(values, bucket_count):
+    return pd.util.hash_array(np.asarray(values, dtype=object), categorize=False) % np.uint64(bucket_count)
+
+
+# row positions and buckets of the values of each row, splitting lists of values on separator, if any; whole numbers
+# read as floats are hashed as integers (8602.0 as 8602)
+def row_buckets(series, bucket_count, separator=None):
+    values = series.dropna().map(keygraph.key)
+    values = pd.Series(values.to_numpy(dtype=object), index=np.flatnonzero(series.notna().to_numpy()))
+    if separator:
+        values = values.str.split(separator, regex=False).explode().str.strip()
+    values = values[values.notna() & (values != '')]
+    return values.index.to_numpy(dtype=np.int64), buckets(values.to_numpy(dtype=object), bucket_count).astype(np.int64)
+
+
+def encode_chunk(series, name, bucket_count, sparse, separator=None):
+    rows, row_bucket = row_buckets(series, bucket_count, separator)
+    if sparse:
+        pairs = pd.DataFrame({'row': rows, 'bucket': row_bucket}).drop_duplicates().sort_values(['row', 'bucket'])
+        text = pairs['bucket'].astype(str).groupby(pairs['row']).agg(BUCKET_SEPARATOR.join)
+        column = pd.Series(text.reindex(range(len(series))).to_numpy(), index=series.index, dtype=object)
+        return pd.DataFrame({name: column})
+    counts = np.zeros((len(series), bucket_count), dtype=np.int16)
+    np.add.at(counts, (rows, row_bucket), 1)
+    return pd.DataFrame(counts, index=series.index, columns=["{}_{}".format(name, b) for b in range(bucket_count)])
+
+
+# the hash encoded columns of a column named name, a chunk of rows at a time
+def encode(series, name, bucket_count, sparse, chunksize, separator=None):
+    chunks = [encode_chunk(series.iloc[start:start + chunksize], name, bucket_count, sparse, separator)
+              for start in range(0, len(series), chunksize)]
+    if len(chunks) == 0:
+        return encode_chunk(series, name, bucket_count, sparse, separator)
+    return pd.concat(chunks)
+
+
+# the separator of the lists of values of a column with the dictionary row r: its separator, or ',' for a column
+# configured to expand
+def separator(r):
+    if not pd.isna(r.get('separator')) and r.get('separator') != '':
+        return r.get('separator')
+    return EXPAND_SEPARATOR if r.get('expand') is True else None
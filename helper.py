@@ -1,12 +1,18 @@
+import atexit
 import gzip
 import hashlib
+import json
 import shutil
 from datetime import datetime, timezone
 import dateparser
 import pytz
 import requests
 import logging
+import os
 import sys
+import threading
+import time
+import pandas as pd
 from genshi.template import NewTextTemplate
 
 ####################
@@ -16,7 +22,7 @@ from genshi.template import NewTextTemplate
 ####################
 
 
-def log_setup(loglevel):
+def log_setup(loglevel, event_log_file=None):
     numeric_level = getattr(logging, loglevel.upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
@@ -28,25 +34,89 @@ def log_setup(loglevel):
         handlers=[logging.FileHandler("python.log"), logging.StreamHandler(sys.stdout)],
     )
 
+    global event_log
+    if event_log_file is not None:
+        close_event_log()
+        event_log = open(event_log_file, 'a', encoding='utf-8')
+
+
+# Log the arguments as one message, only converting them to text if the log level is enabled
+def log(log_type, arguments, sep):
+    if logging.getLogger().isEnabledFor(logging.getLevelName(log_type.upper())):
+        getattr(logging, log_type)(sep.join(str(a) for a in arguments))
+
 
 def debug(*arguments, log_type='debug', sep=' '):
-    getattr(logging, log_type)(sep.join(str(a) for a in arguments))
+    log(log_type, arguments, sep)
 
 
 def info(*arguments, log_type='info', sep=' '):
-    getattr(logging, log_type)(sep.join(str(a) for a in arguments))
+    log(log_type, arguments, sep)
 
 
 def warning(*arguments, log_type='warning', sep=' '):
-    getattr(logging, log_type)(sep.join(str(a) for a in arguments))
+    log(log_type, arguments, sep)
 
 
 def error(*arguments, log_type='error', sep=' '):
-    getattr(logging, log_type)(sep.join(str(a) for a in arguments))
+    log(log_type, arguments, sep)
 
 
 def critical(*arguments, log_type='critical', sep=' '):
-    getattr(logging, log_type)(sep.join(str(a) for a in arguments))
+    log(log_type, arguments, sep)
+
+
+# an error that stops the pipeline, raised to the program or notebook running it instead of exiting
+class PipelineError(Exception):
+    pass
+
+
+####################
+#
+# Event log
+#
+# With --event-log, one JSON object per line for each stage of a run (reading, encoding and templating each source,
+# merging, writing outputs) with the rows and columns it produced and the seconds since the previous event, in place
+# of logging whole dataframes.
+#
+####################
+
+event_log = None
+run_id = "{}-{}".format(datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S'), os.getpid())
+last_event = time.perf_counter()
+event_lock = threading.Lock()
+
+
+def event(stage, **fields):
+    global last_event
+    # events of the output writer threads are written whole, one at a time
+    with event_lock:
+        if event_log is None:
+            return
+        now = time.perf_counter()
+        record = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'run': run_id,
+                  'stage': stage, 'seconds': round(now - last_event, 3)}
+        record.update(fields)
+        event_log.write(json.dumps(record, default=str) + "\n")
+        event_log.flush()
+        last_event = now
+
+
+# close the event log on exit, or before opening another
+def close_event_log():
+    global event_log
+    with event_lock:
+        if event_log is not None:
+            event_log.close()
+            event_log = None
+
+
+atexit.register(close_event_log)
+
+
+# rows and columns of a dataframe as event fields
+def shape(df):
+    return {'rows': len(df), 'columns': len(df.columns)}
 
 
 def str_to_datetime(date_str, date_format):
@@ -126,11 +196,82 @@ def get_separator(delimiter):
         return None
 
 
-def download(download_url, filepath):
+# Create one additional row per value for rows with a comma separated list of values in the column
+def expand_rows(df, column):
+    expandable_rows_df = df.loc[df[column].astype(str).str.contains(",")]
+    expanded_df = expandable_rows_df.assign(**{column: expandable_rows_df[column].astype(str).str.split(",")})
+    expanded_df = expanded_df.explode(column, ignore_index=True)
+    # keep the column type of compact text and categorical columns
+    if isinstance(df[column].dtype, pd.CategoricalDtype):
+        expanded_df[column] = expanded_df[column].astype('category')
+    elif df[column].dtype != object:
+        expanded_df[column] = expanded_df[column].astype(df[column].dtype)
+    return expanded_df
+
+
+AGGREGATE_SEPARATOR = '|'
+
+
+# Collapse the rows of df to one row per value of the column: the count of rows, whether any row is True for boolean
+# (one-hot) columns, and the distinct values of each other column in order, separated by AGGREGATE_SEPARATOR
+def collapse_rows(df, column, count_column):
+    groups = df.groupby(column, sort=False)
+    collapsed = groups.size().rename(count_column).to_frame()
+    for c in df.columns:
+        if c == column or c == count_column:
+            continue
+        if pd.api.types.is_bool_dtype(df[c].dtype):
+            collapsed[c] = groups[c].any()
+            continue
+        values = df[[column, c]].dropna().drop_duplicates()
+        values[c] = values[c].astype(str)
+        collapsed[c] = values.groupby(column, sort=False)[c].agg(AGGREGATE_SEPARATOR.join)
+    return collapsed.reset_index()[[c for c in df.columns if c != count_column] + [count_column]]
+
+
+# Map each value of the series through the mapping dictionary of text values, looking up each category only once
+def map_values(series, mapping):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        lookup = pd.Series(series.cat.categories.astype(str)).map(mapping).to_numpy()
+        codes = series.cat.codes.to_numpy()
+        mapped = pd.Series(lookup[codes], index=series.index)
+        return mapped.where(codes >= 0, mapping.get('nan'))
+    return series.astype(str).map(mapping)
+
+
+# Fill missing values without changing the type of categorical, text or nullable columns
+def fill_na(df, value, columns=None):
+    for column in df.columns if columns is None else columns:
+        series = df[column]
+        if not series.hasnans:
+            continue
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            if value not in series.cat.categories:
+                series = series.cat.add_categories([value])
+            df[column] = series.fillna(value)
+        elif isinstance(series.dtype, pd.StringDtype):
+            df[column] = series.fillna(str(value))
+        elif isinstance(series.dtype, pd.BooleanDtype):
+            df[column] = series.astype('Int8').fillna(value)
+        else:
+            df[column] = series.fillna(value)
+    return df
+
+
+# Stream the url to a file, calling progress(bytes written, total bytes or None) as it is written
+def download(download_url, filepath, session=None, timeout=None, progress=None):
     info("Downloading", download_url, "as", filepath)
-    response = requests.get(download_url)
-    response.raise_for_status()
-    open(filepath, 'wb').write(response.content)
+    with (session or requests).get(download_url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        total = response.headers.get('Content-Length')
+        total = int(total) if total is not None and total.isdigit() else None
+        size = 0
+        with open(filepath, 'wb') as fp:
+            for block in response.iter_content(chunk_size=1024 * 1024):
+                fp.write(block)
+                size += len(block)
+                if progress is not None:
+                    progress(size, total)
     info("Completed download of", filepath)
     return response
 
@@ -145,6 +286,12 @@ def get_md5(filename_with_path):
     return file_hash.hexdigest()
 
 
+# Identify a version of a data file by its size and modification time, without reading the whole file
+def file_signature(file_path):
+    stat = os.stat(file_path)
+    return "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+
+
 def gunzip_file(from_file_path, to_file_path):
     debug("Unzipping", from_file_path, "to", to_file_path)
     with gzip.open(from_file_path, 'rb') as f_in:
@@ -0,0 +1,187 @@
+# local modules
+import helper
+import source
+
+# other libraries
+import json
+import os
+import re
+from os.path import isfile
+import filelock
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# CROSS-SOURCE KEY GRAPH
+#
+# Links between join-group key values found in the same row of any source, e.g. a ClinVar VariationID and its
+# gene symbol, or a gene symbol and its HGNC id. Stored both ways: for each pair of linked join-groups, the values of
+# the first in sorted order with the linked values of the second, so the keys related to a --variant, --gene or
+# --region are found by binary search before any source is loaded.
+#
+# The graph is built once from every source with a downloaded data file and saved in the sources directory as numpy
+# arrays, written under a temporary name and renamed by one run holding a lock while the others wait for it. It is
+# rebuilt when a data file changes or a source is added or removed.
+#
+#########################
+
+GRAPH_FILE = 'key-graph.npz'
+LOCK_FILE = 'key-graph.lock'
+LIST_SEPARATORS = r'[,;|]'
+# separates the join-groups of a link in the names of the arrays
+LINK_SEPARATOR = '>'
+
+
+class KeyGraph:
+
+    # links is {(group_a, group_b): (values of group_a sorted, the linked values of group_b)}
+    def __init__(self, signatures, links=None):
+        self.signatures = signatures
+        self.links = links or {}
+        self.added = {}
+
+    # add the links of the values in the same rows, to be sorted by finish
+    def add(self, group_a, values_a, group_b, values_b):
+        pairs = pd.DataFrame({'a': list(values_a), 'b': list(values_b)})
+        pairs = pairs.assign(a=pairs['a'].map(split), b=pairs['b'].map(split)).explode('a').explode('b').dropna()
+        pairs = pairs.drop_duplicates()
+        self.added.setdefault((group_a, group_b), []).append(pairs[['a', 'b']].set_axis(['from', 'to'], axis=1))
+        self.added.setdefault((group_b, group_a), []).append(pairs[['b', 'a']].set_axis(['from', 'to'], axis=1))
+
+    def finish(self):
+        for link, frames in self.added.items():
+            linked = pd.concat(frames).drop_duplicates().sort_values(['from', 'to'])
+            self.links[link] = (linked['from'].to_numpy(dtype=str), linked['to'].to_numpy(dtype=str))
+        self.added = {}
+        return self
+
+    def groups(self):
+        return set(g for link in self.links for g in link)
+
+    # whether keys of the two join-groups were found together in any source
+    def linked(self, group_a, group_b):
+        return (group_a, group_b) in self.links
+
+    # values in target_group linked directly to any of the values in group
+    def lookup(self, group, values, target_group):
+        if (group, target_group) not in self.links:
+            return set()
+        from_values, to_values = self.links[(group, target_group)]
+        values = np.array(sorted(set(key(v) for v in values)), dtype=str)
+        first = np.searchsorted(from_values, values, side='left')
+        last = np.searchsorted(from_values, values, side='right')
+        return set(v for lo, hi in zip(first, last) for v in to_values[lo:hi].tolist())
+
+    # values of every other join-group reachable from the values, without passing back through a visited group
+    # (so a variant resolves to its genes and their HGNC ids, but not to every other variant of those genes)
+    def resolve(self, group, values):
+        resolved = {group: set(key(v) for v in values)}
+        frontier = [group]
+        while len(frontier) > 0:
+            next_frontier = []
+            for g in frontier:
+                for target in self.groups() - set(resolved):
+                    if not self.linked(g, target):
+                        continue
+                    related = self.lookup(g, resolved[g], target)
+                    if len(related) > 0:
+                        resolved[target] = related
+                        next_frontier.append(target)
+            frontier = next_frontier
+        return resolved
+
+    def arrays(self):
+        arrays = {'signatures': np.array([json.dumps(self.signatures, sort_keys=True)])}
+        for (group_a, group_b), (values_a, values_b) in self.links.items():
+            name = group_a + LINK_SEPARATOR + group_b
+            arrays[name + ':from'] = values_a
+            arrays[name + ':to'] = values_b
+        return arrays
+
+
+def from_arrays(arrays):
+    links = {}
+    for name in arrays:
+        if name.endswith(':from'):
+            group_a, group_b = name[:-len(':from')].split(LINK_SEPARATOR)
+            links[(group_a, group_b)] = (arrays[name], arrays[name[:-len(':from')] + ':to'])
+    return KeyGraph(json.loads(str(arrays['signatures'][0])), links)
+
+
+# key values are stored as strings so an integer VariationID matches in any source
+def key(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def split(value):
+    if pd.isna(value):
+        return []
+    return [v for v in (key(part) for part in re.split(LIST_SEPARATORS, key(value))) if len(v) > 0 and v != '-']
+
+
+def data_signatures(source_files_df):
+    signatures = {}
+    for i, sourcefile in source_files_df.iterrows():
+        data_file = source.data_file(sourcefile)
+        if isfile(data_file):
+            signatures[sourcefile.get('name')] = helper.file_signature(data_file)
+    return signatures
+
+
+def build(source_files_df, signatures, chunksize):
+    graph = KeyGraph(signatures)
+    for i, sourcefile in source_files_df.iterrows():
+        if sourcefile.get('name') not in signatures:
+            continue
+        dic = pd.read_csv(os.path.join(sourcefile.get('path'), sourcefile.get('dictionary')))
+        join_columns = dic.loc[dic['join-group'].notnull(), ['column', 'join-group']].values.tolist()
+        if len(set(g for c, g in join_columns)) < 2:
+            helper.debug("No linked join-groups in", sourcefile.get('name'))
+            continue
+        helper.info("Adding join-group keys from", sourcefile.get('name'), "to key graph")
+        columns = [c for c, g in join_columns]
+        for chunk in source.read(sourcefile, chunksize, columns=columns):
+            for a in range(len(join_columns)):
+                for b in range(a + 1, len(join_columns)):
+                    (column_a, group_a), (column_b, group_b) = join_columns[a], join_columns[b]
+                    if group_a != group_b and column_a in chunk and column_b in chunk:
+                        pairs = chunk[[column_a, column_b]].drop_duplicates()
+                        graph.add(group_a, pairs[column_a], group_b, pairs[column_b])
+    return graph.finish()
+
+
+# the saved key graph, if built from the current data files
+def saved(graph_file, signatures):
+    if not isfile(graph_file):
+        return None
+    with np.load(graph_file) as arrays:
+        graph = from_arrays(dict(arrays))
+    if graph.signatures != signatures:
+        helper.info("Key graph", graph_file, "is out of date")
+        return None
+    helper.debug("Using key graph", graph_file)
+    return graph
+
+
+# load the key graph for all configured sources, building it first if missing or out of date
+def load(sources_path, chunksize):
+    graph_file = os.path.join(sources_path, GRAPH_FILE)
+    source_files_df = pd.DataFrame([source.get(sources_path, name) for name in source.names(sources_path)])
+    signatures = data_signatures(source_files_df)
+    graph = saved(graph_file, signatures)
+    if graph is not None:
+        return graph
+    with filelock.FileLock(os.path.join(sources_path, LOCK_FILE)):
+        graph = saved(graph_file, signatures)
+        if graph is not None:
+            return graph
+        graph = build(source_files_df, signatures, chunksize)
+        temp_path = "{}.{}.tmp".format(graph_file, os.getpid())
+        with open(temp_path, 'wb') as fp:
+            np.savez(fp, **graph.arrays())
+        os.replace(temp_path, graph_file)
+    helper.info("Saved key graph", graph_file)
+    return graph
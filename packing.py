@@ -0,0 +1,155 @@
+# local modules
+import helper
+import keygraph
+
+# other libraries
+import json
+import re
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# PACKED TEMPLATE OUTPUT
+#
+# Packs the rendered template text of each row into documents sized for an LLM context window. Rows are grouped by the
+# key of the highest precedence join-group with a value in the row (variation-id, then gene-symbol, then hgnc-id), so
+# the records of a variant or a gene stay together, and ordered by the order of the sources. The record of a gene (or
+# other key) found with variants in the rows of the sources goes with the records of each of those variants, so e.g.
+# the gene-disease validity of a gene is packed with the variants of the gene. The records are streamed a key at a
+# time from the rows of the sources, in the order each key first appears. The records of a key are added to a chunk
+# until the next record would take it over the budget, then a new chunk of the same key is started, so a chunk never
+# holds records of two keys and a record is never split; a record over the budget on its own is a chunk by itself.
+#
+# Each chunk is written as one JSON line with its key, its part number, the sources and number of records, the
+# index of its first and last record among the records of the key, and its size in characters and approximate
+# tokens. Tokens are counted with a fast approximation of a subword tokenizer: one token per word or punctuation
+# mark, plus one for every further few characters of long words.
+#
+#########################
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+CHARACTERS_PER_TOKEN = 6
+RECORD_SEPARATOR = "\n\n"
+VARIANT_GROUP = 'variation-id'
+
+
+def count_tokens(text):
+    return sum(1 + (len(t) - 1) // CHARACTERS_PER_TOKEN for t in TOKEN_PATTERN.findall(text))
+
+
+def size(text, unit):
+    return len(text) if unit == 'chars' else count_tokens(text)
+
+
+# the join-groups and columns of a source used to group its records, in join-group precedence
+def group_columns(dictionary, name, columns):
+    dic = dictionary.loc[(dictionary['name'] == name) & dictionary['join-group'].notnull()]
+    dic = dic.loc[dic['column'].isin(columns)]
+    dic = dic.assign(precedence=dic['join-group'].map(helper.get_join_precedence)).sort_values('precedence',
+                                                                                                 kind='stable')
+    return list(zip(dic['join-group'], dic['column']))
+
+
+def group_key(join_group, value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return "{}:{}".format(join_group, value)
+
+
+# the variation-id keys found in the same rows of the sources as each key of another join-group, e.g. the variants of
+# a gene symbol, in order of first appearance
+def variant_keys(data, dictionary, source_order):
+    variants = {}
+    for name in source_order:
+        columns = dict(reversed(group_columns(dictionary, name, data[name].columns)))
+        if VARIANT_GROUP not in columns:
+            continue
+        for join_group, column in columns.items():
+            if join_group == VARIANT_GROUP:
+                continue
+            pairs = data[name][[columns[VARIANT_GROUP], column]].dropna().drop_duplicates()
+            for variant, value in zip(pairs[columns[VARIANT_GROUP]], pairs[column]):
+                for v in keygraph.split(value):
+                    variants.setdefault(group_key(join_group, v), {})[group_key(VARIANT_GROUP, variant)] = None
+    return variants
+
+
+# the keys of each record of a source: the key of the highest precedence join-group with a value in the row, resolved
+# to the variants found with it in the sources if it is not a variant
+def record_keys(df, name, dictionary, variants):
+    keys = np.full(len(df), None, dtype=object)
+    for join_group, column in group_columns(dictionary, name, df.columns):
+        values = df[column].to_numpy(dtype=object)
+        missing = pd.isna(keys) & pd.notna(values)
+        keys[missing] = [group_key(join_group, v) for v in values[missing]]
+    if pd.isna(keys).any():
+        helper.warning("No join-group value to group", int(pd.isna(keys).sum()), name,
+                       "template records; packed under its source name")
+        keys[pd.isna(keys)] = "source:" + name
+    return pd.Series([list(variants.get(k, [k])) for k in keys], dtype=object).explode()
+
+
+# (key, records) of the rendered templates of each key, with the records of a key as (source, text) in the order of
+# the sources, and the keys in order of first appearance; the text of the records of one key is read at a time
+def records(data, dictionary, source_order):
+    variants = variant_keys(data, dictionary, source_order)
+    names, texts, keys, sources, positions = [], [], [], [], []
+    for name in source_order:
+        template_column_name = "{}-template".format(name)
+        if template_column_name not in data[name]:
+            continue
+        source_keys = record_keys(data[name], name, dictionary, variants)
+        keys.append(source_keys.to_numpy(dtype=object))
+        sources.append(np.full(len(source_keys), len(names)))
+        positions.append(source_keys.index.to_numpy())
+        names.append(name)
+        texts.append(data[name][template_column_name].to_numpy(dtype=object))
+    if len(names) == 0:
+        return
+    codes, uniques = pd.factorize(np.concatenate(keys))
+    order = np.argsort(codes, kind='stable')
+    sources, positions = np.concatenate(sources)[order], np.concatenate(positions)[order]
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    for code, (first, last) in enumerate(zip(np.r_[0, bounds], np.r_[bounds, len(order)])):
+        yield uniques[code], [(names[s], texts[s][p]) for s, p in zip(sources[first:last], positions[first:last])]
+
+
+# chunks of (first record, last record) indexes of the records of one key within the budget
+def pack(texts, budget, unit):
+    chunks = []
+    first = 0
+    used = 0
+    separator = size(RECORD_SEPARATOR, unit)
+    for i, text in enumerate(texts):
+        text_size = size(text, unit)
+        if i > first and used + separator + text_size > budget:
+            chunks.append((first, i - 1))
+            first, used = i, 0
+        used = text_size if i == first else used + separator + text_size
+    if len(texts) > 0:
+        chunks.append((first, len(texts) - 1))
+    return chunks
+
+
+def write(file_path, data, dictionary, source_order, budget, unit):
+    chunk_count = 0
+    record_count = 0
+    key_count = 0
+    with open(file_path, "w") as file:
+        for key, key_records in records(data, dictionary, source_order):
+            record_count += len(key_records)
+            key_count += 1
+            texts = [text for name, text in key_records]
+            chunks = pack(texts, budget, unit)
+            for part, (first, last) in enumerate(chunks):
+                text = RECORD_SEPARATOR.join(texts[first:last + 1])
+                sources = list(dict.fromkeys(name for name, t in key_records[first:last + 1]))
+                file.write(json.dumps({'chunk': chunk_count, 'key': key, 'part': part + 1, 'parts': len(chunks),
+                                       'sources': sources, 'records': last - first + 1, 'first_record': first,
+                                       'last_record': last, 'chars': len(text), 'tokens': count_tokens(text),
+                                       'text': text}))
+                file.write("\n")
+                chunk_count += 1
+    helper.info("Packed", record_count, "template records for", key_count, "keys into",
+                chunk_count, "chunks of at most", budget, unit, "in", file_path)
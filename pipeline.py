@@ -0,0 +1,990 @@
+# local modules
+from textwrap import TextWrapper
+
+import arguments
+import helper
+import download
+import source
+import generate
+import filters
+import region
+import keygraph
+import store
+import cache
+import textstore
+import packing
+import planner
+import external
+import features
+import scaling
+import hashing
+import sampling
+import aggregates
+import database
+import templates
+import sharding
+import writer
+import numpy as np
+
+# other libraries
+import os
+from os import access, R_OK
+from os.path import isfile
+
+import pandas as pd
+
+pd.options.mode.copy_on_write = True  # will become default in Pandas 3
+
+#########################
+#
+# PIPELINE
+#
+# The stages of main.py as a library: a Pipeline holds the options of a run (the command line options, given as an
+# argparse namespace or keyword options) and the configuration of its sources, and runs each stage as a method:
+# download, filter, load, encode, template, join and write. Errors raise helper.PipelineError (or ValueError for
+# invalid options) instead of exiting.
+#
+# A pipeline kept between queries in one process (e.g. a notebook or a service) keeps the chunks parsed from each
+# data file, so a query with other --gene, --variant, --region or --filter values only filters them again, and keeps
+# the encoded and templated rows of each source for each query, so repeating a query skips the encode and template
+# stages. main.py runs one query and does not keep the parsed chunks (keep_sources=False).
+#
+#   p = pipeline.Pipeline(sources=['clinvar-variant-summary', 'vrs'], onehot=True)
+#   p.download()
+#   joined = p.run(gene='MYH7')
+#   joined = p.run(gene='TP53')
+#
+#########################
+
+ONE_HOT_PREFIX = 'hot'
+CATEGORIES_PREFIX = 'cat'
+ORDINAL_PREFIX = 'ord'
+RANK_PREFIX = 'rnk'
+DAYS_PREFIX = 'days'
+AGE_PREFIX = 'age'
+HASH_PREFIX = 'hsh'
+SOURCES_PATH = os.path.normpath('./sources')
+# the options each stage depends on, with the row filters of the source, to reuse its result for the same query
+LOAD_OPTIONS = ['expand', 'compact', 'shared_store', 'chunk_size', 'sample', 'sample_seed', 'sample_by',
+                'sample_key', 'db', 'aggregate']
+ENCODE_OPTIONS = LOAD_OPTIONS + ['map', 'onehot', 'categories', 'days', 'age', 'scale', 'hash', 'hash_buckets',
+                                 'hash_format', 'na_value', 'columns']
+TEMPLATE_OPTIONS = ENCODE_OPTIONS + ['template']
+# the options of a query given to filter() or run()
+FILTER_OPTIONS = ['gene', 'variant', 'region', 'filter', 'related']
+# number of stage results kept, dropping the oldest
+MAX_RESULTS = 64
+
+
+class Pipeline:
+
+    def __init__(self, args=None, sources_path=SOURCES_PATH, keep_sources=True, **options):
+        self.args = arguments.options(args, **options)
+        self.sources_path = sources_path
+        self.keep_sources = keep_sources
+        # the chunks parsed from each data file, and the result of each stage for each source and query
+        self.parsed = {}
+        self.results = {}
+        self.key_graph = None
+        self.key_filters = []
+        self.row_filters = []
+        self.source_filters = {}
+        self.sharded_sources = set()
+        self.aggregated_sources = set()
+        self.dictionaries = {}
+        self.dictionary = None
+        self.data = {}
+        self.joined = None
+        self.join_plan = None
+        # the seed of the --sample of every source, the same for the sources to sample the same keys
+        self.sample_seed = self.args.sample_seed
+        if self.args.sample is not None and self.sample_seed is None:
+            self.sample_seed = int(np.random.default_rng().integers(2 ** 32))
+            helper.info("Sampling sources with --sample-seed", self.sample_seed)
+        # output files written, and the partial outputs of a shard for the merge
+        self.output_files = []
+        self.shard_files = []
+        # while writing, the writer, the sources written, the last job writing to each text file, and with
+        # --template-dedup the digests of the texts written to each text file
+        self.writer = None
+        self.written = set()
+        self.text_jobs = {}
+        self.text_seen = {}
+        self.configure()
+
+    #########################
+    #
+    # LOAD SOURCE CONFIGURATION
+    #
+    #########################
+
+    def configure(self):
+        args = self.args
+        # generate config.yml template files if not present in source directories
+        generate.config(self.sources_path)
+
+        # find and create a list of all the config.yml files
+        selected_sources = []
+        if args.sources:
+            selected_sources = set(args.sources)
+        source.data_cache = args.data_cache
+        source.load(self.sources_path, selected_sources)
+        helper.debug("config file list:", source.source_list())
+
+        # load all the config files into a source list dataframe
+        source_files_df = source.df()
+        helper.event('config', sources=sorted(source_files_df['name']), **helper.shape(source_files_df))
+
+        # validate sourcefile selections in arguments if any
+        if args.sources is None:
+            sources = list(set(source_files_df['name']))
+        else:
+            sources = list(set(source_files_df['name']) & set(args.sources))
+
+        # any invalid sources?
+        if args.sources:
+            invalid_sources = set(args.sources).difference(sources)
+            if len(invalid_sources) > 0:
+                raise helper.PipelineError("Invalid source file specified in --sources parameter: {}".format(
+                    invalid_sources))
+
+        helper.debug("Using source files: ", sources)
+
+        # restrict source list by command line option, if any
+        if args.sources:
+            source_files_df = source_files_df.loc[source_files_df['name'].isin(sources)]
+
+        helper.debug("Source configurations: ", source_files_df)
+        helper.event('sources', sources=sorted(sources))
+        self.source_files_df = source_files_df
+
+    #########################
+    #
+    # DOWNLOAD DATA FILES
+    #
+    #########################
+
+    def download(self):
+        # download any missing data files (or all if "force" is enabled); with --db the sources are read from the
+        # database instead
+        if self.args.db and not self.args.build_db:
+            helper.info("Reading sources from database", self.args.db)
+        else:
+            download.all_files(self.source_files_df, self.args.force, self.args.download_connections,
+                               self.args.download_retries)
+        helper.event('download')
+
+        #  verify existence of source dictionaries
+        missing_dictionary = 0
+        for index, sourcefile in self.source_files_df.iterrows():
+            dictionary_file = str(os.path.join(sourcefile.get('path'), sourcefile.get('dictionary')))
+            if isfile(dictionary_file) and access(dictionary_file, R_OK):
+                helper.debug("Found dictionary file", dictionary_file)
+            else:
+                missing_dictionary = missing_dictionary + 1
+                generate.dictionary(sourcefile)
+                helper.warning("Created template for missing dictionary file", dictionary_file)
+                print("Created missing dictionary file", dictionary_file,
+                      "; Edit the file to configure field level options.")
+
+        if not missing_dictionary:
+            helper.debug("Verified all dictionaries exist.")
+
+    # load the sources into the --db database
+    def build_database(self):
+        dictionaries = {sourcefile.get('name'): self.source_dictionary(sourcefile)
+                        for index, sourcefile in self.source_files_df.iterrows()}
+        loaded = database.build(self.args.db, self.source_files_df, dictionaries, self.args.chunk_size)
+        helper.event('database', file=self.args.db, loaded=loaded)
+        return loaded
+
+    #########################
+    #
+    # ROW FILTERS
+    #
+    #########################
+
+    # row filters applied to each source as it is read, from the --gene, --variant, --region and --filter options,
+    # replaced by the given options (e.g. gene='MYH7' or gene=['MYH7', 'TP53'], region=['chr7:1-1000'])
+    def filter(self, **options):
+        args = self.args
+        for option, value in options.items():
+            if option not in FILTER_OPTIONS:
+                raise ValueError("{} is not a filter option".format(option))
+            if option in arguments.TEXT_OPTIONS and isinstance(value, (list, tuple)):
+                value = ','.join(str(v) for v in value)
+            elif option == 'region' and isinstance(value, str):
+                value = [value]
+            setattr(args, option, value)
+
+        row_filters = []
+        # key values for join-groups (--gene, --variant, --region), converted to row filters once data files exist
+        filter_keys = []
+        try:
+            if args.gene:
+                filter_keys.append(('gene-symbol', args.gene.split(',')))
+            if args.variant:
+                filter_keys.append(('variation-id', [int(v) for v in str(args.variant).split(',')]))
+            if args.filter:
+                row_filters.append(filters.Filter(args.filter))
+            for r in args.region or []:
+                region.parse(r)
+        except ValueError as exc:
+            raise helper.PipelineError(exc)
+
+        # restrict variants to those overlapping the --region(s) using the variant summary coordinate index
+        if args.region:
+            download.download(source.get(self.sources_path, region.REGION_SOURCE), False)
+            region_ids = region.variation_ids(self.sources_path, args.region, args.chunk_size)
+            helper.info("Regions", args.region, "overlap", len(region_ids), "variants")
+            filter_keys.append(('variation-id', sorted(region_ids)))
+
+        # with --related, resolve the keys of other join-groups so sources without the filtered join-group are also
+        # filtered
+        if args.related and self.key_graph is None:
+            self.key_graph = keygraph.load(self.sources_path, args.chunk_size)
+        key_graph = self.key_graph if args.related else None
+
+        key_filters = []
+        for join_group, values in filter_keys:
+            key_filter = filters.join_group_filter(join_group, values)
+            if key_graph is not None:
+                resolved = key_graph.resolve(join_group, values)
+                related_groups = sorted(set(resolved) - {join_group}, key=helper.get_join_precedence)
+                helper.info("Related keys for", join_group, values, ":", {g: len(resolved[g]) for g in related_groups})
+                key_filter = filters.FirstApplicable([key_filter] + [filters.join_group_filter(g, sorted(resolved[g]))
+                                                                      for g in related_groups])
+            key_filters.append(key_filter)
+        row_filters = key_filters + row_filters
+
+        # a shard only reads the rows of its shard from the sources with the shard key
+        if args.shard_index is not None:
+            if args.shard_key == 'chromosome':
+                download.download(source.get(self.sources_path, region.REGION_SOURCE), False)
+            row_filters.append(sharding.shard_filter(args, self.sources_path))
+        helper.debug("Row filters:", row_filters)
+        self.key_filters = key_filters
+        self.row_filters = row_filters
+
+    #########################
+    #
+    # TEMPLATE TEXT STORE
+    #
+    #########################
+
+    # with --text-store, assemble the template text output from the pre-rendered templates of the matching rows
+    def write_text_store(self):
+        args = self.args
+        wrapper = TextWrapper(width=80, break_long_words=False, break_on_hyphens=False)
+        seen = set()
+        with open(args.text_output, "w") as file:
+            for index, sourcefile in self.source_files_df.iterrows():
+                if len(sourcefile['template']) == 0:
+                    continue
+                dic = pd.read_csv(str(os.path.join(sourcefile.get('path'), sourcefile.get('dictionary'))))
+                texts = textstore.texts(sourcefile, dic, self.key_filters, args.expand, args.chunk_size,
+                                        args.template_engine)
+                if args.template_dedup:
+                    texts = templates.unseen(texts, seen)
+                for text in texts:
+                    file.write(wrapper.fill(text))
+                    file.write("\n\n")
+        helper.info("Assembled", args.text_output, "from template text stores")
+        helper.event('output', file=args.text_output)
+        return [args.text_output]
+
+    #########################
+    #
+    # READ SOURCES
+    #
+    #########################
+
+    # key of the result of a stage for a source: the filters applied to the source and the options of the stage
+    def result_key(self, stage, name, stage_options):
+        return (stage, name, tuple(repr(f) for f in self.source_filters[name]),
+                tuple(repr(getattr(self.args, o)) for o in stage_options))
+
+    def cached(self, key):
+        df = self.results.get(key)
+        return None if df is None else df.copy(deep=False)
+
+    def keep(self, key, df):
+        # a single query has no use for the result
+        if not self.keep_sources:
+            return
+        self.results[key] = df.copy(deep=False)
+        while len(self.results) > MAX_RESULTS:
+            del self.results[next(iter(self.results))]
+
+    # the chunks of a data file as read, each with the rows expanded from its lists of values
+    def parts(self, sourcefile, expand_columns, dic=None):
+        args = self.args
+        # with --db, only the rows with the keys of the filters are read from the database
+        if args.db:
+            reader = database.read(args.db, sourcefile, args.chunk_size, self.row_filters, dic, expand_columns)
+            return ((chunk, source.expand(chunk, expand_columns)) for chunk in reader)
+        key = (sourcefile.get('name'), tuple(expand_columns), args.shared_store, args.chunk_size)
+        if key in self.parsed:
+            helper.debug("Using parsed chunks of", sourcefile.get('name'))
+            return self.parsed[key]
+        # with --shared-store, read from the memory mapped store of the source shared by all processes
+        reader = store.read if args.shared_store else source.read
+        # for each row with a list of values, create a copy with each value
+        chunks = ((chunk, source.expand(chunk, expand_columns)) for chunk in reader(sourcefile, args.chunk_size))
+        if self.keep_sources:
+            chunks = list(chunks)
+            self.parsed[key] = chunks
+        return chunks
+
+    # the dictionary of a source, with an 'output' flag for the columns selected by --columns
+    def source_dictionary(self, sourcefile):
+        dictionary_file = str(os.path.join(sourcefile.get('path'), sourcefile.get('dictionary')))
+        helper.info("Read dictionary", dictionary_file)
+        dic = pd.read_csv(dictionary_file)
+        helper.event('dictionary', source=sourcefile.get('name'), **helper.shape(dic))
+
+        # TODO: args.columns refactoring
+        #  - add an attribute to indicate if the dictionary item is included in final output
+        #    so we can ignore those columns for mapping, categories, onehot, days, age
+        # if columns selected on command line, set inclusion flag filter to only include those
+        dic['output'] = dic.apply(lambda x: True, axis=1)
+        if self.args.columns is not None:
+            dic['output'] = np.where(dic.column.isin(self.args.columns), True, False)
+        return dic
+
+    # read the rows of each source passing the row filters
+    def load(self):
+        self.start_load()
+        for index, sourcefile in self.source_files_df.iterrows():
+            self.load_source(sourcefile)
+        return self.data
+
+    # fail on a --filter applying to none of the sources, e.g. with a misspelled column, instead of reading them
+    # unfiltered
+    def check_filters(self):
+        expression_filters = [f for f in self.row_filters if isinstance(f, filters.Filter)
+                              and f.expression == self.args.filter]
+        if len(expression_filters) == 0:
+            return
+        dictionaries = [pd.read_csv(str(os.path.join(sourcefile.get('path'), sourcefile.get('dictionary'))))
+                        for index, sourcefile in self.source_files_df.iterrows()]
+        for f in expression_filters:
+            if not any(f.applies(pd.DataFrame(columns=dic['column']), dic) for dic in dictionaries):
+                raise helper.PipelineError("--filter {} does not apply to any of the sources {}; its names {} must "
+                                           "all be columns or join-groups of a source.".format(
+                                               f, sorted(self.source_files_df['name']), f.names()))
+
+    def start_load(self):
+        self.check_filters()
+        # setup sources dictionary
+        self.dictionary = pd.DataFrame(columns=['name', 'path', 'file', 'column', 'comment', 'join-group', 'onehot',
+                                                'category', 'continuous', 'format', 'map', 'days', 'age', 'expand',
+                                                'na-value', 'hash', 'separator', 'aggregate'])
+        self.data = {}
+        self.sharded_sources = set()
+        self.aggregated_sources = set()
+
+    # process a source file and dictionary
+    def load_source(self, sourcefile):
+        sourcename = sourcefile.get('name')
+        helper.debug(sourcefile.get('path'), sourcefile.get('file'),
+                     sourcefile.get('dictionary'), "sep='" + sourcefile.get('delimiter') + "'")
+        dic = self.source_dictionary(sourcefile)
+        # with --aggregate, the rows read are aggregated into one row per key, with a dictionary of their own
+        aggregation = aggregates.aggregation(self.args, dic)
+        self.data[sourcename] = self.read(sourcefile, dic, aggregation)
+        if aggregation is not None:
+            dic = aggregation.dictionary
+            self.aggregated_sources.add(sourcename)
+        self.dictionaries[sourcename] = dic
+
+        # add dictionary entries to global dic if specified on command line, or all if no columns specified on
+        # command line
+        for i, r in dic.iterrows():
+            self.dictionary.loc[len(self.dictionary)] = [
+                sourcefile.get('name'), sourcefile.get('path'), sourcefile.get('file'), r.get('column'),
+                r.get('comment'), r.get('join-group'), r.get('onehot'), r.get('category'), r.get('continuous'),
+                r.get('format'), r.get('map'), r.get('days'), r.get('age'), r.get('expand'), r.get('na-value'),
+                r.get('hash'), r.get('separator'), r.get('aggregate')]
+
+        helper.debug("Dictionary processed")
+        return self.data[sourcename]
+
+    def read(self, sourcefile, dic, aggregation=None):
+        args = self.args
+        sourcename = sourcefile.get('name')
+        helper.info("Reading source for", sourcename, "...")
+
+        # filters that apply to this source, evaluated on each chunk as it is read
+        source_filters = []
+        dic_filter_df = dic.loc[(dic.get('expand') == True)] if args.expand else dic.iloc[0:0]
+        helper.debug("Found", len(dic_filter_df), "columns to expand.")
+
+        chunks = []
+        expanded_chunks = []
+        reservoir = sampling.reservoir(args, sourcename, dic, self.sample_seed)
+        first = True
+        for chunk, expanded in self.parts(sourcefile, list(dic_filter_df['column']), dic):
+            if first:
+                first = False
+                helper.debug("File header contains columns:", chunk.columns)
+                source_filters = [f for f in self.row_filters if f.applies(chunk, dic)]
+                for f in set(self.row_filters) - set(source_filters):
+                    helper.debug("Filter", f, "does not apply to", sourcename)
+                if args.compact:
+                    categorical = source.categorical_columns(dic, chunk)
+                    helper.debug("Compact categorical columns for", sourcename, ":", sorted(categorical))
+
+            for f in source_filters:
+                chunk = chunk.loc[f.mask(chunk, dic)]
+                expanded = [e.loc[f.mask(e, dic)] for e in expanded]
+            if args.compact:
+                chunk = source.compact(chunk.copy(deep=False), categorical)
+                expanded = [source.compact(e.copy(deep=False), categorical) for e in expanded]
+            if reservoir is not None:
+                reservoir.add(chunk)
+                for e in expanded:
+                    reservoir.add(e, expanded=True)
+                continue
+            if aggregation is not None:
+                for part in [chunk] + expanded:
+                    aggregation.add(part)
+                continue
+            chunks.append(chunk)
+            expanded_chunks.extend(expanded)
+        if reservoir is not None:
+            chunks = reservoir.chunks()
+            helper.info("Sampled", sum(len(c) for c in chunks), "of", reservoir.offered, "rows of", sourcename, ";",
+                        reservoir)
+            if aggregation is not None:
+                for part in chunks:
+                    aggregation.add(part)
+        if aggregation is not None:
+            chunks = [aggregation.frame()]
+            helper.info("Aggregated", sourcename, "into", len(chunks[0]), "rows;", aggregation)
+
+        # expanded rows follow the original rows
+        df = source.concat(chunks + expanded_chunks, compact=args.compact)
+        self.source_filters[sourcename] = source_filters
+        if any(isinstance(f, sharding.ShardFilter) for f in source_filters):
+            self.sharded_sources.add(sourcename)
+        helper.debug("Read", len(df), "rows for", sourcename, "with filters", source_filters)
+        helper.event('read', source=sourcename, filters=[repr(f) for f in source_filters], **helper.shape(df))
+
+        # show count of unique values per column
+        if args.counts:
+            print(sourcename, ":", df.nunique())
+            print("Finished reading source file")
+            print()
+            print()
+        return df
+
+    #########################
+    #
+    # ENCODINGS
+    #
+    #########################
+
+    # create augmented columns for onehot, mapping, continuous, scaling, categories, rank of each source
+    def encode(self):
+        for index, sourcefile in self.source_files_df.iterrows():
+            self.encoded(sourcefile)
+        return self.data
+
+    # the encoded rows of a source, reusing those of an earlier identical query
+    def encoded(self, sourcefile):
+        args = self.args
+        sourcename = sourcefile.get('name')
+        if not (args.onehot or args.categories or args.map or args.scale or args.hash):
+            return self.data[sourcename]
+        key = self.result_key('encode', sourcename, ENCODE_OPTIONS)
+        df = self.cached(key)
+        if df is None:
+            df = self.encode_source(sourcefile, self.dictionaries[sourcename], self.data[sourcename])
+            self.keep(key, df)
+        else:
+            helper.debug("Using encoded rows of", sourcename)
+        self.data[sourcename] = df
+        helper.event('encode', source=sourcename, **helper.shape(df))
+        return df
+
+    def encode_source(self, sourcefile, dic, df):
+        args = self.args
+        sourcename = sourcefile.get('name')
+        sourcecolumns = list(set(dic['column']))
+
+        # read mapping file, if any, and filter by selected columns, if any
+        map_config_df = pd.DataFrame()
+        if args.map:
+            # see if any of the dictionary fields are set with a map encoder
+            dic_filter_df = dic.loc[(dic['map'] == True)]
+            if len(dic_filter_df) > 0:
+                mapping_file = str(os.path.join(sourcefile['path'], 'mapping.csv'))
+                if not (isfile(mapping_file) and access(mapping_file, R_OK)):
+                    # no mapping file found, let's create one, but ask user to re-run if columns are filtered
+                    generate.mapping(mapping_file, self.data, sourcefile, dic)
+                    raise helper.PipelineError("Cannot map columns without mapping file for {}; Please edit "
+                                               "generated template.".format(sourcename))
+                else:
+                    helper.debug("Found existing mapping file", mapping_file)
+
+                    map_config_df = pd.read_csv(mapping_file)
+                    map_config_df = map_config_df.loc[map_config_df['column'].isin(sourcecolumns)]
+
+                    helper.debug("Mapping Config:", map_config_df)
+            else:
+                helper.debug("No map fields found in dictionary for", sourcename)
+
+        # parameters of the continuous columns to scale, fitted once per data file
+        scale_parameters = {}
+        if args.scale:
+            continuous_columns = list(dic.loc[dic['continuous'] == True, 'column'])
+            if len(continuous_columns) > 0:
+                scale_parameters = scaling.load(sourcefile, continuous_columns, args.chunk_size)
+
+        helper.debug("Processing onehot, mapping, etc. for", sourcename)
+
+        # loop through each column and process any configured options
+        # for i, r in dictionary.iterrows():
+        for i, r in dic.iterrows():
+
+            column_name = r['column']
+
+            #
+            # mappings
+            #
+            if args.map and r['map'] is True:
+
+                # get mapping subset for this column, if any (dictionary column name == mapping column name)
+                map_col_df = map_config_df.loc[(map_config_df['column'] == column_name)]
+                map_col_df = map_col_df.drop(columns={'column', 'frequency'}, axis=1)
+                map_col_df.rename(columns={'value': column_name}, inplace=True)
+
+                helper.debug("Map config for column:", column_name)
+                helper.event('map', source=sourcename, column=column_name, **helper.shape(map_col_df))
+
+                # get list of unique 'map-name' values
+                map_names = map_col_df['map-name'].unique()
+
+                # loop through each 'map-name'
+                if len(map_names) > 0 and len(map_col_df.index) > 0:
+
+                    for m in map_names:
+
+                        # create filtered dataframe for map-name
+                        map_name_df = map_col_df.loc[(map_col_df['map-name'] == m)]
+                        if m in df.columns:
+                            helper.warning("Map name", m, "is already a column of", sourcename, "; not mapping.")
+                            continue
+
+                        # look up the map-value of each value, compared as text
+                        if not args.compact:
+                            df[column_name] = df[column_name].astype(str)
+                        mapping = dict(zip(map_name_df[column_name].astype(str), map_name_df['map-value']))
+                        df[m] = helper.map_values(df[column_name], mapping)
+
+            #
+            # onehot encoding
+            #
+            if args.onehot and r['onehot'] is True:
+                helper.debug("One-hot encoding", column_name, "as", ONE_HOT_PREFIX+column_name)
+                oh_prefix = column_name + '_' + ONE_HOT_PREFIX + '_'
+                one_hot_values = df[column_name]
+                if isinstance(one_hot_values.dtype, pd.CategoricalDtype):
+                    one_hot_values = one_hot_values.cat.remove_unused_categories()
+                one_hot_encoded = pd.get_dummies(one_hot_values, prefix=oh_prefix)
+                df = pd.concat([df, one_hot_encoded], axis=1)
+
+            #
+            # categories/label encoding
+            #
+            if args.categories and r['category'] is True:
+                # imported when needed, as importing scikit-learn takes longer than serving a cached result
+                from sklearn.preprocessing import LabelEncoder
+                encoder = LabelEncoder()
+                encoded_column_name = CATEGORIES_PREFIX + '_' + column_name
+                helper.debug("Category encoding", column_name, "as", encoded_column_name, "in", sourcename)
+                if isinstance(df[column_name].dtype, pd.CategoricalDtype):
+                    # compact categorical columns are already encoded with sorted categories
+                    df[encoded_column_name] = df[column_name].cat.remove_unused_categories().cat.codes
+                else:
+                    df[encoded_column_name] = encoder.fit_transform(df[column_name])
+
+                # TODO: do we then normalize or scale the values afterwards, is that a separate option?
+
+            #
+            # hash encoding
+            #
+            if args.hash and r.get('hash') is True:
+                hash_prefix = HASH_PREFIX + '_' + column_name
+                helper.debug("Hash encoding", column_name, "as", hash_prefix, "in", args.hash_buckets, "buckets")
+                hashed = hashing.encode(df[column_name], hash_prefix, args.hash_buckets, args.hash_format == 'sparse',
+                                        args.chunk_size, separator=hashing.separator(r))
+                df = pd.concat([df, hashed], axis=1)
+
+            # date time encodings (age, days)
+            if not pd.isna(r['format']):
+                helper.debug("Age/Days: Column=", column_name, " format=", r['format'])
+                if args.age:
+                    age_column = AGE_PREFIX + '_' + column_name
+                    df[age_column] = df.apply(lambda x: helper.get_age(x.get(column_name), r['format']), axis=1)
+                if args.days:
+                    days_column = DAYS_PREFIX + '_' + column_name
+                    df[days_column] = df.apply(lambda x: helper.get_days(x.get(column_name), r['format']), axis=1)
+
+            # column-level NaN value replacement
+            if not pd.isna(r['na-value']) and r['na-value'] is not None:
+                helper.debug("Apply na-value", r['na-value'], "to", column_name)
+                df = helper.fill_na(df, r['na-value'], [column_name])
+
+            # continuous columns scaled with the parameters fitted on the whole data file
+            if args.scale and r['continuous'] is True and column_name in df:
+                scaled_column = args.scale + '_' + column_name
+                helper.debug("Scaling", column_name, "as", scaled_column)
+                df[scaled_column] = scaling.transform(df[column_name], scale_parameters[column_name], args.scale)
+
+        # if specified, fill any remaining N/A values that weren't filled in at the field level
+        if args.na_value is not None:
+            df = helper.fill_na(df, args.na_value)
+
+        # hold the new encoded columns in the smallest types too
+        if args.compact:
+            df = source.compact(df)
+        return df
+
+    #########################
+    #
+    # TEMPLATES
+    #
+    #########################
+
+    # render the template of each source with a template for each row, as the '<source>-template' column
+    def template(self):
+        for index, sourcefile in self.source_files_df.iterrows():
+            self.templated(sourcefile)
+        return self.data
+
+    # the templated rows of a source, reusing those of an earlier identical query
+    def templated(self, sourcefile):
+        sourcename = sourcefile.get('name')
+        # the template of an aggregated source reads columns no longer in its rows
+        if not self.args.template or len(sourcefile['template']) == 0 or sourcename in self.aggregated_sources:
+            return self.data[sourcename]
+        key = self.result_key('template', sourcename, TEMPLATE_OPTIONS)
+        df = self.cached(key)
+        if df is None:
+            df = self.template_source(sourcefile, self.data[sourcename])
+            self.keep(key, df)
+        else:
+            helper.debug("Using templated rows of", sourcename)
+        self.data[sourcename] = df
+        helper.event('template', source=sourcename, **helper.shape(df))
+        return df
+
+    def template_source(self, sourcefile, df):
+        sourcefile_name = sourcefile['name']
+        template_column_name = "{}-template".format(sourcefile_name)
+        helper.debug("Applying template to", sourcefile_name, "as", template_column_name)
+        if len(df) > 0:
+            template = templates.Template(sourcefile['template'], self.args.template_engine)
+            df[template_column_name] = template.render(self.template_rows(df))
+            if self.args.compact:
+                df[template_column_name] = df[template_column_name].astype(source.COMPACT_STRING)
+        else:
+            df[template_column_name] = df.apply(lambda x: '', axis=1)
+        return df
+
+    # the rows of a source given to its template
+    def template_rows(self, df):
+        if self.args.compact:
+            return templates.compact_rows(df)
+        return df
+
+    # render the template of each source with both template engines for the rows passing the filters; returns the
+    # number of rows rendered differently
+    def check_templates(self):
+        self.load()
+        differences = 0
+        for index, sourcefile in self.source_files_df.iterrows():
+            if len(sourcefile['template']) == 0:
+                continue
+            sourcename = sourcefile.get('name')
+            rows = self.template_rows(self.data[sourcename])
+            differences += templates.check(sourcename, sourcefile['template'], rows)
+        return differences
+
+    #########################
+    #
+    # MERGED OUTPUT
+    #
+    #########################
+
+    # merge selected source files by join-group, by order of the sources (--sources by default) using left joins
+    def join(self, sources=None):
+        args = self.args
+        sources_sort = list(sources or args.sources or [])
+        if len(sources_sort) == 0:
+            raise helper.PipelineError("--join requires at least one source specified with --sources parameter.")
+        missing = [s for s in sources_sort if s not in self.data]
+        if len(missing) > 0:
+            raise helper.PipelineError("sources {} to join are not loaded.".format(missing))
+        helper.info("Merging data sources:", sources_sort)
+        # the rows of a sharded source joined to all the rows of an unsharded first source would be repeated by
+        # every shard
+        if args.shard_index is not None and sources_sort[0] not in self.sharded_sources and \
+                len(self.sharded_sources) > 0:
+            raise helper.PipelineError("the first of --sources must have the {} shard key to join shards.".format(
+                args.shard_key))
+
+        dic_df = self.dictionary[self.dictionary['join-group'].notnull()]
+        dic_df['precedence'] = dic_df['join-group'].map(helper.get_join_precedence)
+        # the suffix of each source for its column names already in the output
+        suffixes = dict(zip(self.source_files_df['name'], "-" + self.source_files_df['suffix']))
+        key_graph = self.key_graph if args.related else None
+        self.join_plan = planner.plan(sources_sort, dic_df, self.data, suffixes, key_graph, args.aggregate_join)
+        self.joined = None
+        # with --max-memory, the joined rows are only written by write(), a block at a time
+        if args.max_memory is not None:
+            return None
+        out_df = planner.execute(self.join_plan, self.data, key_graph, args.aggregate_join)
+        if args.explain:
+            planner.explain(self.join_plan)
+        self.joined = self.finish_joined(out_df)
+        return self.joined
+
+    def finish_joined(self, out_df):
+        args = self.args
+        # fill in any Nan values after merging dataframes
+        if args.na_value is not None:
+            out_df = helper.fill_na(out_df, args.na_value)
+
+        # drop any columns that were not included in args.columns (or keep them all)
+        if args.columns is not None:
+            columns_to_remove = list(set(out_df.columns.values.tolist()) - set(args.columns))
+            helper.debug("Columns to remove:", columns_to_remove)
+            out_df.drop(columns_to_remove, axis=1, inplace=True)
+        return out_df
+
+    # filter, load, encode and template the sources, and join them with --joined-output; returns the joined rows, or
+    # the rows of each source when not joining. With a writer, the outputs of each source are written by the writer
+    # while the next source is processed, and write() then writes the rest.
+    def run(self, writer=None, **options):
+        self.filter(**options)
+        self.start_load()
+        if writer is not None:
+            self.start_output(writer)
+        for index, sourcefile in self.source_files_df.iterrows():
+            sourcename = sourcefile.get('name')
+            self.load_source(sourcefile)
+            self.encoded(sourcefile)
+            self.templated(sourcefile)
+            if writer is not None:
+                self.write_source(sourcename)
+                # a single query without joined or packed output has no more use for the rows once written
+                if not (self.keep_sources or self.args.join or self.args.packed_output is not None):
+                    del self.data[sourcename]
+        # show the dictionary
+        helper.debug("Columns:", self.args.columns)
+        helper.debug("Dictionary:", len(self.dictionary), "columns")
+        if self.args.join:
+            return self.join()
+        return self.data
+
+    #########################
+    #
+    # OUTPUT FILES
+    #
+    #########################
+
+    def output_file(self, output_file, kind, name, sharded):
+        if self.args.shard_index is not None:
+            self.shard_files.append({'output': output_file, 'part': sharding.part_file(self.args, output_file),
+                                     'kind': kind, 'source': name, 'sharded': sharded})
+            output_file = self.shard_files[-1]['part']
+        cache.detach(output_file)
+        self.output_files.append(output_file)
+        return output_file
+
+    # start writing the outputs with a writer (writer.Writer(0) writes each in turn in the main thread)
+    def start_output(self, output_writer):
+        args = self.args
+        self.writer = output_writer
+        self.written = set()
+        self.text_jobs = {}
+        self.text_seen = {}
+        self.output_files = []
+        self.shard_files = []
+        if args.text_output is not None:
+            # a shard writes the text of each source to its own part, for the merge to order by source
+            text_files = [args.text_output]
+            if args.shard_index is not None:
+                text_files = [sharding.text_part_file(args, d) for d in self.source_files_df['name']]
+            for text_file in text_files:
+                cache.detach(text_file)
+                self.output_files.append(text_file)
+                with open(text_file, "w") as file:
+                    file.write("")
+
+    # write the template text of a source to the text output, and the source output file
+    def write_source(self, d):
+        args = self.args
+        df = self.data[d]
+        self.written.add(d)
+
+        # aggregated sources have no template text
+        if args.text_output is not None and d not in self.aggregated_sources:
+            text_file = args.text_output
+            if args.shard_index is not None:
+                text_file = sharding.text_part_file(args, d)
+                self.shard_files.append({'output': args.text_output, 'part': text_file, 'kind': 'text', 'source': d,
+                                         'sharded': d in self.sharded_sources})
+            # the text of each source follows the text of the source before it in the same file
+            self.text_jobs[text_file] = self.writer.submit(text_file + " " + d, self.write_text, text_file, d, df,
+                                                           after=self.text_jobs.get(text_file))
+
+        helper.debug("columns for ", d, ":")
+        helper.debug(df.columns.values.tolist())
+
+        # files put in current directory, prepend source name to file
+        output_file = d + '-output.csv'
+        if args.output is not None:
+            output_file = d + '-' + args.output
+        helper.debug("Generating intermediate source output", output_file)
+        if args.columns is not None:
+            columns_to_remove = list(set(df.columns.values.tolist()) - set(args.columns))
+            df = df.drop(columns_to_remove, axis=1)
+        output_file = self.output_file(output_file, 'source', d, d in self.sharded_sources)
+        self.submit_csv(output_file, df, self.feature_columns(d, df) if args.features else None, {'source': d})
+
+    # write the template text, packed, per-source and joined outputs of the options not already written while
+    # running; returns the files written, once written by the writer threads
+    def write(self):
+        args = self.args
+        data = self.data
+        if self.writer is None:
+            self.start_output(writer.Writer(0))
+
+        # create per-source output files to debugging purposes
+        for d in [d for d in data.keys() if d not in self.written]:
+            self.write_source(d)
+
+        # template text packed into chunks per variant or gene, with the sources in --sources order
+        if args.packed_output is not None:
+            source_order = [s for s in (args.sources or []) if s in data] + \
+                           [d for d in data if d not in (args.sources or [])]
+            cache.detach(args.packed_output)
+            self.output_files.append(args.packed_output)
+            packing.write(args.packed_output, data, self.dictionary, source_order, args.pack_budget, args.pack_unit)
+            helper.event('output', file=args.packed_output)
+
+        if args.join and self.joined is not None:
+            first = self.join_plan.steps[0].name
+            output_file = self.output_file(args.output, 'joined', first, first in self.sharded_sources)
+            helper.info("Generating output", output_file)
+            self.submit_csv(output_file, self.joined, self.joined_feature_columns() if args.features else None, {})
+        elif args.join and args.max_memory is not None and self.join_plan is not None:
+            self.write_joined_blocks()
+        self.writer = None
+        return self.output_files
+
+    # with --max-memory, join and write the joined output a block of rows of the first source at a time
+    def write_joined_blocks(self):
+        args = self.args
+        first = self.join_plan.steps[0].name
+        output_file = self.output_file(args.output, 'joined', first, first in self.sharded_sources)
+        helper.info("Generating output", output_file, "in blocks of at most", args.max_memory, "MB")
+        key_graph = self.key_graph if args.related else None
+        rows = external.write(output_file, self.join_plan, self.data, key_graph, args.aggregate_join,
+                              args.max_memory, self.finish_joined)
+        helper.event('output', file=output_file, rows=rows)
+        if args.explain:
+            planner.explain(self.join_plan)
+
+    # write a CSV output, and its feature matrix if feature_columns
+    def submit_csv(self, output_file, df, feature_columns, fields):
+        if feature_columns is not None:
+            for feature_file in features.files(output_file):
+                cache.detach(feature_file)
+                self.output_files.append(feature_file)
+        self.writer.submit(output_file, self.write_csv, output_file, df, feature_columns, fields)
+
+    def write_csv(self, output_file, df, feature_columns, fields):
+        source.as_written(df).to_csv(output_file, index=False)
+        helper.event('output', **fields, file=output_file, **helper.shape(df))
+        if feature_columns is not None:
+            features.write(output_file, df, feature_columns, self.args.feature_dtype, self.args.chunk_size)
+
+    def write_text(self, text_file, d, df):
+        wrapper = TextWrapper(width=80, break_long_words=False, break_on_hyphens=False)
+        texts = df["{}-template".format(d)]
+        if self.args.template_dedup:
+            texts = templates.unseen(texts, self.text_seen.setdefault(text_file, set()))
+        rows = 0
+        with open(text_file, "a") as file:
+            for text in texts:
+                file.write(wrapper.fill(text))
+                file.write("\n\n")
+                rows += 1
+        helper.event('output', source=d, file=text_file, rows=rows)
+
+    #########################
+    #
+    # FEATURE MATRIX
+    #
+    #########################
+
+    # map-names of each column of a source in its mapping file
+    def map_names(self, sourcename):
+        sourcefile = self.source_files_df.loc[self.source_files_df['name'] == sourcename].iloc[0]
+        mapping_file = str(os.path.join(sourcefile['path'], 'mapping.csv'))
+        if not (self.args.map and isfile(mapping_file)):
+            return {}
+        map_config_df = pd.read_csv(mapping_file)
+        return map_config_df.groupby('column')['map-name'].unique().to_dict()
+
+    # the encoded and continuous columns of a source, as {'name', 'source', 'column', 'encoding'}
+    def feature_columns(self, sourcename, df):
+        args = self.args
+        map_names = self.map_names(sourcename)
+        columns = []
+        for i, r in self.dictionaries[sourcename].iterrows():
+            column_name = r['column']
+            encoded = []
+            if r['continuous'] is True:
+                encoded.append((column_name, 'continuous'))
+                if args.scale:
+                    encoded.append((args.scale + '_' + column_name, args.scale))
+            if args.map and r['map'] is True:
+                encoded.extend((m, 'map') for m in map_names.get(column_name, []))
+            if args.onehot and r['onehot'] is True:
+                oh_prefix = column_name + '_' + ONE_HOT_PREFIX + '_'
+                encoded.extend((c, 'onehot') for c in df.columns if str(c).startswith(oh_prefix))
+            if args.categories and r['category'] is True:
+                encoded.append((CATEGORIES_PREFIX + '_' + column_name, 'category'))
+            if args.hash and r.get('hash') is True:
+                hash_prefix = HASH_PREFIX + '_' + column_name + '_'
+                encoded.extend((c, 'hash') for c in df.columns if str(c).startswith(hash_prefix))
+            if sourcename in self.aggregated_sources and r.get('aggregate') in aggregates.NUMERIC:
+                encoded.append((column_name, 'aggregate'))
+            if not pd.isna(r['format']):
+                if args.days:
+                    encoded.append((DAYS_PREFIX + '_' + column_name, 'days'))
+                if args.age:
+                    encoded.append((AGE_PREFIX + '_' + column_name, 'age'))
+            columns.extend({'name': c, 'source': sourcename, 'column': column_name, 'encoding': encoding}
+                           for c, encoding in encoded if c in df)
+        return columns
+
+    # the feature columns of each source joined, by their names in the joined output
+    def joined_feature_columns(self):
+        columns = []
+        for step in self.join_plan.steps:
+            df = self.data[step.name]
+            source_columns = self.feature_columns(step.name, df)
+            if self.args.aggregate_join and step.index > 0:
+                count_column = "{}-count".format(step.name)
+                source_columns.append({'name': count_column, 'source': step.name, 'column': step.right_column,
+                                       'encoding': 'count'})
+            for c in source_columns:
+                columns.append(dict(c, name=step.renames.get(c['name'], c['name'])))
+        return [c for c in columns if c['name'] in self.joined]
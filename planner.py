@@ -0,0 +1,288 @@
+# local modules
+import helper
+
+# other libraries
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# JOIN PLANNER
+#
+# The joined output is the first of --sources left joined in turn with each of the others, by the highest precedence
+# join-group the source shares with the sources before it (or bridged through the key graph with --related). The
+# planner keeps those joins, and so the output, but chooses the order to run them in: from the key counts of the join
+# columns it estimates the fan-out of each join (the number of rows each row of the output is joined to), and runs
+# the joins with the smallest fan-out first, once the columns they join on have been joined, so the intermediate
+# results grow as late as possible. The columns of each source are named, the output columns ordered and the output
+# rows sorted as the joins in --sources order would give them.
+#
+# The estimate of the output rows is the rows of the first source multiplied by the fan-out of every join, assuming
+# the keys of different join-groups are independent. With --explain the plan is printed with the estimated and actual
+# rows after each join, and a warning is logged before running a plan estimated to multiply the rows of the first
+# source by more than JOIN_WARNING_FACTOR.
+#
+#########################
+
+JOIN_WARNING_FACTOR = 100
+# prefix of the columns holding the position of each row in the joined sources, for ordering the output rows
+ORDER_COLUMN = '__order-'
+
+
+# a join of a source into the output, and its statistics
+class Step:
+
+    def __init__(self, index, name, suffix):
+        self.index = index
+        self.name = name
+        self.suffix = suffix
+        self.join_group = None
+        self.left_column = None
+        self.right_column = None
+        # with --related, the join-group and column the join-group of the source is bridged from
+        self.bridge_group = None
+        self.bridge_column = None
+        # the steps that add the columns this step joins on
+        self.after = set()
+        # right column name to its name in the output
+        self.renames = {}
+        self.keys = 0
+        self.max_duplicates = 0
+        self.fanout = 1.0
+        self.estimate = None
+        self.actual = None
+        # estimated fan-out of the other join-groups the source could have been joined by
+        self.alternatives = {}
+
+    def __repr__(self):
+        return "{} by {}".format(self.name, self.join_group) if self.join_group else self.name
+
+
+class Plan:
+
+    def __init__(self, steps, order, columns):
+        # steps in --sources order, the order to run them in, and the output columns
+        self.steps = steps
+        self.order = order
+        self.columns = columns
+
+    def reordered(self):
+        return [s.index for s in self.order] != [s.index for s in self.steps]
+
+
+def join_columns(dic_df, name):
+    s_dic_df = dic_df.loc[(dic_df['name'] == name)].sort_values(by=['precedence'])
+    return dict(s_dic_df[['join-group', 'column']].drop_duplicates('join-group').values)
+
+
+def right_columns(df, step, aggregate):
+    columns = list(df.columns)
+    return columns + ["{}-count".format(step.name)] if aggregate and step.index > 0 else columns
+
+
+def key_counts(series):
+    return series.value_counts(dropna=False)
+
+
+# rows of the right source per row of the left column, from their key counts
+def fanout(left_counts, right_counts, aggregate, rows=None):
+    rows = left_counts.sum() if rows is None else rows
+    if rows == 0:
+        return 1.0
+    matches = right_counts.reindex(left_counts.index).fillna(0).clip(lower=1)
+    if aggregate:
+        matches = matches.clip(upper=1)
+    return float((left_counts * matches).sum() / rows)
+
+
+# key counts of the related keys of the left keys, with None for the keys without related keys
+def bridged_counts(left_counts, key_graph, from_group, to_group):
+    related = {}
+    for value, count in left_counts.items():
+        keys = sorted(key_graph.lookup(from_group, [value], to_group)) if not pd.isna(value) else []
+        for k in keys or [None]:
+            related[k] = related.get(k, 0) + count
+    return pd.Series(list(related.values()), index=pd.Index(list(related.keys()), dtype=object), dtype='int64')
+
+
+# the joins of the sources in --sources order, as main.py has always run them, with their statistics
+def steps(sources, dic_df, data, suffixes, key_graph, aggregate):
+    all_steps = []
+    # output column name to the step adding it, and join-group to output column taking the first source with it
+    owners = {}
+    already_joined = {}
+    # output column name to the source and column it is from, and its key counts once needed
+    sources_of = {}
+    counts = {}
+
+    def column_counts(column):
+        if column not in counts:
+            name, c = sources_of[column]
+            counts[column] = key_counts(data[name][c])
+        return counts[column]
+
+    for s in sources:
+        step = Step(len(all_steps), s, suffixes[s])
+        s_join_columns = join_columns(dic_df, s)
+        if step.index > 0:
+            available = [jg for jg in s_join_columns if jg in already_joined]
+            if len(available) > 0:
+                step.join_group = available[0]
+            elif key_graph is not None:
+                # with --related, bridge to the source through the key graph (e.g. variation-id to gene-symbol)
+                for jg in s_join_columns:
+                    linked = [prior_jg for prior_jg in already_joined if key_graph.linked(prior_jg, jg)]
+                    if len(linked) > 0:
+                        step.join_group = jg
+                        step.bridge_group = linked[0]
+                        step.bridge_column = already_joined[linked[0]]
+                        break
+            if step.join_group is None:
+                raise helper.PipelineError("no join-group of {} is in the sources before it.".format(s))
+            step.right_column = s_join_columns[step.join_group]
+            right_counts = key_counts(data[s][step.right_column])
+            step.keys = int(right_counts.size)
+            step.max_duplicates = int(right_counts.max()) if right_counts.size > 0 else 0
+            if step.bridge_group is None:
+                step.left_column = already_joined[step.join_group]
+                step.after.add(owners[step.left_column])
+                step.fanout = fanout(column_counts(step.left_column), right_counts, aggregate)
+                for jg in available[1:]:
+                    step.alternatives[jg] = fanout(column_counts(already_joined[jg]),
+                                                   key_counts(data[s][s_join_columns[jg]]), aggregate)
+            else:
+                step.left_column = 'related-' + step.join_group
+                step.after.add(owners[step.bridge_column])
+                left_counts = column_counts(step.bridge_column)
+                counts[step.left_column] = bridged_counts(left_counts, key_graph, step.bridge_group, step.join_group)
+                step.fanout = fanout(counts[step.left_column], right_counts, aggregate, rows=left_counts.sum())
+                owners[step.left_column] = step.index
+                already_joined[step.join_group] = step.left_column
+            helper.debug("Join of", step, "on", step.left_column, "=", step.right_column, "has", step.keys,
+                         "keys, at most", step.max_duplicates, "rows per key, estimated fan-out", step.fanout)
+
+        # name the columns of the source in the output as the merge would, suffixing names already in the output
+        for c in right_columns(data[s], step, aggregate):
+            if c == step.right_column and c == step.left_column:
+                continue
+            name = c + step.suffix if c in owners else c
+            if name != c:
+                step.renames[c] = name
+            owners[name] = step.index
+            sources_of[name] = (s, c)
+        for jg, column in s_join_columns.items():
+            already_joined.setdefault(jg, column)
+        all_steps.append(step)
+    return all_steps, list(owners)
+
+
+def plan(sources, dic_df, data, suffixes, key_graph, aggregate):
+    all_steps, columns = steps(sources, dic_df, data, suffixes, key_graph, aggregate)
+    # the first source, then the joins with the smallest fan-out among those with the columns they join on
+    order = [all_steps[0]]
+    done = {0}
+    pending = all_steps[1:]
+    estimate = len(data[sources[0]])
+    all_steps[0].estimate = estimate
+    while len(pending) > 0:
+        ready = [s for s in pending if s.after <= done]
+        step = min(ready, key=lambda s: (s.fanout, s.index))
+        estimate *= step.fanout
+        step.estimate = int(round(estimate))
+        order.append(step)
+        done.add(step.index)
+        pending.remove(step)
+    join_plan = Plan(all_steps, order, columns)
+    helper.info("Join plan:", order, "estimated", order[-1].estimate, "rows")
+    helper.event('plan', order=[s.name for s in order], estimate=order[-1].estimate,
+                 fanout={s.name: round(s.fanout, 3) for s in order})
+    if order[-1].estimate > JOIN_WARNING_FACTOR * max(1, all_steps[0].estimate):
+        helper.warning("The joins of", sources, "are estimated to give", order[-1].estimate, "rows from",
+                       all_steps[0].estimate, "rows of", sources[0], "; consider --aggregate-join or filters")
+    return join_plan
+
+
+def order_column(step, bridge=False):
+    return "{}{}{}".format(ORDER_COLUMN, step.index, '-bridge' if bridge else '')
+
+
+# the right-hand rows of each join of the plan, collapsed with --aggregate-join and with their output column names
+def right_frames(join_plan, data, aggregate):
+    frames = {}
+    for step in join_plan.order[1:]:
+        right_df = data[step.name]
+        # with --aggregate-join, collapse the source to one row per join key so the output keeps its rows
+        if aggregate:
+            right_df = helper.collapse_rows(right_df, step.right_column, "{}-count".format(step.name))
+            helper.debug("Collapsed", len(data[step.name]), "rows of", step.name, "to", len(right_df), "keys")
+        right_df = right_df.rename(columns=step.renames)
+        if join_plan.reordered():
+            right_df = right_df.assign(**{order_column(step): np.arange(len(right_df))})
+        frames[step.index] = right_df
+    return frames
+
+
+# the output of the joins of the plan, with the columns and rows in the order of joining in --sources order; with
+# rows, the output of the rows from start to stop of the first source only, with the frames of right_frames
+def execute(join_plan, data, key_graph, aggregate, rows=None, frames=None):
+    reordered = join_plan.reordered()
+    frames = right_frames(join_plan, data, aggregate) if frames is None else frames
+    out_df = None
+    for step in join_plan.order:
+        if rows is None:
+            helper.info("Merging", step.name)
+        if step.index == 0:
+            out_df = data[step.name]
+            start = 0
+            if rows is not None:
+                start = rows[0]
+                out_df = out_df.iloc[rows[0]:rows[1]]
+            if reordered:
+                out_df = out_df.assign(**{order_column(step): np.arange(start, start + len(out_df))})
+            step.actual = len(out_df)
+            continue
+
+        if step.bridge_group is not None:
+            helper.info("Bridging", step.bridge_group, "to", step.join_group, "for", step.name, "as", step.left_column)
+            out_df = out_df.reset_index(drop=True)
+            out_df[step.left_column] = out_df[step.bridge_column].map(
+                lambda v: sorted(key_graph.lookup(step.bridge_group, [v], step.join_group)) or [None])
+            out_df = out_df.explode(step.left_column)
+            if reordered:
+                out_df[order_column(step, bridge=True)] = out_df.groupby(level=0).cumcount()
+            out_df = out_df.reset_index(drop=True)
+
+        helper.debug("Left join column", step.left_column, "right join column", step.right_column)
+        helper.debug("Out length prior", len(out_df))
+        out_df = pd.merge(
+            out_df, frames[step.index],
+            how='left',
+            left_on=step.left_column,
+            right_on=step.renames.get(step.right_column, step.right_column), suffixes=('', step.suffix))
+        step.actual = len(out_df)
+        helper.debug("Out length after", len(out_df))
+        if rows is None:
+            helper.event('merge', source=step.name, join_group=step.join_group, estimate=step.estimate,
+                         **helper.shape(out_df))
+
+    if reordered:
+        order_columns = [order_column(s, bridge) for s in join_plan.steps for bridge in [True, False]
+                         if order_column(s, bridge) in out_df]
+        out_df = out_df.sort_values(order_columns, kind='stable').reset_index(drop=True)
+    return out_df if list(out_df.columns) == join_plan.columns else out_df[join_plan.columns]
+
+
+def explain(join_plan):
+    print("Join plan, in the order the joins are run:")
+    print("{:>4}  {:<36} {:<14} {:<36} {:>9} {:>8} {:>9} {:>12} {:>12}".format(
+        'step', 'source', 'join-group', 'left column', 'keys', 'max dup', 'fan-out', 'est rows', 'actual rows'))
+    for step in join_plan.order:
+        left_column = step.left_column or ''
+        if step.bridge_group is not None:
+            left_column = "{} via {}".format(step.bridge_column, step.bridge_group)
+        print("{:>4}  {:<36} {:<14} {:<36} {:>9} {:>8} {:>9.2f} {:>12} {:>12}".format(
+            step.index, step.name, step.join_group or '', left_column, step.keys, step.max_duplicates, step.fanout,
+            step.estimate, '' if step.actual is None else step.actual))
+        for jg, alternative in step.alternatives.items():
+            print("{:>4}  {:<36} {:<14} {:<36} {:>9} {:>8} {:>9.2f}   (not used; lower join-group precedence)".format(
+                '', '', jg, '', '', '', alternative))
@@ -0,0 +1,174 @@
+# local modules
+import download
+import helper
+import source
+
+# other libraries
+import os
+import re
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# GENOMIC REGION INDEX
+#
+# Interval index over the variant coordinates in the ClinVar variant summary. For each assembly and chromosome the
+# variants are split into tiers by length: variants up to LONG_VARIANT long, then each further tier with variants up to
+# twice as long as the one before (e.g. copy number variants spanning most of a chromosome). Each tier holds the start
+# positions of its variants in sorted order with the matching stop positions and VariationIDs, plus the longest of
+# their lengths. Variants overlapping a region are found in each tier by binary search on the start positions between
+# (region start - longest length) and region end, then checked against their stop positions, so a long variant only
+# widens the search of the variants of about its length, at most twice the region's overlapping variants of the tier.
+#
+# The index is built once per release of the variant summary file and saved next to it under a temporary name, then
+# renamed, so a run never reads a partly written index.
+#
+#########################
+
+REGION_SOURCE = 'clinvar-variant-summary'
+REGION_COLUMNS = ['VariationID', 'Assembly', 'Chromosome', 'Start', 'Stop']
+DEFAULT_ASSEMBLY = 'GRCh38'
+INDEX_SUFFIX = '.regions.npz'
+# format of the index, rebuilt when it changes
+INDEX_VERSION = 3
+# length of the longest variants of the first tier
+LONG_VARIANT = 100000
+
+
+# parse chr:start-end[@assembly], e.g. chr7:117,480,025-117,668,665@GRCh38
+def parse(region_text):
+    match = re.fullmatch(r'\s*(?:chr)?([0-9A-Za-z]+):([0-9,]+)-([0-9,]+)(?:@(\w+))?\s*', region_text)
+    if match is None:
+        raise ValueError("Invalid region {}; expected chr:start-end[@assembly]".format(region_text))
+    chromosome = normalize_chromosome(match.group(1))
+    start = int(match.group(2).replace(',', ''))
+    end = int(match.group(3).replace(',', ''))
+    if end < start:
+        raise ValueError("Invalid region {}; end is before start".format(region_text))
+    return chromosome, start, end, match.group(4) or DEFAULT_ASSEMBLY
+
+
+def normalize_chromosome(chromosome):
+    chromosome = str(chromosome)
+    if chromosome.lower().startswith('chr'):
+        chromosome = chromosome[3:]
+    if chromosome.upper() in ('M', 'MT'):
+        return 'MT'
+    return chromosome.upper() if chromosome.isalpha() else chromosome
+
+
+def index_file(sourcefile):
+    return source.data_file(sourcefile) + INDEX_SUFFIX
+
+
+def build(sourcefile, chunksize):
+    helper.info("Building region index for", sourcefile.get('name'))
+    chunks = []
+    for chunk in source.read(sourcefile, chunksize, columns=REGION_COLUMNS):
+        chunk = chunk.assign(Start=pd.to_numeric(chunk['Start'], errors='coerce'),
+                             Stop=pd.to_numeric(chunk['Stop'], errors='coerce'))
+        chunks.append(chunk.dropna(subset=['Start', 'Stop']))
+    df = pd.concat(chunks, ignore_index=True)
+    df['Chromosome'] = df['Chromosome'].map(normalize_chromosome)
+
+    arrays = index_arrays(df)
+    arrays['signature'] = np.array([helper.file_signature(source.data_file(sourcefile))])
+    arrays['version'] = np.array([INDEX_VERSION])
+    file_path = index_file(sourcefile)
+    temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    with open(temp_path, 'wb') as fp:
+        np.savez(fp, **arrays)
+    os.replace(temp_path, file_path)
+    helper.info("Saved region index", file_path, "with", len(df), "variant locations")
+
+
+# tier of each variant length: 0 up to LONG_VARIANT, then k up to LONG_VARIANT * 2 ** k
+def tiers(lengths):
+    return np.maximum(np.ceil(np.log2(np.maximum(lengths, 1) / LONG_VARIANT)), 0).astype(np.int64)
+
+
+def tier_key(key, tier):
+    return key if tier == 0 else "{}:long{}".format(key, tier)
+
+
+# the arrays of the index of the variant locations of df, with the columns of REGION_COLUMNS
+def index_arrays(df):
+    arrays = {}
+    for (assembly, chromosome), group in df.groupby(['Assembly', 'Chromosome']):
+        group = group.sort_values('Start')
+        group_tiers = tiers((group['Stop'] - group['Start']).to_numpy())
+        key = "{}:{}".format(assembly, chromosome)
+        arrays[key + ':tiers'] = np.union1d([0], group_tiers)
+        for tier in arrays[key + ':tiers']:
+            variants = group.loc[group_tiers == tier]
+            arrays[tier_key(key, tier) + ':start'] = variants['Start'].to_numpy(dtype=np.int64)
+            arrays[tier_key(key, tier) + ':stop'] = variants['Stop'].to_numpy(dtype=np.int64)
+            arrays[tier_key(key, tier) + ':id'] = variants['VariationID'].to_numpy(dtype=np.int64)
+            arrays[tier_key(key, tier) + ':length'] = np.array([(variants['Stop'] - variants['Start']).max() if len(variants) > 0
+                                                else 0], dtype=np.int64)
+    return arrays
+
+
+# the region index of a source, if saved for the current data file
+def indexed(sourcefile):
+    file_path = index_file(sourcefile)
+    if not os.path.isfile(file_path):
+        return None
+    with np.load(file_path) as index:
+        if str(index['signature'][0]) == helper.file_signature(source.data_file(sourcefile)) and \
+                'version' in index and int(index['version'][0]) == INDEX_VERSION:
+            helper.debug("Using region index", file_path)
+            return dict(index)
+    helper.info("Region index", file_path, "is out of date")
+    return None
+
+
+# load the region index, building it first if missing or out of date with the data file; one run builds it holding
+# the download lock of the source while the others wait for it
+def load(sourcefile, chunksize):
+    index = indexed(sourcefile)
+    if index is not None:
+        return index
+    with download.locked(sourcefile):
+        index = indexed(sourcefile)
+        if index is None:
+            build(sourcefile, chunksize)
+            index = indexed(sourcefile)
+    return index
+
+
+# the stop positions and VariationIDs of the variants that may overlap chromosome:start-end on assembly: those of each
+# tier starting from (start - the longest length of the tier) to end
+def candidates(index, chromosome, start, end, assembly=DEFAULT_ASSEMBLY):
+    key = "{}:{}".format(assembly, normalize_chromosome(chromosome))
+    stops, ids = [], []
+    for tier in index[key + ':tiers']:
+        starts = index[tier_key(key, tier) + ':start']
+        lo = np.searchsorted(starts, start - index[tier_key(key, tier) + ':length'][0], side='left')
+        hi = np.searchsorted(starts, end, side='right')
+        stops.append(index[tier_key(key, tier) + ':stop'][lo:hi])
+        ids.append(index[tier_key(key, tier) + ':id'][lo:hi])
+    return np.concatenate(stops), np.concatenate(ids)
+
+
+# VariationIDs of variants overlapping chromosome:start-end on assembly
+def overlaps(index, chromosome, start, end, assembly=DEFAULT_ASSEMBLY):
+    if "{}:{}:start".format(assembly, normalize_chromosome(chromosome)) not in index:
+        helper.warning("No variants indexed for chromosome", chromosome, "on", assembly)
+        return set()
+    stops, ids = candidates(index, chromosome, start, end, assembly)
+    return set(ids[stops >= start].tolist())
+
+
+# VariationIDs overlapping any of the region texts
+def variation_ids(sources_path, regions, chunksize):
+    sourcefile = source.get(sources_path, REGION_SOURCE)
+    index = load(sourcefile, chunksize)
+    ids = set()
+    for r in regions:
+        chromosome, start, end, assembly = parse(r)
+        region_ids = overlaps(index, chromosome, start, end, assembly)
+        helper.info("Region", r, "overlaps", len(region_ids), "variants")
+        ids |= region_ids
+    return ids
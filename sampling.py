@@ -0,0 +1,121 @@
+# local modules
+import keygraph
+
+# other libraries
+import zlib
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# SAMPLED SOURCES
+#
+# With --sample=N, each source is read as a uniform random sample of N of its rows passing the filters, taken in the
+# one pass reading the data file a chunk at a time, so a configuration is tried on a large source in seconds and the
+# sample goes through the encodings, templates and joins as the whole source would. Each row is given a random
+# priority and the N rows with the lowest priorities seen so far are kept (a bottom-k reservoir), so no more than N
+# rows (and the chunk being read) are held at once. With --sample-seed the same rows are sampled on every run.
+#
+# With --sample-by=<column>, the sample is stratified: N rows are sampled for each value of the column, in the sources
+# with the column.
+#
+# With --sample-key=<join-group>, the sources with a column in the join-group are sampled by key instead of by row:
+# the priority of a row is a hash of its key seeded by the run, the same in every source, and all the rows of the N
+# keys with the lowest priorities are kept, so the sampled sources keep the rows of mostly the same keys and still
+# join. Rows without a key are not sampled.
+#
+#########################
+
+# the column holding the priority of each row kept
+PRIORITY = '_sample_priority'
+
+
+# the column of a source in the join-group, or None
+def key_column(dic, join_group):
+    columns = dic.loc[dic['join-group'] == join_group, 'column']
+    return columns.iloc[0] if len(columns) > 0 else None
+
+
+class Reservoir:
+
+    def __init__(self, size, seed, name, stratum=None, key=None):
+        self.size = size
+        self.seed = seed
+        # random priorities differ between sources sampled with the same seed
+        self.random = np.random.default_rng([seed, zlib.crc32(name.encode())])
+        # the column the sample is stratified by, and the column of the keys sampled, if any
+        self.stratum = stratum
+        self.key = key
+        # the rows kept so far from each chunk, with their priorities, and whether they are expanded rows
+        self.parts = []
+        self.expanded = []
+        self.offered = 0
+        # the columns of the source, for a sample without rows
+        self.empty = None
+
+    def __repr__(self):
+        by = ", by {}".format(self.stratum) if self.stratum else ""
+        keys = " keys of {}".format(self.key) if self.key else " rows"
+        return "sample of {}{}{}".format(self.size, keys, by)
+
+    # the priority of each row of df: the seeded hash of its key, or a random number
+    def priorities(self, df):
+        if self.key is None:
+            return self.random.integers(0, np.iinfo(np.uint64).max, size=len(df), dtype=np.uint64, endpoint=True)
+        keys = df[self.key].map(lambda v: None if pd.isna(v) else keygraph.key(v))
+        hash_key = "{:016d}".format(self.seed % 10 ** 16)
+        priorities = pd.util.hash_array(keys.fillna('').to_numpy(dtype=object), hash_key=hash_key, categorize=False)
+        # rows without a key are never kept
+        priorities[keys.isna().to_numpy()] = np.iinfo(np.uint64).max
+        return priorities
+
+    # rows of the priorities kept: the size lowest in each stratum, or those of the size lowest keys
+    def kept(self, priorities):
+        if self.key is not None:
+            priorities = priorities[priorities['priority'] != np.iinfo(np.uint64).max]
+        # ranked as floats, exactly for the top 53 bits
+        rank_priorities = (priorities['priority'].to_numpy() >> np.uint64(11)).astype(np.float64)
+        groups = pd.Series(rank_priorities, index=priorities.index).groupby(priorities['stratum'].to_numpy(),
+                                                                              sort=False, dropna=False)
+        if self.key is None:
+            rank = groups.rank(method='first')
+        else:
+            rank = groups.rank(method='dense')
+        return priorities.loc[rank <= self.size]
+
+    # offer the rows of a chunk, or rows expanded from a chunk, to the sample
+    def add(self, df, expanded=False):
+        if self.empty is None:
+            self.empty = df.iloc[0:0]
+        if len(df) == 0:
+            return
+        df = df.assign(**{PRIORITY: self.priorities(df)})
+        self.offered += len(df)
+        self.parts.append(df)
+        self.expanded.append(expanded)
+        priorities = pd.concat([pd.DataFrame({
+            'part': i, 'position': np.arange(len(part)), 'priority': part[PRIORITY].to_numpy(),
+            'stratum': part[self.stratum].to_numpy() if self.stratum else 0}) for i, part in enumerate(self.parts)],
+            ignore_index=True)
+        kept = self.kept(priorities)
+        # drop the rows no longer in the sample, keeping the order of the rows read
+        positions = kept.groupby('part')['position']
+        parts = [i for i in range(len(self.parts)) if i in positions.groups]
+        self.parts = [self.parts[i].iloc[np.sort(positions.get_group(i).to_numpy())] for i in parts]
+        self.expanded = [self.expanded[i] for i in parts]
+
+    # the chunks of the rows sampled, in the order they were read, the expanded rows after the others
+    def chunks(self):
+        if len(self.parts) == 0:
+            return [] if self.empty is None else [self.empty]
+        return [part.drop(columns=[PRIORITY]) for expanded in (False, True)
+                for part, e in zip(self.parts, self.expanded) if e == expanded]
+
+
+# the reservoir sampling the named source read with the dictionary dic, or None without --sample
+def reservoir(args, name, dic, seed):
+    if args.sample is None:
+        return None
+    stratum = args.sample_by if args.sample_by in set(dic['column']) else None
+    key = key_column(dic, args.sample_key) if args.sample_key else None
+    return Reservoir(args.sample, seed, name, stratum=stratum, key=key)
@@ -0,0 +1,167 @@
+# local modules
+import download
+import helper
+import source
+
+# other libraries
+import json
+import os
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# CONTINUOUS SCALING
+#
+# With --scale, each column configured as continuous in the dictionary is also output scaled as a new column
+# '<method>_<column>': zscore ((x - mean) / standard deviation), minmax ((x - min) / (max - min)), log1p (log(1 + x),
+# shifted by the minimum when below zero) or robust ((x - median) / interquartile range). Values that are not numbers
+# are NaN.
+#
+# The parameters are fitted on all the rows of the data file, whatever the filters of the run, so the scaled values
+# of a row are the same in every run. They are gathered in one pass over the continuous columns of the data file a
+# chunk at a time: the count, mean and variance with Welford's method, merged chunk by chunk, the minimum and maximum,
+# and the quartiles from a quantile sketch of bounded size. The parameters are saved next to the data file (e.g.
+# variant_summary.txt.scaling.json) and fitted again when the data file or the continuous columns change.
+#
+#########################
+
+PARAMETERS_SUFFIX = '.scaling.json'
+# values kept per level of the quantile sketch; the rank error of a quartile is about log2(rows / capacity) / capacity
+SKETCH_CAPACITY = 4096
+
+
+# a mergeable sketch of the distribution of a stream of values: level i holds values standing for 2^i values each,
+# and a full level is sorted and every other value moved up a level, alternating which half is kept
+class QuantileSketch:
+
+    def __init__(self, capacity=SKETCH_CAPACITY):
+        self.capacity = capacity
+        self.levels = [np.empty(0)]
+        self.offset = 0
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity:
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                kept = np.sort(self.levels[level])[self.offset::2]
+                self.offset = 1 - self.offset
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], kept])
+                self.levels[level] = np.empty(0)
+            level += 1
+
+    def quantile(self, q):
+        values = np.concatenate(self.levels)
+        if len(values) == 0:
+            return None
+        weights = np.concatenate([np.full(len(v), 2.0 ** i) for i, v in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        index = min(int(np.searchsorted(cumulative, q * cumulative[-1])), len(values) - 1)
+        return float(values[order][index])
+
+
+# count, mean, variance, minimum and maximum of a stream of values, merging the statistics of each chunk
+class Statistics:
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.sketch = QuantileSketch()
+
+    def update(self, values):
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        count = self.count + len(values)
+        mean = float(values.mean())
+        delta = mean - self.mean
+        self.m2 += float(((values - mean) ** 2).sum()) + delta ** 2 * self.count * len(values) / count
+        self.mean += delta * len(values) / count
+        self.count = count
+        self.minimum = float(values.min()) if self.minimum is None else min(self.minimum, float(values.min()))
+        self.maximum = float(values.max()) if self.maximum is None else max(self.maximum, float(values.max()))
+        self.sketch.update(values)
+
+    def parameters(self):
+        return {'count': self.count, 'mean': self.mean,
+                'std': (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0,
+                'min': self.minimum, 'max': self.maximum, 'q1': self.sketch.quantile(0.25),
+                'median': self.sketch.quantile(0.5), 'q3': self.sketch.quantile(0.75)}
+
+
+def parameters_file(sourcefile):
+    return source.data_file(sourcefile) + PARAMETERS_SUFFIX
+
+
+def numbers(series):
+    if not pd.api.types.is_numeric_dtype(series.dtype):
+        series = pd.to_numeric(series.astype(object), errors='coerce')
+    return series.to_numpy(dtype='float64', na_value=np.nan)
+
+
+def fit(sourcefile, columns, chunksize):
+    helper.info("Fitting scaling of", columns, "for", sourcefile.get('name'))
+    statistics = {c: Statistics() for c in columns}
+    for chunk in source.read(sourcefile, chunksize, columns=columns):
+        for c in columns:
+            if c in chunk:
+                statistics[c].update(numbers(chunk[c]))
+    return {c: s.parameters() for c, s in statistics.items()}
+
+
+# the saved scaling parameters of the continuous columns of a source, if fitted for the current data file
+def saved_parameters(sourcefile, columns):
+    file_path = parameters_file(sourcefile)
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'r') as fp:
+        saved = json.load(fp)
+    if saved.get('signature') == helper.file_signature(source.data_file(sourcefile)) and \
+            sorted(saved.get('parameters', {})) == sorted(columns):
+        helper.debug("Using scaling parameters", file_path)
+        return saved['parameters']
+    helper.info("Scaling parameters", file_path, "are out of date")
+    return None
+
+
+# the scaling parameters of the continuous columns of a source, fitted and saved if missing or out of date; one run
+# fits them holding the download lock of the source while the others wait for them
+def load(sourcefile, columns, chunksize):
+    parameters = saved_parameters(sourcefile, columns)
+    if parameters is not None:
+        return parameters
+    with download.locked(sourcefile):
+        parameters = saved_parameters(sourcefile, columns)
+        if parameters is not None:
+            return parameters
+        file_path = parameters_file(sourcefile)
+        signature = helper.file_signature(source.data_file(sourcefile))
+        parameters = fit(sourcefile, columns, chunksize)
+        temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(temp_path, 'w') as fp:
+            json.dump({'signature': signature, 'parameters': parameters}, fp, indent=1)
+        os.replace(temp_path, file_path)
+    helper.info("Saved scaling parameters", file_path)
+    return parameters
+
+
+def transform(series, parameters, method):
+    values = numbers(series)
+    if parameters['count'] == 0:
+        return pd.Series(np.nan, index=series.index)
+    if method == 'zscore':
+        scaled = (values - parameters['mean']) / (parameters['std'] or 1.0)
+    elif method == 'minmax':
+        scaled = (values - parameters['min']) / ((parameters['max'] - parameters['min']) or 1.0)
+    elif method == 'log1p':
+        scaled = np.log1p(np.maximum(values - min(parameters['min'], 0.0), 0.0))
+    else:
+        scaled = (values - parameters['median']) / ((parameters['q3'] - parameters['q1']) or 1.0)
+    return pd.Series(scaled, index=series.index)
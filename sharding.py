@@ -0,0 +1,187 @@
+# local modules
+import helper
+import keygraph
+import region
+import source
+
+# other libraries
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+
+#########################
+#
+# SHARDED EXECUTION
+#
+# With --shards N, the rows of each source are partitioned into N shards by a hash of their key in the --shard-key
+# join-group (variation-id or gene-symbol), or by a hash of the chromosome of the variant for 'chromosome'. Each
+# shard is a separate run of main.py with --shard-index, reading only the rows of its shard from the sources with
+# the key, and all the rows of the sources without it (e.g. gene sources when sharding by variant), so the left joins
+# of each shard are complete. A shard writes its partial outputs and a manifest to its own directory under
+# --shard-dir.
+#
+# Running with --shards and without --shard-index runs every shard as a local process and then merges the partial
+# outputs. Shards can instead be run as separate jobs on machines sharing a filesystem, followed by one run with
+# --shard-merge. The merge concatenates the outputs of the sharded sources in shard order, takes the outputs of
+# sources without the key from the first shard, and adds one-hot columns missing from a shard as False, so the final
+# outputs are the same for the same number of shards wherever the shards ran.
+#
+#########################
+
+SHARD_KEYS = ['variation-id', 'gene-symbol', 'chromosome']
+MANIFEST_FILE = 'manifest.json'
+MERGE_CHUNK_SIZE = 100000
+
+
+def shard_path(args, index):
+    return os.path.join(args.shard_dir, "shard-{}-of-{}".format(index, args.shards))
+
+
+def part_file(args, output_file):
+    os.makedirs(shard_path(args, args.shard_index), exist_ok=True)
+    return os.path.join(shard_path(args, args.shard_index), os.path.basename(output_file))
+
+
+def text_part_file(args, source_name):
+    return part_file(args, "{}-template.txt".format(source_name))
+
+
+def shard_of(keys, shards):
+    values = np.asarray(keys.map(keygraph.key), dtype=object)
+    return pd.util.hash_array(values, categorize=False) % shards
+
+
+# rows of one shard, by the first column of the join-group of a source
+class ShardFilter:
+
+    def __init__(self, join_group, shards, index, description, shard_keys=None, located_keys=None):
+        self.join_group = join_group
+        self.shards = shards
+        self.index = index
+        self.description = description
+        # with 'chromosome', the variants located in the chromosomes of the shard and all located variants
+        self.shard_keys = shard_keys
+        self.located_keys = located_keys
+
+    def __repr__(self):
+        return "shard {} of {} by {}".format(self.index, self.shards, self.description)
+
+    def column(self, df, dic):
+        columns = [c for c in dic.loc[dic['join-group'] == self.join_group, 'column'] if c in df.columns]
+        return columns[0] if len(columns) > 0 else None
+
+    def applies(self, df, dic):
+        return self.column(df, dic) is not None
+
+    def keys(self, join_group, dic):
+        return None
+
+    def mask(self, df, dic=None):
+        column = self.column(df, dic)
+        if column is None:
+            return None
+        in_shard = shard_of(df[column], self.shards) == self.index
+        if self.shard_keys is not None:
+            # variants without a location are sharded by their VariationID
+            keys = df[column].map(keygraph.key)
+            in_shard = keys.isin(self.shard_keys).to_numpy() | (~keys.isin(self.located_keys).to_numpy() & in_shard)
+        return pd.Series(in_shard, index=df.index)
+
+
+def shard_filter(args, sources_path):
+    if args.shard_key != 'chromosome':
+        return ShardFilter(args.shard_key, args.shards, args.shard_index, args.shard_key)
+
+    # the chromosome of each variant from the region index, preferring the default assembly
+    index = region.load(source.get(sources_path, region.REGION_SOURCE), args.chunk_size)
+    chromosomes = {}
+    for name in sorted(index, key=lambda n: n.startswith(region.DEFAULT_ASSEMBLY + ':')):
+        if name.endswith(':id'):
+            chromosome = name.split(':')[1]
+            chromosomes.update((str(i), chromosome) for i in index[name].tolist())
+    keys = pd.Series(list(chromosomes.keys()), dtype=object)
+    in_shard = shard_of(pd.Series(list(chromosomes.values()), dtype=object), args.shards) == args.shard_index
+    helper.info("Shard", args.shard_index, "has", int(in_shard.sum()), "of", len(keys), "located variants")
+    return ShardFilter('variation-id', args.shards, args.shard_index, 'chromosome',
+                       shard_keys=set(keys[in_shard]), located_keys=set(keys))
+
+
+# files is a list of {'output': final file, 'part': partial file, 'kind': source, joined or text, 'source': name,
+# 'sharded': whether the part holds only the rows of the shard}
+def write_manifest(args, files):
+    manifest = {'shard': args.shard_index, 'shards': args.shards, 'shard_key': args.shard_key, 'files': files}
+    with open(os.path.join(shard_path(args, args.shard_index), MANIFEST_FILE), 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    helper.info("Completed shard", args.shard_index, "of", args.shards)
+
+
+# run every shard as a local process with the same arguments
+def run(args):
+    processes = []
+    for index in range(args.shards):
+        command = [sys.executable, sys.argv[0]] + sys.argv[1:] + ['--shard-index={}'.format(index)]
+        helper.info("Starting shard", index, "of", args.shards)
+        processes.append(subprocess.Popen(command))
+    failed = [index for index, p in enumerate(processes) if p.wait() != 0]
+    if len(failed) > 0:
+        raise helper.PipelineError("shards {} failed; see python.log.".format(failed))
+
+
+def read_manifests(args):
+    manifests = []
+    for index in range(args.shards):
+        manifest_file = os.path.join(shard_path(args, index), MANIFEST_FILE)
+        if not os.path.isfile(manifest_file):
+            raise helper.PipelineError("shard {} of {} has not completed; missing {}".format(index, args.shards,
+                                                                                             manifest_file))
+        with open(manifest_file, 'r') as fp:
+            manifests.append(json.load(fp))
+    return manifests
+
+
+# concatenate the CSV parts as text, adding columns missing from a part as False for one-hot columns or else empty
+def merge_csv(parts, output_file):
+    headers = [list(pd.read_csv(p, nrows=0).columns) for p in parts]
+    columns = list(dict.fromkeys(c for h in headers for c in h))
+    missing = set(c for c in columns if any(c not in h for h in headers))
+    flags = set(missing)
+    for p, header in zip(parts, headers):
+        present = [c for c in header if c in missing]
+        if len(present) > 0:
+            for chunk in pd.read_csv(p, usecols=present, dtype=str, keep_default_na=False, chunksize=MERGE_CHUNK_SIZE):
+                flags -= set(c for c in present if not chunk[c].isin(['True', 'False']).all())
+    pd.DataFrame(columns=columns).to_csv(output_file, index=False)
+    for p, header in zip(parts, headers):
+        fill = {c: ('False' if c in flags else '') for c in columns if c not in header}
+        for chunk in pd.read_csv(p, dtype=str, keep_default_na=False, chunksize=MERGE_CHUNK_SIZE):
+            chunk.assign(**fill)[columns].to_csv(output_file, mode='a', index=False, header=False)
+
+
+def merge_text(parts, output_file):
+    with open(output_file, 'w') as fp:
+        for p in parts:
+            with open(p, 'r') as part:
+                fp.write(part.read())
+
+
+# assemble the final outputs from the partial outputs of every shard, taking unsharded parts from the first shard
+def merge(args):
+    manifests = read_manifests(args)
+    merged = {}
+    for f in manifests[0]['files']:
+        shards = manifests if f['sharded'] else manifests[:1]
+        parts = [part['part'] for m in shards for part in m['files']
+                 if part['output'] == f['output'] and part['source'] == f['source']]
+        kind, source_parts = merged.setdefault(f['output'], (f['kind'], []))
+        source_parts.extend(parts)
+    for output, (kind, parts) in merged.items():
+        helper.info("Merging", len(parts), "shard parts into", output)
+        if kind == 'text':
+            # the text of each source in source order, with the text of a sharded source in shard order
+            merge_text(parts, output)
+        else:
+            merge_csv(parts, output)
+    helper.info("Merged", args.shards, "shards")
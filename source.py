@@ -2,8 +2,14 @@ import helper
 import yaml
 import os
 import pandas as pd
+from pandas.api.types import is_bool_dtype, is_extension_array_dtype, is_float_dtype, is_integer_dtype, \
+    is_numeric_dtype
+from pandas.api.types import union_categoricals
 
 sources = []
+# directory shared by runs holding the data files of each source in a directory named as the source directory, or None
+# to keep the data files in the source directories
+data_cache = None
 
 
 def count():
@@ -23,12 +29,12 @@ def source_list():
 
 
 def df():
-    dataframe = pd.DataFrame(columns=['name', 'suffix', 'path', 'url', 'download_file', 'file', 'gzip', 'header_row',
-                                      'skip_rows', 'delimiter', 'quoting', 'strip_hash', 'md5_url', 'md5_file',
-                                      'template', 'dictionary', 'mapping'])
+    dataframe = pd.DataFrame(columns=['name', 'suffix', 'path', 'data_path', 'url', 'download_file', 'file', 'gzip',
+                                      'header_row', 'skip_rows', 'delimiter', 'quoting', 'strip_hash', 'md5_url',
+                                      'md5_file', 'template', 'dictionary', 'mapping'])
     for s in sources:
         dataframe.loc[len(dataframe)] = [
-            s.name, s.suffix, s.path, s.url, s.download_file,
+            s.name, s.suffix, s.path, s.data_path, s.url, s.download_file,
             s.file, s.gzip, s.header_row,
             s.skip_rows, s.delimiter, s.quoting,
             s.strip_hash, s.md5_url, s.md5_file,
@@ -39,7 +45,24 @@ def df():
     return dataframe
 
 
+# configuration of a single source by name, without adding it to the list of selected sources
+def get(sources_path, name):
+    configfile = str(os.path.join(sources_path, name, 'config.yml'))
+    s = Source(configfile, register=False)
+    return pd.Series({'name': s.name, 'suffix': s.suffix, 'path': s.path, 'data_path': s.data_path, 'url': s.url,
+                      'download_file': s.download_file, 'file': s.file, 'gzip': s.gzip, 'header_row': s.header_row,
+                      'skip_rows': s.skip_rows, 'delimiter': s.delimiter, 'quoting': s.quoting,
+                      'strip_hash': s.strip_hash, 'md5_url': s.md5_url, 'md5_file': s.md5_file,
+                      'template': s.template, 'dictionary': s.dictionary, 'mapping': s.mapping})
+
+
+# names of all the sources configured in the sources directory
+def names(sources_path):
+    return [f for f in sorted(os.listdir(sources_path)) if os.path.isfile(os.path.join(sources_path, f, 'config.yml'))]
+
+
 def load(sources_path, selected_sources):
+    sources.clear()
     for root, dirs, files in os.walk(sources_path):
         for f in files:
             if f == 'config.yml':
@@ -53,7 +76,7 @@ def load(sources_path, selected_sources):
 class Source:
 
     # keep a list of sources
-    def __init__(self, configfile):
+    def __init__(self, configfile, register=True):
         path = configfile.replace('config.yml', '')[:-1]  # path is everything but trailing /config.yml
         with (open(configfile, "r") as stream):
             try:
@@ -64,6 +87,7 @@ class Source:
                 self.name = config.get('name')
                 self.suffix = config.get('suffix')
                 self.path = path
+                self.data_path = os.path.join(data_cache, os.path.basename(path)) if data_cache else path
                 self.url = config.get('url')
                 self.download_file = config.get('download_file')
                 self.file = config.get('file')
@@ -80,8 +104,142 @@ class Source:
                 self.mapping = 'mapping.csv'
 
             except yaml.YAMLError as exc:
-                helper.critical(exc)
-                exit(-1)
+                raise helper.PipelineError("Invalid configuration {}: {}".format(configfile, exc))
 
         # add new source to the shared class list
-        sources.append(self)
+        if register:
+            sources.append(self)
+
+
+# the data file of a source, in the data cache if configured
+def data_file(sourcefile):
+    return str(os.path.join(sourcefile.get('data_path'), sourcefile.get('file')))
+
+
+# read a source data file in chunks of rows, stripping hashes and spaces from column labels if configured
+def read(sourcefile, chunksize, columns=None):
+    sourcefile_file = data_file(sourcefile)
+    usecols = None
+    if columns is not None:
+        usecols = lambda column: (column.strip(' #') if sourcefile.get('strip_hash') == 1 else column) in columns
+    reader = pd.read_csv(sourcefile_file,
+                         usecols=usecols,
+                         header=sourcefile.get('header_row'), sep=helper.get_separator(sourcefile.get('delimiter')),
+                         skiprows=helper.skip_array(sourcefile.get('skip_rows')), engine='python',
+                         quoting=sourcefile.get('quoting'),
+                         chunksize=chunksize,
+                         on_bad_lines='warn')
+    with reader:
+        for chunk in reader:
+            if sourcefile.get('strip_hash') == 1:
+                chunk = chunk.rename(columns=lambda column: column.strip(' #'))
+            yield chunk
+
+
+# rows created from the rows of a chunk with lists of values in any of the columns, one row per value
+def expand(chunk, columns):
+    expanded = []
+    for column in columns:
+        helper.debug("expanding column", column)
+        expanded.append(helper.expand_rows(pd.concat([chunk] + expanded), column))
+    return expanded
+
+
+# combine chunks read separately into one dataframe
+def concat(chunks, columns=None, compact=False):
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    # a column parsed as numbers in one chunk and text in another is text in the whole file
+    mixed = set()
+    for column in chunks[0].columns:
+        kinds = set(is_numeric_dtype(chunk[column].dtype) for chunk in chunks
+                    if column in chunk and chunk[column].notna().any())
+        if len(kinds) > 1:
+            mixed.add(column)
+    # categories of a compact column are the union of the categories of each chunk
+    for column in chunks[0].columns:
+        if all(isinstance(chunk[column].dtype, pd.CategoricalDtype) for chunk in chunks if column in chunk):
+            categories = union_categoricals([chunk[column] for chunk in chunks if column in chunk],
+                                            sort_categories=True).categories
+            chunks = [chunk.assign(**{column: chunk[column].cat.set_categories(categories)}) for chunk in chunks]
+    df = pd.concat(chunks, ignore_index=True)
+    for column in mixed:
+        df[column] = df[column].map(lambda v: v if pd.isna(v) else str(v))
+        if compact:
+            df[column] = df[column].astype(COMPACT_STRING)
+    return df
+
+
+#########################
+#
+# COMPACT MEMORY MODE
+#
+# With --compact, text columns are held as pyarrow backed strings, columns with few distinct values as categoricals
+# and numbers in the smallest numeric type that holds them exactly. Integer and boolean columns use the nullable
+# pandas types so missing values after a left join do not turn them into floats or objects. The output files are
+# written as without --compact: an integer column with missing values is written as floats (e.g. 10000.0).
+#
+#########################
+
+COMPACT_STRING = 'string[pyarrow]'
+# columns with at most this share of distinct values in the first chunk read are held as categoricals
+CATEGORY_RATIO = 0.05
+
+
+# columns to hold as categoricals: configured for category, onehot or map encodings, or with few distinct values
+def categorical_columns(dic, chunk):
+    configured = dic.loc[(dic['category'] == True) | (dic['onehot'] == True) | (dic['map'] == True), 'column']
+    columns = set(configured)
+    for column in chunk.columns[chunk.dtypes == object]:
+        if chunk[column].nunique() <= max(1, CATEGORY_RATIO * len(chunk)):
+            columns.add(column)
+    # join-groups and lists of values to expand keep their text values
+    excluded = dic.loc[dic['join-group'].notnull() | (dic['expand'] == True), 'column']
+    return columns - set(excluded)
+
+
+def compact(df, categorical=()):
+    for column in df.columns:
+        series = df[column]
+        if column in categorical and not is_numeric_dtype(series.dtype):
+            df[column] = series.astype('category')
+        elif is_bool_dtype(series.dtype):
+            df[column] = series.astype('boolean')
+        elif is_integer_dtype(series.dtype):
+            df[column] = compact_integer(series)
+        elif is_float_dtype(series.dtype):
+            df[column] = compact_float(series)
+        elif series.dtype == object:
+            df[column] = series.astype(COMPACT_STRING)
+    return df
+
+
+def compact_integer(series):
+    values = pd.to_numeric(series.dropna(), downcast='integer')
+    return series.astype(values.dtype.name.capitalize() if len(values) > 0 else 'Int8')
+
+
+# float32 if it holds every value exactly, else float64
+def compact_float(series):
+    values = pd.to_numeric(series, downcast='float')
+    if values.dtype != series.dtype and not (values.astype(series.dtype) == series)[series.notna()].all():
+        return series
+    return values
+
+
+# nullable integer columns with missing values, which are floats without --compact
+def missing_integer_columns(df):
+    return [c for c in df.columns if is_integer_dtype(df[c].dtype) and is_extension_array_dtype(df[c].dtype)
+            and df[c].hasnans]
+
+
+# the rows as written to an output file, with the nullable integer columns with missing values (or float_columns)
+# as floats
+def as_written(df, float_columns=None):
+    if float_columns is None:
+        float_columns = missing_integer_columns(df)
+    float_columns = [c for c in float_columns if c in df and is_extension_array_dtype(df[c].dtype)]
+    if len(float_columns) == 0:
+        return df
+    return df.astype({c: 'float64' for c in float_columns})
+
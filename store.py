@@ -0,0 +1,140 @@
+# local modules
+import download
+import helper
+import source
+
+# other libraries
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import is_bool_dtype, is_float_dtype, is_integer_dtype
+
+#########################
+#
+# SHARED SOURCE STORE
+#
+# With --shared-store, a source is parsed from its data file once and saved next to it as an Arrow IPC file. Every
+# process then memory maps the file read-only and reads its rows in chunks straight from the mapped columns, so
+# parallel main.py workers share the one copy of each source held in the operating system page cache, and only the
+# rows left after filtering are copied into each process.
+#
+# Each column has one type for the whole file, the type the column has after the chunks parsed from the data file are
+# combined: numbers with missing values are floats, flags with missing values are nullable flags, and a column parsed
+# as numbers in one chunk and text in another is text. The store is rebuilt when the data file or its format changes.
+#
+#########################
+
+STORE_SUFFIX = '.arrow'
+SIGNATURE_KEY = b'signature'
+VERSION_KEY = b'version'
+# format of the store, rebuilt when it changes
+STORE_VERSION = 2
+
+
+def store_file(sourcefile):
+    return source.data_file(sourcefile) + STORE_SUFFIX
+
+
+def kind(series):
+    if not series.notna().any():
+        return None
+    # flags with missing values are parsed as objects
+    if is_bool_dtype(series.dtype) or series.dropna().map(type).eq(bool).all():
+        return 'bool'
+    if is_integer_dtype(series.dtype):
+        return 'int'
+    if is_float_dtype(series.dtype):
+        return 'float'
+    return 'text'
+
+
+# arrow type of a column from the kinds of values parsed in each chunk
+def column_type(kinds):
+    kinds.discard(None)
+    if len(kinds) == 0:
+        # no values in any chunk, parsed as missing numbers
+        return pa.float64()
+    if kinds == {'bool'}:
+        return pa.bool_()
+    if kinds == {'int'}:
+        return pa.int64()
+    if kinds <= {'int', 'float'}:
+        return pa.float64()
+    return pa.string()
+
+
+def as_column(series, arrow_type):
+    if arrow_type == pa.string():
+        series = series.map(lambda v: None if pd.isna(v) else str(v))
+    return pa.array(series, type=arrow_type, from_pandas=True)
+
+
+def build(sourcefile, chunksize):
+    helper.info("Building shared store for", sourcefile.get('name'))
+    data_file = source.data_file(sourcefile)
+    signature = helper.file_signature(data_file)
+
+    # first pass finds the type of each column over the whole file, second pass writes the columns
+    kinds = {}
+    for chunk in source.read(sourcefile, chunksize):
+        for column in chunk.columns:
+            kinds.setdefault(column, set()).add(kind(chunk[column]))
+    schema = pa.schema([(column, column_type(k)) for column, k in kinds.items()],
+                       metadata={SIGNATURE_KEY: signature.encode(), VERSION_KEY: str(STORE_VERSION).encode()})
+
+    # write to a temporary file and rename, so other processes never map a partly written store
+    file_path = store_file(sourcefile)
+    temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    rows = 0
+    with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for chunk in source.read(sourcefile, chunksize):
+            arrays = [as_column(chunk[f.name], f.type) for f in schema]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            rows += len(chunk)
+    os.replace(temp_path, file_path)
+    helper.info("Saved shared store", file_path, "with", rows, "rows")
+
+
+# the mapped store of a source, if saved for the current data file
+def stored(sourcefile):
+    file_path = store_file(sourcefile)
+    if not os.path.isfile(file_path):
+        return None
+    table = pa.ipc.open_file(pa.memory_map(file_path, 'r')).read_all()
+    metadata = table.schema.metadata
+    if metadata.get(SIGNATURE_KEY, b'').decode() != helper.file_signature(source.data_file(sourcefile)) or \
+            metadata.get(VERSION_KEY, b'').decode() != str(STORE_VERSION):
+        helper.info("Shared store", file_path, "is out of date")
+        return None
+    helper.debug("Using shared store", file_path)
+    return table
+
+
+# memory map the store of a source read-only, building it first if missing or out of date with the data file; one run
+# builds it holding the download lock of the source while the others wait for it
+def load(sourcefile, chunksize):
+    table = stored(sourcefile)
+    if table is not None:
+        return table
+    with download.locked(sourcefile):
+        table = stored(sourcefile)
+        if table is None:
+            build(sourcefile, chunksize)
+            table = stored(sourcefile)
+    return table
+
+
+# read a source from its store in chunks of rows, like source.read
+def read(sourcefile, chunksize, columns=None):
+    table = load(sourcefile, chunksize)
+    if columns is not None:
+        table = table.select([c for c in table.column_names if c in columns])
+    # an empty source is one chunk without rows, as when parsed from the data file
+    for offset in range(0, max(table.num_rows, 1), chunksize):
+        chunk = table.slice(offset, chunksize).to_pandas()
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        # missing text values are NaN, as when parsed from the data file
+        for column in chunk.columns[chunk.dtypes == object]:
+            chunk[column] = chunk[column].where(chunk[column].notna(), np.nan)
+        yield chunk
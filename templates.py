@@ -0,0 +1,295 @@
+# local modules
+import helper
+
+# other libraries
+import ast
+import copy
+import hashlib
+import numpy as np
+import pandas as pd
+from genshi.template.base import EXPR, SUB, TEXT
+from genshi.template.directives import ChooseDirective, IfDirective, OtherwiseDirective, WhenDirective, WithDirective
+
+#########################
+#
+# TEMPLATE ENGINES
+#
+# The template of a source in config.yml is a Genshi text template rendered for each row, with the row as 'dict'
+# (e.g. ${dict.GeneSymbol} or ${dict['GENE SYMBOL']}). With --template-engine=genshi each row is rendered by Genshi
+# from a pandas Series of the row. With --template-engine=compiled (the default) the template parsed by Genshi is
+# compiled once into a Python function of a tuple of the row values: the text is appended as is, each dict.<column>
+# and dict['<column>'] is read from the tuple by the position of the column, and the with, choose, when, otherwise
+# and if directives become Python statements, so the text is the same as Genshi renders. A template with other
+# directives is rendered by Genshi.
+#
+# Rows often differ only in columns the template does not read (e.g. the GRCh37 and GRCh38 rows of a variant in the
+# variant summary, or the rows of a source repeated by --expand), so the values of the columns read by the template
+# are hashed for each row and each distinct combination is rendered once, its text shared by the rows with it. With
+# --template-dedup, a text already written to --template-output is not written again.
+#
+# --template-check renders the template of each source with both engines for the rows of its data file passing the
+# filters, with Genshi rendering every row, and reports the rows rendered differently.
+#
+#########################
+
+ENGINES = ['genshi', 'compiled']
+# name of the row in the templates
+RECORD = 'dict'
+# differences shown per source by --template-check
+CHECK_EXAMPLES = 3
+
+
+class UnsupportedTemplate(Exception):
+    pass
+
+
+# text of the value of an expression, as Genshi outputs it
+def text(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if hasattr(value, '__iter__'):
+        return ''.join(str(v) for v in value)
+    return str(value)
+
+
+# the target of an assignment to names, a name or nested tuples of names
+def target(names):
+    if isinstance(names, str):
+        return names
+    return "({},)".format(", ".join(target(n) for n in names))
+
+
+def missing(column):
+    raise KeyError("{} is not a column of the rows of the template".format(column))
+
+
+# replaces dict.<column> and dict['<column>'] with the value at the position of the column in the row
+class RowAccess(ast.NodeTransformer):
+
+    def __init__(self, columns):
+        self.positions = {c: i for i, c in enumerate(columns)}
+        self.referenced = set()
+
+    def column(self, node, column):
+        self.referenced.add(column)
+        if column not in self.positions:
+            return ast.copy_location(ast.Call(func=ast.Name(id='_missing', ctx=ast.Load()),
+                                              args=[ast.Constant(column)], keywords=[]), node)
+        return ast.copy_location(ast.Subscript(value=ast.Name(id='_row', ctx=ast.Load()),
+                                               slice=ast.Constant(self.positions[column]), ctx=ast.Load()), node)
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == RECORD:
+            return self.column(node, node.attr)
+        return self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == RECORD and isinstance(node.slice, ast.Constant):
+            return self.column(node, node.slice.value)
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        # the row itself, e.g. dict.get('X'), is only available to Genshi
+        if node.id == RECORD:
+            raise UnsupportedTemplate("uses {} other than to read a column".format(RECORD))
+        return node
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) and \
+                node.func.value.id == RECORD:
+            raise UnsupportedTemplate("calls {}.{}".format(RECORD, node.func.attr))
+        return self.generic_visit(node)
+
+
+class Compiler:
+
+    def __init__(self, columns):
+        self.access = RowAccess(columns)
+        self.lines = []
+        self.chooses = []
+        self.count = 0
+
+    # the Python source of an expression with the columns read from the row; the tree of an expression without source
+    # (the vars of a with) is Genshi's own, rendering the template, so a copy of it is rewritten
+    def expression(self, expr):
+        tree = ast.parse(expr.source, mode='eval') if expr.source != '?' else copy.deepcopy(expr.ast)
+        return ast.unparse(self.access.visit(tree))
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def stream(self, stream, indent):
+        start = len(self.lines)
+        for kind, data, pos in stream:
+            if kind is TEXT:
+                self.emit(indent, "_append({!r})".format(data))
+            elif kind is EXPR:
+                self.emit(indent, "_append(_text({}))".format(self.expression(data)))
+            elif kind is SUB:
+                self.directives(data[0], data[1], indent)
+            else:
+                raise UnsupportedTemplate("has {} events".format(kind))
+        if len(self.lines) == start:
+            self.emit(indent, "pass")
+
+    # the directives applied to a stream, the first outermost
+    def directives(self, directives, stream, indent):
+        if len(directives) == 0:
+            return self.stream(stream, indent)
+        directive, rest = directives[0], directives[1:]
+        self.count += 1
+        if isinstance(directive, WithDirective):
+            for targets, expr in directive.vars:
+                value = "_with{}".format(self.count)
+                self.emit(indent, "{} = {}".format(value, self.expression(expr)))
+                for assign in targets:
+                    # the names assigned, a name or nested tuples of names
+                    self.emit(indent, "{} = {}".format(target(assign.__defaults__[0]), value))
+            self.directives(rest, stream, indent)
+        elif isinstance(directive, ChooseDirective):
+            choose = "_choose{}".format(self.count)
+            self.emit(indent, "{} = False".format(choose))
+            if directive.expr is not None:
+                self.emit(indent, "{}_value = {}".format(choose, self.expression(directive.expr)))
+            self.chooses.append((choose, directive.expr is not None))
+            self.directives(rest, stream, indent)
+            self.chooses.pop()
+        elif isinstance(directive, WhenDirective):
+            if len(self.chooses) == 0:
+                raise UnsupportedTemplate("has a when outside a choose")
+            choose, has_value = self.chooses[-1]
+            if has_value and directive.expr is not None:
+                test = "{}_value == ({})".format(choose, self.expression(directive.expr))
+            elif has_value:
+                test = "{}_value".format(choose)
+            elif directive.expr is not None:
+                test = self.expression(directive.expr)
+            else:
+                raise UnsupportedTemplate("has a when without a test")
+            self.emit(indent, "if not {}:".format(choose))
+            self.emit(indent + 1, "{} = bool({})".format(choose, test))
+            self.emit(indent + 1, "if {}:".format(choose))
+            self.directives(rest, stream, indent + 2)
+        elif isinstance(directive, OtherwiseDirective):
+            if len(self.chooses) == 0:
+                raise UnsupportedTemplate("has an otherwise outside a choose")
+            choose = self.chooses[-1][0]
+            self.emit(indent, "if not {}:".format(choose))
+            self.emit(indent + 1, "{} = True".format(choose))
+            self.directives(rest, stream, indent + 1)
+        elif isinstance(directive, IfDirective):
+            self.emit(indent, "if {}:".format(self.expression(directive.expr)))
+            self.directives(rest, stream, indent + 1)
+        else:
+            raise UnsupportedTemplate("has a {} directive".format(type(directive).__name__))
+
+
+# a template of a source, rendering rows with the engine
+class Template:
+
+    def __init__(self, template_text, engine='compiled', memoize=True):
+        self.text = template_text
+        self.genshi = helper.get_genshi_template(template_text)
+        self.engine = engine
+        self.memoize = memoize
+        # compiled functions by the columns of the rows
+        self.functions = {}
+        # the columns read by the template, or None if it is only rendered by Genshi
+        self.columns = None
+        try:
+            compiler = Compiler(())
+            compiler.stream(self.genshi.stream, 1)
+            self.columns = sorted(compiler.access.referenced)
+        except UnsupportedTemplate as exc:
+            if engine == 'compiled':
+                helper.warning("Rendering a template with genshi, as it", exc)
+            self.engine = 'genshi'
+
+    # the function rendering a tuple of the values of the columns
+    def compile(self, columns):
+        columns = tuple(columns)
+        if columns not in self.functions:
+            compiler = Compiler(columns)
+            compiler.emit(0, "def render(_row):")
+            compiler.emit(1, "_out = []")
+            compiler.emit(1, "_append = _out.append")
+            compiler.stream(self.genshi.stream, 1)
+            compiler.emit(1, "return ''.join(_out).strip()")
+            namespace = {'_text': text, '_missing': missing}
+            exec(compile("\n".join(compiler.lines), '<template>', 'exec'), namespace)
+            self.functions[columns] = namespace['render']
+        return self.functions[columns]
+
+    # the first row of each distinct combination of values of the columns read by the template, and the position of
+    # the combination of each row; None when every row is distinct
+    def distinct(self, df):
+        columns = [c for c in self.columns if c in df]
+        if len(columns) == 0:
+            keys = np.zeros(len(df), dtype=np.uint64)
+        else:
+            # values of other types hashing the same (None, NaN and pd.NA, or 42 and '42') are rendered differently,
+            # so the types of the values of text columns are hashed too
+            values = df[columns].assign(**{"{}\0type".format(c): df[c].map(lambda v: type(v).__name__)
+                                           for c in columns if df[c].dtype == object})
+            try:
+                keys = pd.util.hash_pandas_object(values, index=False).to_numpy()
+            except TypeError:
+                # values that cannot be hashed, e.g. lists
+                return None
+        unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        if len(unique_keys) == len(df):
+            return None
+        return first, inverse
+
+    # the text of each row of df, as a list; rows with the same values in the columns read by the template are
+    # rendered once
+    def render(self, df):
+        if len(df) == 0:
+            return []
+        groups = self.distinct(df) if self.memoize and self.columns is not None else None
+        if groups is not None:
+            helper.debug("Rendering", len(groups[0]), "distinct rows of", len(df))
+            texts = self.render_rows(df.iloc[groups[0]])
+            return [texts[i] for i in groups[1]]
+        return self.render_rows(df)
+
+    def render_rows(self, df):
+        values = df.values
+        if self.engine == 'compiled' and values.dtype.kind not in 'mM':
+            function = self.compile(df.columns)
+            # the values of each row as pandas gives them to Genshi in a Series of the row
+            rows = values.tolist() if values.dtype == object else map(tuple, values)
+            return [function(row) for row in rows]
+        return list(df.apply(lambda record: helper.apply_genshi_template(self.genshi, record), axis=1))
+
+
+# compact rows as given to a template, with the missing values of compact columns (pd.NA) rendered the same as NaN
+def compact_rows(df):
+    return df.astype(object).where(df.notna(), np.nan)
+
+
+# the texts not seen before, adding them to seen, a set of the digests of the texts
+def unseen(texts, seen):
+    for t in texts:
+        digest = hashlib.blake2b(t.encode(), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            yield t
+
+
+# render the template of a source with both engines; returns the number of rows rendered differently
+def check(name, template_text, df):
+    genshi = Template(template_text, 'genshi', memoize=False).render(df)
+    compiled_template = Template(template_text, 'compiled')
+    compiled = compiled_template.render(df)
+    if compiled_template.engine != 'compiled':
+        print(name, ": template not compiled, rendered with genshi")
+        return 0
+    differences = [i for i, (g, c) in enumerate(zip(genshi, compiled)) if g != c]
+    print(name, ":", len(df), "rows,", len(differences), "rendered differently")
+    for i in differences[:CHECK_EXAMPLES]:
+        print("  row", i, "genshi:  ", repr(genshi[i]))
+        print("  row", i, "compiled:", repr(compiled[i]))
+    return len(differences)
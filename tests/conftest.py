@@ -0,0 +1,5 @@
+# the modules of the pipeline are imported from the top directory of the repository, as by main.py
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,53 @@
+import os
+
+import pandas as pd
+import pytest
+
+import aggregates
+import helper
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+def submission_dictionary():
+    return pd.read_csv(os.path.join(SOURCES_PATH, 'clinvar-submission-summary', 'dictionary.csv'))
+
+
+def submissions():
+    return pd.DataFrame({
+        'VariationID': [1, 1, 2, 2, 3, 3, 4, 4, 5],
+        'ClinicalSignificance': ['Pathogenic', 'Likely pathogenic', 'Pathogenic', 'Benign', 'Likely benign',
+                                 'Uncertain significance', 'Likely pathogenic', 'Likely benign', 'Pathogenic'],
+        'DateLastEvaluated': ['Jan 02, 2020', 'Mar 04, 2021', '-', 'May 06, 2019', '-', '-', 'Jul 08, 2018', '-',
+                              'Sep 10, 2022'],
+        'Submitter': ['A', 'B', 'A', 'A', 'C', 'D', 'A', 'B', 'A'],
+        'CollectionMethod': ['clinical testing'] * 9})
+
+
+def aggregated(dic, chunks):
+    aggregation = aggregates.Aggregation(dic, 'VariationID')
+    for chunk in chunks:
+        aggregation.add(chunk)
+    return aggregation.frame().set_index('VariationID')
+
+
+def test_clinical_significance_conflict():
+    df = aggregated(submission_dictionary(), [submissions().iloc[:3], submissions().iloc[3:]])
+    # P + LP and LB + VUS are not conflicts, P + B and LP + LB are
+    assert df['agg_ClinicalSignificance_conflict'].to_dict() == {1: 0, 2: 1, 3: 0, 4: 1, 5: 0}
+    assert df['agg_rows'].to_dict() == {1: 2, 2: 2, 3: 2, 4: 2, 5: 1}
+    assert df['agg_Submitter_distinct'].to_dict() == {1: 2, 2: 1, 3: 2, 4: 2, 5: 1}
+    assert df['agg_ClinicalSignificance_Pathogenic'].to_dict() == {1: 1, 2: 1, 3: 0, 4: 0, 5: 1}
+    assert df['agg_DateLastEvaluated_newest'].to_dict() == {1: '2021-03-04', 2: '2019-05-06', 3: '-',
+                                                            4: '2018-07-08', 5: '2022-09-10'}
+
+
+def test_conflict_without_groups():
+    dic = submission_dictionary().assign(aggregate=lambda d: d['column'].map({'ClinicalSignificance': 'conflict'}))
+    df = aggregated(dic, [submissions()])
+    assert df['agg_ClinicalSignificance_conflict'].to_dict() == {1: 1, 2: 1, 3: 1, 4: 1, 5: 0}
+
+
+def test_conflict_needs_two_groups():
+    with pytest.raises(helper.PipelineError):
+        aggregates.conflict_groups('Pathogenic+Likely pathogenic')
@@ -0,0 +1,9 @@
+import arguments
+import cache
+
+
+def test_output_options_change_key():
+    default = cache.normalize(arguments.options())
+    assert cache.normalize(arguments.options(compact=True)) != default
+    assert cache.normalize(arguments.options(template_engine='genshi')) != default
+    assert cache.normalize(arguments.options(writers=0)) == default
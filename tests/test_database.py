@@ -0,0 +1,91 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import database
+import filters
+import helper
+import source
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+def dictionary():
+    return pd.DataFrame({'column': ['clinvar_variation_id', 'vrs_2_0_alpha_id', 'genes', 'score', 'flag'],
+                         'join-group': ['variation-id', None, 'gene-symbol', None, None],
+                         'expand': [False, False, True, False, False]})
+
+
+def rows():
+    return pd.DataFrame({'clinvar_variation_id': [1, 2, 3, 2, 4],
+                         'vrs_2_0_alpha_id': ['ga4gh:VA.1', 'ga4gh:VA.2', None, 'ga4gh:VA.2b', 'ga4gh:VA.4'],
+                         'genes': ['MYH7', 'TTN', 'MYH7,TTN', None, 'BRCA1'],
+                         'score': [1.5, None, 3.0, 4.0, 5.5],
+                         'flag': [True, False, None, True, False]})
+
+
+# the vrs source with a data file of rows and the columns of dictionary
+@pytest.fixture
+def sourcefile(tmp_path):
+    shutil.copytree(os.path.join(SOURCES_PATH, 'vrs'), tmp_path / 'vrs', ignore=shutil.ignore_patterns('__pycache__'))
+    sourcefile = source.get(str(tmp_path), 'vrs')
+    rows().to_csv(source.data_file(sourcefile), index=False)
+    return sourcefile
+
+
+def build(tmp_path, sourcefile):
+    db_file = str(tmp_path / 'release.sqlite')
+    return db_file, database.build(db_file, pd.DataFrame([sourcefile]), {'vrs': dictionary()}, 2)
+
+
+def read(db_file, sourcefile, row_filters=(), expand_columns=()):
+    return pd.concat(database.read(db_file, sourcefile, 2, row_filters, dictionary(), expand_columns))
+
+
+def test_read_equals_the_data_file(tmp_path, sourcefile):
+    db_file, loaded = build(tmp_path, sourcefile)
+    assert loaded == 1
+    pd.testing.assert_frame_equal(read(db_file, sourcefile), pd.concat(source.read(sourcefile, 100)),
+                                  check_dtype=False, check_index_type=False)
+
+
+def test_key_condition_reads_only_the_rows_of_the_keys(tmp_path, sourcefile):
+    db_file, loaded = build(tmp_path, sourcefile)
+    variant = filters.join_group_filter('variation-id', ['2', '4'])
+    condition, parameters = database.key_condition([variant], dictionary(), list(rows().columns), [])
+    assert condition == '("clinvar_variation_id" IN (SELECT value FROM json_each(?)))'
+    df = read(db_file, sourcefile, [variant])
+    # the rows keep their positions in the data file
+    assert df.index.tolist() == [1, 3, 4]
+    assert df['vrs_2_0_alpha_id'].tolist() == ['ga4gh:VA.2', 'ga4gh:VA.2b', 'ga4gh:VA.4']
+    # filters without keys read every row
+    assert database.key_condition([filters.Filter("score > 2")], dictionary(), list(rows().columns), []) == \
+        (None, [])
+
+
+def test_key_condition_of_an_expand_column(tmp_path, sourcefile):
+    db_file, loaded = build(tmp_path, sourcefile)
+    gene = filters.join_group_filter('gene-symbol', ['TTN'])
+    assert read(db_file, sourcefile, [gene])['genes'].tolist() == ['TTN']
+    # the lists of an expand column are read, to match once expanded
+    condition, parameters = database.key_condition([gene], dictionary(), list(rows().columns), ['genes'])
+    assert "instr(\"genes\", ',') > 0" in condition
+    assert read(db_file, sourcefile, [gene], ['genes'])['genes'].tolist() == ['TTN', 'MYH7,TTN']
+
+
+def test_unchanged_release_is_not_loaded_again(tmp_path, sourcefile):
+    db_file, loaded = build(tmp_path, sourcefile)
+    assert build(tmp_path, sourcefile)[1] == 0
+    pd.concat([rows(), rows().iloc[:1]]).to_csv(source.data_file(sourcefile), index=False)
+    assert build(tmp_path, sourcefile)[1] == 1
+    assert len(read(db_file, sourcefile)) == 6
+    connection = database.connect(db_file)
+    assert database.release(connection, 'vrs')['rows'] == 6
+    connection.close()
+
+
+def test_read_without_the_source(tmp_path, sourcefile):
+    with pytest.raises(helper.PipelineError, match="no database"):
+        read(str(tmp_path / 'missing.sqlite'), sourcefile)
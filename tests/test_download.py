@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+import download
+import helper
+
+
+# a local server of /<name> files, answering 503 to the first request of /flaky-* files and 404 to /missing-* files,
+# and closing /truncated-* files before their end, recording the most requests served at once
+class Server(ThreadingHTTPServer):
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+        self.requests = {}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests[self.path] = server.requests.get(self.path, 0) + 1
+            count = server.requests[self.path]
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        try:
+            time.sleep(0.1)
+            if self.path.startswith('/missing') or (self.path.startswith('/flaky') and count == 1):
+                self.send_response(404 if self.path.startswith('/missing') else 503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = "data of {}\n".format(self.path).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body) * (10 if self.path.startswith('/truncated') else 1)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(download, 'BACKOFF_SECONDS', 0)
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def sources(server, tmp_path, names):
+    return pd.DataFrame([{'name': name, 'file': name + '.txt', 'data_path': str(tmp_path / name),
+                          'url': "http://127.0.0.1:{}/{}".format(server.server_port, name)} for name in names])
+
+
+def part_files(tmp_path):
+    return [f for root, dirs, files in os.walk(tmp_path) for f in files if f.endswith('.part')]
+
+
+def test_retry_on_503(server, tmp_path):
+    download.all_files(sources(server, tmp_path, ['flaky-a']), False)
+    with open(tmp_path / 'flaky-a' / 'flaky-a.txt') as fp:
+        assert fp.read() == "data of /flaky-a\n"
+    assert server.requests['/flaky-a'] == 2
+    assert download.manifest({'data_path': str(tmp_path / 'flaky-a')})['file'] == 'flaky-a.txt'
+    assert part_files(tmp_path) == []
+
+
+def test_connections_per_host(server, tmp_path):
+    names = ["file-{}".format(i) for i in range(6)]
+    download.all_files(sources(server, tmp_path, names), False, connections_per_host=2)
+    assert all(os.path.isfile(tmp_path / name / (name + '.txt')) for name in names)
+    assert server.most_active == 2
+
+
+def test_failed_download_leaves_no_part_file(server, tmp_path):
+    with pytest.raises(helper.PipelineError, match='missing-a') as failed:
+        download.all_files(sources(server, tmp_path, ['missing-a', 'truncated-a', 'file-a']), False, retries=1)
+    assert 'truncated-a' in str(failed.value)
+    # not found is not retried, a truncated file is
+    assert server.requests['/missing-a'] == 1
+    assert server.requests['/truncated-a'] == 2
+    assert not os.path.isfile(tmp_path / 'missing-a' / 'missing-a.txt')
+    assert not os.path.isfile(tmp_path / 'truncated-a' / 'truncated-a.txt')
+    assert part_files(tmp_path) == []
+
+
+def test_download_in_running_event_loop(server, tmp_path):
+    async def run():
+        download.all_files(sources(server, tmp_path, ['file-a']), False)
+    asyncio.run(run())
+    assert os.path.isfile(tmp_path / 'file-a' / 'file-a.txt')
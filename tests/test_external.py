@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import external
+import helper
+import planner
+import source
+
+
+# variants with 0 to 4 submissions each, and the genes of some of them; the submission scores are integers, missing in
+# the joined rows of variants without submissions
+def data():
+    rng = np.random.default_rng(8)
+    variants = pd.DataFrame({'VariationID': np.arange(1, 301), 'GeneSymbol': rng.choice(['MYH7', 'TTN', 'BRCA1'], 300),
+                             'Name': ["variant {}".format(i) for i in range(1, 301)]})
+    submission_ids = np.repeat(variants['VariationID'], rng.integers(0, 5, 300)).to_numpy()
+    submissions = pd.DataFrame({'VariationID': rng.permutation(submission_ids),
+                                'Submitter': rng.choice(['A', 'B', 'C'], len(submission_ids)),
+                                'Score': rng.integers(0, 10, len(submission_ids))})
+    genes = pd.DataFrame({'gene': ['MYH7', 'TTN'], 'disease': ['cardiomyopathy', 'myopathy']})
+    return {'variants': variants, 'submissions': submissions, 'genes': genes}
+
+
+def join_plan(data, aggregate=False):
+    dic_df = pd.DataFrame({'name': ['variants', 'variants', 'submissions', 'genes'],
+                           'column': ['VariationID', 'GeneSymbol', 'VariationID', 'gene'],
+                           'join-group': ['variation-id', 'gene-symbol', 'variation-id', 'gene-symbol']})
+    dic_df['precedence'] = dic_df['join-group'].map(helper.get_join_precedence)
+    suffixes = {'variants': '-variant', 'submissions': '-submission', 'genes': '-gene'}
+    return planner.plan(['variants', 'submissions', 'genes'], dic_df, data, suffixes, None, aggregate)
+
+
+def in_memory(tmp_path, data, aggregate=False):
+    output_file = str(tmp_path / 'in-memory.csv')
+    source.as_written(planner.execute(join_plan(data, aggregate), data, None, aggregate)).to_csv(output_file,
+                                                                                                index=False)
+    with open(output_file) as fp:
+        return fp.read()
+
+
+def test_blocks_are_joined_within_the_budget():
+    frames = data()
+    budget = 8 * 1024
+    blocks = list(external.blocks(join_plan(frames), frames, None, False, budget))
+    assert len(blocks) > 5
+    assert all(external.memory(b) <= budget for b in blocks)
+    pd.testing.assert_frame_equal(pd.concat(blocks, ignore_index=True),
+                                  planner.execute(join_plan(frames), frames, None, False))
+
+
+def test_written_blocks_equal_the_join_in_memory(tmp_path):
+    frames = data()
+    output_file = str(tmp_path / 'blocks.csv')
+    for aggregate in (False, True):
+        # about 8 KB of output rows per block
+        rows = external.write(output_file, join_plan(frames, aggregate), frames, None, aggregate, 8 / 1024,
+                              lambda df: df)
+        with open(output_file) as fp:
+            written = fp.read()
+        assert written == in_memory(tmp_path, frames, aggregate)
+        assert rows == len(written.splitlines()) - 1
+    # the spilled blocks are removed
+    assert sorted(os.listdir(tmp_path)) == ['blocks.csv', 'in-memory.csv']
+
+
+def test_block_over_budget_is_joined_in_halves():
+    frames = data()
+    plan = join_plan(frames)
+    frames_of_steps = planner.right_frames(plan, frames, False)
+    halves = list(external.join_block(plan, frames, None, False, frames_of_steps, 0, 64, 4 * 1024))
+    assert len(halves) > 1
+    assert sum(block for out_df, block in halves) == 64
+    pd.testing.assert_frame_equal(pd.concat([out_df for out_df, block in halves], ignore_index=True),
+                                  planner.execute(plan, frames, None, False, rows=(0, 64)))
@@ -0,0 +1,48 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import features
+
+
+def columns(names):
+    return [{'name': n, 'source': 'clinvar-variant-summary', 'column': n, 'encoding': 'onehot'} for n in names]
+
+
+def test_matrix_round_trip(tmp_path):
+    output_file = str(tmp_path / 'output.csv')
+    df = pd.DataFrame({'VariationID': [5, 6, 7, 8, 9],
+                       'onehot_Type_SNV': [True, False, True, True, False],
+                       # a one-hot column of a left joined source, with missing values
+                       'onehot_moi_AD': pd.Series([True, None, False, None, True], dtype=object),
+                       'scl_score': [0.5, np.nan, -1.25, 2.0, 1e6],
+                       'Name': ['a', 'b', 'c', 'd', 'e']})
+    files = features.write(output_file, df, columns(['onehot_Type_SNV', 'onehot_moi_AD', 'scl_score', 'Name']),
+                           'float32', 2)
+    matrix_file, columns_file = features.files(output_file)
+    assert files == [matrix_file, columns_file]
+    assert matrix_file == str(tmp_path / 'output.features.npy')
+
+    matrix = np.load(matrix_file, mmap_mode='r')
+    assert matrix.dtype == np.float32 and matrix.shape == (5, 3)
+    expected = np.array([[1, 1, 0.5], [0, np.nan, np.nan], [1, 0, -1.25], [1, np.nan, 2.0], [0, 1, 1e6]],
+                        dtype=np.float32)
+    np.testing.assert_array_equal(matrix, expected)
+    with open(columns_file) as fp:
+        described = json.load(fp)
+    # the text column is left out
+    assert [c['name'] for c in described['columns']] == ['onehot_Type_SNV', 'onehot_moi_AD', 'scl_score']
+    assert described['shape'] == [5, 3] and described['dtype'] == 'float32'
+    assert described['file'] == 'output.features.npy'
+    # no temporary file is left
+    assert sorted(os.listdir(tmp_path)) == ['output.features.json', 'output.features.npy']
+
+
+def test_empty_matrix(tmp_path):
+    output_file = str(tmp_path / 'output.csv')
+    df = pd.DataFrame({'onehot_Type_SNV': pd.Series([], dtype=bool)})
+    features.write(output_file, df, columns(['onehot_Type_SNV']), 'float16', 100)
+    matrix = np.load(features.files(output_file)[0], mmap_mode='r')
+    assert matrix.dtype == np.float16 and matrix.shape == (0, 1)
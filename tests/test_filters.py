@@ -0,0 +1,54 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import filters
+import helper
+import pipeline
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+# a sources directory with the configuration of the vrs source, without its data file
+@pytest.fixture
+def sources_path(tmp_path):
+    shutil.copytree(os.path.join(SOURCES_PATH, 'vrs'), tmp_path / 'vrs', ignore=shutil.ignore_patterns('__pycache__'))
+    return str(tmp_path)
+
+
+def vrs_rows():
+    return pd.DataFrame({'clinvar_variation_id': [1, 2, 3],
+                         'vrs_2_0_alpha_id': ['ga4gh:VA.1010', 'ga4gh:VA.2020', 'ga4gh:VA.1010x']})
+
+
+def test_function_names_are_not_columns():
+    f = filters.Filter("contains(vrs_2_0_alpha_id, '1010') and notna(clinvar_variation_id)")
+    assert f.names() == ['clinvar_variation_id', 'vrs_2_0_alpha_id']
+
+
+def test_function_filter_applies():
+    df = vrs_rows()
+    f = filters.Filter("contains(vrs_2_0_alpha_id, '1010')")
+    assert f.applies(df, None)
+    assert list(f.mask(df)) == [True, False, True]
+
+
+def test_unknown_column_does_not_apply():
+    f = filters.Filter("nonexistent == 1")
+    assert not f.applies(vrs_rows(), None)
+    assert f.mask(vrs_rows()) is None
+
+
+def test_unknown_column_filter_fails(sources_path):
+    run = pipeline.Pipeline(sources_path=sources_path, sources=['vrs'], filter="nonexistent == 1")
+    run.filter()
+    with pytest.raises(helper.PipelineError, match='nonexistent'):
+        run.start_load()
+
+
+def test_function_filter_is_checked(sources_path):
+    run = pipeline.Pipeline(sources_path=sources_path, sources=['vrs'], filter="contains(vrs_2_0_alpha_id, '1010')")
+    run.filter()
+    run.check_filters()
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import hashing
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+def test_buckets_are_stable():
+    # the buckets of a text are the same on every run and machine, so they are fixed here
+    assert hashing.buckets(['MYH7', 'BRCA1', 'Cardiomyopathy'], 64).tolist() == [52, 37, 36]
+    # and the same whatever the other values
+    assert hashing.buckets(['BRCA1'], 64).tolist() == [37]
+    # whole numbers read as floats are hashed as integers
+    rows, row_bucket = hashing.row_buckets(pd.Series([8602.0, None]), 64)
+    assert rows.tolist() == [0]
+    assert row_bucket.tolist() == hashing.buckets(['8602'], 64).tolist()
+
+
+def test_chunks_are_the_same_as_one_chunk():
+    series = pd.Series(['MYH7', 'BRCA1;MYH7', None, 'TTN', 'BRCA2;TTN;MYH7'] * 7)
+    whole = hashing.encode(series, 'hsh_GeneSymbol', 16, False, len(series), separator=';')
+    chunked = hashing.encode(series, 'hsh_GeneSymbol', 16, False, 3, separator=';')
+    pd.testing.assert_frame_equal(whole, chunked)
+    assert list(whole.columns) == ['hsh_GeneSymbol_{}'.format(b) for b in range(16)]
+
+
+def test_lists_are_split_on_the_separator():
+    series = pd.Series(['Cardiomyopathy|not provided', 'not provided', None, 'Cardiomyopathy, dilated'])
+    dense = hashing.encode(series, 'hsh_PhenotypeList', 64, False, 10, separator='|')
+    first, second = hashing.buckets(['Cardiomyopathy', 'not provided'], 64)
+    assert dense.iloc[0].sum() == 2
+    assert dense.iloc[0]['hsh_PhenotypeList_{}'.format(first)] == 1
+    assert dense.iloc[0]['hsh_PhenotypeList_{}'.format(second)] == 1
+    assert dense.iloc[1].sum() == 1
+    assert dense.iloc[2].sum() == 0
+    # a comma is part of the name, not a separator
+    assert dense.iloc[3].sum() == 1
+    sparse = hashing.encode(series, 'hsh_PhenotypeList', 64, True, 10, separator='|')
+    assert sparse['hsh_PhenotypeList'].iloc[0] == '|'.join(str(b) for b in sorted([first, second]))
+    assert pd.isna(sparse['hsh_PhenotypeList'].iloc[2])
+    # without a separator the list is one value
+    whole = hashing.encode(series, 'hsh_PhenotypeList', 64, False, 10)
+    assert whole.iloc[0].sum() == 1
+
+
+def test_separator_of_the_dictionary():
+    dic = pd.read_csv(os.path.join(SOURCES_PATH, 'clinvar-variant-summary', 'dictionary.csv')).set_index('column')
+    assert hashing.separator(dic.loc['GeneSymbol']) == ';'
+    assert hashing.separator(dic.loc['PhenotypeList']) == '|'
+    assert hashing.separator({'separator': np.nan, 'expand': True}) == ','
+    assert hashing.separator({'separator': np.nan, 'expand': False}) is None
@@ -0,0 +1,85 @@
+import json
+import logging
+
+import pandas as pd
+import pytest
+
+import helper
+
+
+class Text:
+
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'text'
+
+
+@pytest.fixture
+def event_log(tmp_path):
+    event_log_file = tmp_path / 'events.jsonl'
+    helper.close_event_log()
+    helper.event_log = open(event_log_file, 'a', encoding='utf-8')
+    yield event_log_file
+    helper.close_event_log()
+
+
+def test_log_converts_only_enabled_messages(caplog):
+    text = Text()
+    with caplog.at_level(logging.INFO):
+        helper.debug("debug", text)
+        assert text.count == 0
+        helper.info("rows", text, 3)
+        assert text.count == 1
+    assert caplog.messages == ['rows text 3']
+    with caplog.at_level(logging.INFO):
+        helper.info("a", "b", sep=', ')
+    assert caplog.messages[-1] == 'a, b'
+
+
+def test_event(event_log):
+    df = pd.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z']})
+    helper.event('read', source='vrs', **helper.shape(df))
+    helper.event('output', file='out.csv')
+    helper.close_event_log()
+    with open(event_log) as fp:
+        events = [json.loads(line) for line in fp]
+    assert [e['stage'] for e in events] == ['read', 'output']
+    assert events[0]['source'] == 'vrs'
+    assert (events[0]['rows'], events[0]['columns']) == (3, 2)
+    assert all(e['run'] == helper.run_id and e['seconds'] >= 0 for e in events)
+
+
+def test_event_without_event_log(event_log):
+    helper.close_event_log()
+    helper.event('read', source='vrs')
+    assert helper.event_log is None
+    assert event_log.read_text() == ''
+
+
+def test_collapse_rows():
+    df = pd.DataFrame({'GeneSymbol': ['MYH7', 'TTN', 'MYH7', 'MYH7', None],
+                       'disease_title': ['cardiomyopathy', 'myopathy', 'cardiomyopathy', None, 'other'],
+                       'moi_title': ['AD', 'AR', 'AR', 'AD', 'AD'],
+                       'score': [1.5, 2.0, 3.0, 1.5, 4.0],
+                       'onehot_moi_AD': [True, False, False, True, True]})
+    collapsed = helper.collapse_rows(df, 'GeneSymbol', 'gencc-count')
+    # one row per key in order of first appearance, without the rows without a key
+    assert collapsed['GeneSymbol'].tolist() == ['MYH7', 'TTN']
+    assert list(collapsed.columns) == list(df.columns) + ['gencc-count']
+    assert collapsed['gencc-count'].tolist() == [3, 1]
+    # the distinct values of each column in order, and whether any row is True for flags
+    assert collapsed['disease_title'].tolist() == ['cardiomyopathy', 'myopathy']
+    assert collapsed['moi_title'].tolist() == ['AD|AR', 'AR']
+    assert collapsed['score'].tolist() == ['1.5|3.0', '2.0']
+    assert collapsed['onehot_moi_AD'].tolist() == [True, False]
+
+
+def test_collapse_rows_without_values():
+    df = pd.DataFrame({'VariationID': [5, 5, 6], 'Comment': [None, None, 'x']})
+    collapsed = helper.collapse_rows(df, 'VariationID', 'count')
+    assert collapsed['count'].tolist() == [2, 1]
+    assert pd.isna(collapsed['Comment'].iloc[0])
+    assert collapsed['Comment'].iloc[1] == 'x'
@@ -0,0 +1,50 @@
+import os
+
+import keygraph
+
+
+def graph():
+    key_graph = keygraph.KeyGraph({'clinvar-variant-summary': 'signature'})
+    # a variant of two genes, and a float VariationID read from a column with missing values
+    key_graph.add('variation-id', [5, 6, 7.0, None], 'gene-symbol', ['MYH7', 'TTN;MYH7', 'BRCA1', 'TP53'])
+    key_graph.add('gene-symbol', ['MYH7', 'TTN', 'BRCA1'], 'hgnc-id', ['HGNC:7577', 'HGNC:12403', 'HGNC:1100'])
+    return key_graph.finish()
+
+
+def test_lookup():
+    key_graph = graph()
+    assert key_graph.lookup('variation-id', [6], 'gene-symbol') == {'MYH7', 'TTN'}
+    assert key_graph.lookup('variation-id', ['7'], 'gene-symbol') == {'BRCA1'}
+    assert key_graph.lookup('gene-symbol', ['MYH7'], 'variation-id') == {'5', '6'}
+    assert key_graph.lookup('gene-symbol', ['MYH7', 'BRCA1', 'NONE'], 'hgnc-id') == {'HGNC:7577', 'HGNC:1100'}
+    assert key_graph.lookup('variation-id', [5], 'hgnc-id') == set()
+    assert key_graph.lookup('gene-symbol', ['TP53'], 'variation-id') == set()
+    assert key_graph.linked('hgnc-id', 'gene-symbol')
+    assert not key_graph.linked('variation-id', 'hgnc-id')
+
+
+def test_resolve():
+    key_graph = graph()
+    # a variant resolves to its genes and their HGNC ids, not to the other variants of its genes
+    assert key_graph.resolve('variation-id', [5.0]) == {'variation-id': {'5'}, 'gene-symbol': {'MYH7'},
+                                                        'hgnc-id': {'HGNC:7577'}}
+    assert key_graph.resolve('hgnc-id', ['HGNC:7577']) == {'hgnc-id': {'HGNC:7577'}, 'gene-symbol': {'MYH7'},
+                                                           'variation-id': {'5', '6'}}
+
+
+def test_load_saves_and_reuses_the_graph(tmp_path, monkeypatch):
+    builds = []
+    monkeypatch.setattr(keygraph.source, 'names', lambda sources_path: [])
+    monkeypatch.setattr(keygraph, 'data_signatures', lambda source_files_df: {'clinvar-variant-summary': 'signature'})
+    monkeypatch.setattr(keygraph, 'build', lambda source_files_df, signatures, chunksize: builds.append(1) or graph())
+    loaded = keygraph.load(str(tmp_path), 100)
+    assert sorted(os.listdir(tmp_path)) == sorted([keygraph.GRAPH_FILE, keygraph.LOCK_FILE])
+    saved = keygraph.load(str(tmp_path), 100)
+    assert len(builds) == 1
+    assert saved.signatures == loaded.signatures
+    assert saved.lookup('gene-symbol', ['MYH7'], 'variation-id') == {'5', '6'}
+    assert saved.resolve('variation-id', [6]) == loaded.resolve('variation-id', [6])
+    # rebuilt when a data file changes
+    monkeypatch.setattr(keygraph, 'data_signatures', lambda source_files_df: {'clinvar-variant-summary': 'changed'})
+    keygraph.load(str(tmp_path), 100)
+    assert len(builds) == 2
@@ -0,0 +1,63 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import packing
+
+
+def dictionary():
+    return pd.DataFrame({
+        'name': ['variants', 'variants', 'submissions', 'genes', 'genes'],
+        'column': ['VariationID', 'GeneSymbol', 'VariationID', 'gene', 'hgnc'],
+        'join-group': ['variation-id', 'gene-symbol', 'variation-id', 'gene-symbol', 'hgnc-id']})
+
+
+def data():
+    return {
+        'variants': pd.DataFrame({'VariationID': [5.0, 6.0, np.nan], 'GeneSymbol': ['MYH7', 'TTN;MYH7', 'BRCA1'],
+                                  'variants-template': ['v5', 'v6', 'v-brca1']}),
+        'submissions': pd.DataFrame({'VariationID': [6, 5, 6], 'submissions-template': ['s6a', 's5', 's6b']}),
+        'genes': pd.DataFrame({'gene': ['MYH7', 'TP53', np.nan], 'hgnc': ['HGNC:7577', 'HGNC:11998', 'HGNC:1'],
+                               'genes-template': ['g-myh7', 'g-tp53', 'g-hgnc1']})}
+
+
+def test_records_are_grouped_by_variant_in_source_order():
+    records = list(packing.records(data(), dictionary(), ['variants', 'submissions', 'genes']))
+    assert records == [
+        ('variation-id:5', [('variants', 'v5'), ('submissions', 's5'), ('genes', 'g-myh7')]),
+        ('variation-id:6', [('variants', 'v6'), ('submissions', 's6a'), ('submissions', 's6b'), ('genes', 'g-myh7')]),
+        # a row without a variant is grouped by its next join-group, not by a missing variant
+        ('gene-symbol:BRCA1', [('variants', 'v-brca1')]),
+        ('gene-symbol:TP53', [('genes', 'g-tp53')]),
+        ('hgnc-id:HGNC:1', [('genes', 'g-hgnc1')])]
+
+
+def test_records_follow_the_source_order():
+    records = dict(packing.records(data(), dictionary(), ['submissions', 'variants']))
+    assert records['variation-id:6'] == [('submissions', 's6a'), ('submissions', 's6b'), ('variants', 'v6')]
+
+
+def test_pack_within_budget():
+    texts = ['a' * 40, 'b' * 40, 'c' * 40, 'd' * 200, 'e' * 10]
+    chunks = packing.pack(texts, 100, 'chars')
+    assert chunks == [(0, 1), (2, 2), (3, 3), (4, 4)]
+    for first, last in chunks:
+        text = packing.RECORD_SEPARATOR.join(texts[first:last + 1])
+        # only a record over the budget on its own goes over it
+        assert len(text) <= 100 or first == last
+
+
+def test_write(tmp_path):
+    frames = data()
+    frames['submissions']['submissions-template'] = ['x' * 30, 'y' * 30, 'z' * 30]
+    file_path = str(tmp_path / 'packed.jsonl')
+    packing.write(file_path, frames, dictionary(), ['variants', 'submissions', 'genes'], 40, 'chars')
+    with open(file_path) as fp:
+        chunks = [json.loads(line) for line in fp]
+    assert all(c['chars'] <= 40 for c in chunks)
+    variant_6 = [c for c in chunks if c['key'] == 'variation-id:6']
+    assert [c['text'] for c in variant_6] == ['v6\n\n' + 'x' * 30, 'z' * 30 + '\n\ng-myh7']
+    assert [(c['part'], c['parts'], c['first_record'], c['last_record']) for c in variant_6] == [(1, 2, 0, 1),
+                                                                                                (2, 2, 2, 3)]
+    assert [c['chunk'] for c in chunks] == list(range(len(chunks)))
@@ -0,0 +1,83 @@
+import pandas as pd
+
+import helper
+import planner
+
+
+# variants, their submissions (several per variant), their VRS ids (one per variant) and gene curations (one per gene)
+def data():
+    return {
+        'variants': pd.DataFrame({'VariationID': [5, 6, 7, 8], 'GeneSymbol': ['MYH7', 'TTN', 'MYH7', 'BRCA1'],
+                                  'Name': ['v5', 'v6', 'v7', 'v8']}),
+        'submissions': pd.DataFrame({'VariationID': [6, 5, 5, 6, 6, 9, 5],
+                                     'Submitter': ['A', 'B', 'C', 'B', 'D', 'E', 'A'],
+                                     'Name': ['s1', 's2', 's3', 's4', 's5', 's6', 's7']}),
+        'vrs': pd.DataFrame({'clinvar_variation_id': [8, 7, 6, 5], 'vrs_id': ['ga4gh:8', 'ga4gh:7', 'ga4gh:6',
+                                                                              'ga4gh:5']}),
+        'genes': pd.DataFrame({'gene': ['TTN', 'MYH7', 'TP53'], 'Name': ['g-ttn', 'g-myh7', 'g-tp53']})}
+
+
+def dictionary():
+    dic_df = pd.DataFrame({
+        'name': ['variants', 'variants', 'submissions', 'vrs', 'genes'],
+        'column': ['VariationID', 'GeneSymbol', 'VariationID', 'clinvar_variation_id', 'gene'],
+        'join-group': ['variation-id', 'gene-symbol', 'variation-id', 'variation-id', 'gene-symbol']})
+    return dic_df.assign(precedence=dic_df['join-group'].map(helper.get_join_precedence))
+
+
+SUFFIXES = {'variants': '-variant', 'submissions': '-submission', 'vrs': '-vrs', 'genes': '-gene'}
+
+
+def test_aggregate_join_keeps_the_rows_of_the_first_source():
+    sources = ['variants', 'submissions', 'genes']
+    join_plan = planner.plan(sources, dictionary(), data(), SUFFIXES, None, True)
+    out_df = planner.execute(join_plan, data(), None, True)
+    assert out_df['VariationID'].tolist() == [5, 6, 7, 8]
+    # the keys without rows in the source are not counted
+    assert out_df['submissions-count'].fillna(0).tolist() == [3, 3, 0, 0]
+    assert out_df['genes-count'].fillna(0).tolist() == [1, 1, 1, 0]
+    assert out_df['Submitter'].tolist()[:2] == ['B|C|A', 'A|B|D']
+    assert out_df['Name-gene'].tolist()[:3] == ['g-myh7', 'g-ttn', 'g-myh7']
+
+
+# the joins in --sources order, as main.py ran them before the planner
+def baseline_join(sources, dic_df, data, suffixes):
+    out_df = data[sources[0]]
+    joined = dict(planner.join_columns(dic_df, sources[0]))
+    for s in sources[1:]:
+        columns = planner.join_columns(dic_df, s)
+        join_group = [jg for jg in columns if jg in joined][0]
+        out_df = pd.merge(out_df, data[s], how='left', left_on=joined[join_group], right_on=columns[join_group],
+                          suffixes=('', suffixes[s]))
+        for jg, column in columns.items():
+            joined.setdefault(jg, column)
+    return out_df
+
+
+def test_plan_runs_the_smallest_fanout_first():
+    sources = ['variants', 'submissions', 'vrs', 'genes']
+    join_plan = planner.plan(sources, dictionary(), data(), SUFFIXES, None, False)
+    assert [s.name for s in join_plan.order] == ['variants', 'vrs', 'genes', 'submissions']
+    assert join_plan.reordered()
+    assert {s.name: s.fanout for s in join_plan.steps} == {'variants': 1.0, 'submissions': 2.0, 'vrs': 1.0,
+                                                           'genes': 1.0}
+    # variants 5 and 6 have 3 submissions each, 7 and 8 none and keep their row
+    assert join_plan.order[-1].estimate == 8
+
+
+def test_output_equals_the_joins_in_sources_order():
+    for sources in (['variants', 'submissions', 'vrs', 'genes'], ['variants', 'genes', 'submissions', 'vrs'],
+                    ['submissions', 'variants', 'genes', 'vrs'], ['vrs', 'submissions', 'variants']):
+        join_plan = planner.plan(sources, dictionary(), data(), SUFFIXES, None, False)
+        out_df = planner.execute(join_plan, data(), None, False)
+        # the same rows in the same order, with the same columns
+        pd.testing.assert_frame_equal(out_df, baseline_join(sources, dictionary(), data(), SUFFIXES))
+        assert [s.actual for s in join_plan.order][-1] == len(out_df)
+
+
+def test_output_of_blocks_of_rows_equals_the_whole_output():
+    sources = ['variants', 'submissions', 'vrs', 'genes']
+    join_plan = planner.plan(sources, dictionary(), data(), SUFFIXES, None, False)
+    blocks = [planner.execute(join_plan, data(), None, False, rows=(start, start + 3)) for start in (0, 3)]
+    pd.testing.assert_frame_equal(pd.concat(blocks, ignore_index=True),
+                                  baseline_join(sources, dictionary(), data(), SUFFIXES))
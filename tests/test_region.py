@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import region
+
+
+# 1000 variants 100 long every 1000 positions of chromosome 1, and one copy number variant spanning the chromosome
+def locations():
+    starts = np.arange(1000) * 1000 + 1
+    df = pd.DataFrame({'VariationID': np.arange(1000) + 1, 'Assembly': 'GRCh38', 'Chromosome': '1',
+                       'Start': starts, 'Stop': starts + 100})
+    cnv = pd.DataFrame({'VariationID': [5000], 'Assembly': ['GRCh38'], 'Chromosome': ['1'], 'Start': [1],
+                        'Stop': [248956422]})
+    return pd.concat([df, cnv], ignore_index=True)
+
+
+def test_long_variant_overlaps():
+    index = region.index_arrays(locations())
+    assert region.overlaps(index, 'chr1', 500050, 501050) == {501, 502, 5000}
+    assert region.overlaps(index, '1', 500200, 500300) == {5000}
+    assert region.overlaps(index, '1', 248000000, 248000001) == {5000}
+
+
+def test_long_variant_does_not_widen_search():
+    index = region.index_arrays(locations())
+    stops, ids = region.candidates(index, '1', 500050, 501050)
+    # the variants starting from 100 before the region to its end, and the long variant
+    assert sorted(ids.tolist()) == [501, 502, 5000]
+    assert len(stops) == 3
+
+
+# variants of every length from 1 b to 50 Mb at random positions
+def random_locations(count=3000, seed=11):
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(1, 200000000, count)
+    lengths = np.exp(rng.uniform(0, np.log(50000000), count)).astype(np.int64)
+    return pd.DataFrame({'VariationID': np.arange(count) + 1, 'Assembly': 'GRCh38', 'Chromosome': '1',
+                         'Start': starts, 'Stop': starts + lengths})
+
+
+def test_overlaps_match_a_scan():
+    df = random_locations()
+    index = region.index_arrays(df)
+    rng = np.random.default_rng(5)
+    for start in rng.integers(1, 200000000, 50):
+        end = start + int(rng.integers(0, 2000000))
+        expected = set(df.loc[(df['Start'] <= end) & (df['Stop'] >= start), 'VariationID'].tolist())
+        assert region.overlaps(index, '1', start, end) == expected
+
+
+def test_long_variants_are_searched_by_tier():
+    # 1000 variants 150 kb long every 1 Mb: a region is searched only from 200 kb before it
+    starts = np.arange(1000) * 1000000 + 1
+    df = pd.DataFrame({'VariationID': np.arange(1000) + 1, 'Assembly': 'GRCh38', 'Chromosome': '1',
+                       'Start': starts, 'Stop': starts + 150000})
+    index = region.index_arrays(df)
+    assert index['GRCh38:1:tiers'].tolist() == [0, 1]
+    stops, ids = region.candidates(index, '1', 500000100, 500000200)
+    assert ids.tolist() == [501]
+    assert region.overlaps(index, '1', 500000100, 500000200) == {501}
+    assert region.overlaps(index, '1', 500200000, 500300000) == set()
+
+
+def test_index_is_replaced_whole(tmp_path, monkeypatch):
+    monkeypatch.setattr(region.source, 'read', lambda sourcefile, chunksize, columns=None: iter([locations()]))
+    monkeypatch.setattr(region.helper, 'file_signature', lambda file: 'signature')
+    sourcefile = {'name': region.REGION_SOURCE, 'path': str(tmp_path), 'data_path': str(tmp_path),
+                  'file': 'variant_summary.txt'}
+    index = region.load(sourcefile, 100)
+    assert region.overlaps(index, '1', 500200, 500300) == {5000}
+    assert sorted(os.listdir(tmp_path)) == ['download.lock', 'variant_summary.txt.regions.npz']
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+import arguments
+import sampling
+
+
+def chunks(rows=1000, chunk_size=100):
+    df = pd.DataFrame({'VariationID': np.arange(rows) // 2 + 1, 'Type': np.where(np.arange(rows) % 10 == 0, 'Deletion',
+                                                                                 'single nucleotide variant')})
+    df.loc[df.index % 50 == 1, 'Type'] = 'Duplication'
+    return [df.iloc[start:start + chunk_size] for start in range(0, rows, chunk_size)]
+
+
+def sampled(reservoir, source_chunks):
+    for chunk in source_chunks:
+        reservoir.add(chunk)
+        # no more than the sample is held between chunks: size rows, size rows of each stratum or the rows of size keys
+        held = pd.concat(reservoir.parts)
+        if reservoir.key is not None:
+            assert held[reservoir.key].nunique() <= reservoir.size
+        elif reservoir.stratum is not None:
+            assert held[reservoir.stratum].value_counts().max() <= reservoir.size
+        else:
+            assert len(held) <= reservoir.size
+    return pd.concat(reservoir.chunks())
+
+
+def test_sample_size_and_order():
+    sample = sampled(sampling.Reservoir(25, 7, 'clinvar-variant-summary'), chunks())
+    assert len(sample) == 25
+    # in the order read
+    assert sample.index.is_monotonic_increasing
+    # a sample larger than the source is the whole source
+    assert len(sampled(sampling.Reservoir(5000, 7, 'clinvar-variant-summary'), chunks())) == 1000
+
+
+def test_seed_gives_the_same_sample():
+    first = sampled(sampling.Reservoir(25, 7, 'clinvar-variant-summary'), chunks())
+    again = sampled(sampling.Reservoir(25, 7, 'clinvar-variant-summary'), chunks(chunk_size=333))
+    other = sampled(sampling.Reservoir(25, 8, 'clinvar-variant-summary'), chunks())
+    assert first.index.tolist() == again.index.tolist()
+    assert first.index.tolist() != other.index.tolist()
+
+
+def test_sample_by_column():
+    sample = sampled(sampling.Reservoir(30, 7, 'clinvar-variant-summary', stratum='Type'), chunks())
+    # 30 of each value, or all the rows of a value with fewer
+    assert sample['Type'].value_counts().to_dict() == {'single nucleotide variant': 30, 'Deletion': 30,
+                                                       'Duplication': 20}
+
+
+def test_sample_key_keeps_the_same_keys_in_two_sources():
+    variants = pd.DataFrame({'VariationID': np.arange(1, 501)})
+    submissions = pd.DataFrame({'VariationID': np.repeat(np.arange(1, 501), 3), 'Submitter': ['A', 'B', 'C'] * 500})
+    submissions.loc[::7, 'VariationID'] = np.nan
+    variant_sample = sampled(sampling.Reservoir(40, 7, 'clinvar-variant-summary', key='VariationID'),
+                             [variants.iloc[start:start + 64] for start in range(0, len(variants), 64)])
+    submission_sample = sampled(sampling.Reservoir(40, 7, 'clinvar-submission-summary', key='VariationID'),
+                                [submissions.iloc[start:start + 100] for start in range(0, len(submissions), 100)])
+    assert len(variant_sample) == 40
+    assert set(submission_sample['VariationID']) == set(variant_sample['VariationID'])
+    # all the rows with a key of the sample, and none without a key
+    assert len(submission_sample) == submissions['VariationID'].isin(variant_sample['VariationID']).sum()
+
+
+def test_reservoir_of_a_source():
+    dic = pd.DataFrame({'column': ['VariationID', 'Type'], 'join-group': ['variation-id', None]})
+    args = arguments.options(sample=10, sample_by='Type', sample_key='variation-id')
+    reservoir = sampling.reservoir(args, 'clinvar-variant-summary', dic, 7)
+    assert (reservoir.size, reservoir.stratum, reservoir.key) == (10, 'Type', 'VariationID')
+    genes = pd.DataFrame({'column': ['GeneSymbol'], 'join-group': ['gene-symbol']})
+    reservoir = sampling.reservoir(args, 'gencc-submissions', genes, 7)
+    assert (reservoir.stratum, reservoir.key) == (None, None)
+    assert sampling.reservoir(arguments.options(), 'gencc-submissions', genes, 7) is None
@@ -0,0 +1,74 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import scaling
+import source
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+def fitted(values, chunk_size):
+    statistics = scaling.Statistics()
+    for start in range(0, len(values), chunk_size):
+        statistics.update(values[start:start + chunk_size])
+    return statistics.parameters()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000, 100000])
+def test_chunks_merge_to_the_statistics_of_all_values(chunk_size):
+    rng = np.random.default_rng(3)
+    # a large offset, where summing squares in one pass would lose the variance
+    values = 1e9 + rng.normal(0, 10, 20000)
+    parameters = fitted(values, chunk_size)
+    assert parameters['count'] == len(values)
+    assert parameters['mean'] == pytest.approx(np.mean(values), rel=1e-12)
+    assert parameters['std'] == pytest.approx(np.std(values, ddof=1), rel=1e-6)
+    assert parameters['std'] ** 2 == pytest.approx(np.var(values, ddof=1), rel=1e-6)
+    assert (parameters['min'], parameters['max']) == (values.min(), values.max())
+
+
+def test_missing_values_are_ignored():
+    values = np.array([1.0, np.nan, 2.0, 3.0, np.nan, 4.0])
+    parameters = fitted(values, 2)
+    assert parameters['count'] == 4
+    assert parameters['mean'] == pytest.approx(2.5)
+    assert parameters['std'] == pytest.approx(np.std([1, 2, 3, 4], ddof=1))
+    empty = fitted(np.array([np.nan]), 1)
+    assert empty['count'] == 0 and empty['std'] == 0.0 and empty['median'] is None
+
+
+def test_quartiles_within_the_sketch_error():
+    values = np.random.default_rng(4).permutation(200000).astype(float)
+    parameters = fitted(values, 5000)
+    # the rank error is about log2(rows / capacity) / capacity
+    error = np.log2(len(values) / scaling.SKETCH_CAPACITY) / scaling.SKETCH_CAPACITY * len(values)
+    for q, name in ((0.25, 'q1'), (0.5, 'median'), (0.75, 'q3')):
+        assert abs(parameters[name] - np.quantile(values, q)) <= 2 * error
+
+
+def test_transform():
+    parameters = fitted(np.array([1.0, 2.0, 3.0, 4.0, 5.0]), 2)
+    series = pd.Series([1, 3, 'x', None, 5], dtype=object)
+    np.testing.assert_allclose(scaling.transform(series, parameters, 'zscore'),
+                               [-2 / np.std([1, 2, 3, 4, 5], ddof=1), 0, np.nan, np.nan,
+                                2 / np.std([1, 2, 3, 4, 5], ddof=1)])
+    np.testing.assert_allclose(scaling.transform(series, parameters, 'minmax'), [0, 0.5, np.nan, np.nan, 1])
+    np.testing.assert_allclose(scaling.transform(series, parameters, 'log1p'), np.log1p([1, 3, np.nan, np.nan, 5]))
+    np.testing.assert_allclose(scaling.transform(series, parameters, 'robust'), [-1, 0, np.nan, np.nan, 1])
+
+
+def test_parameters_are_saved_next_to_the_data_file(tmp_path):
+    shutil.copytree(os.path.join(SOURCES_PATH, 'vrs'), tmp_path / 'vrs', ignore=shutil.ignore_patterns('__pycache__'))
+    sourcefile = source.get(str(tmp_path), 'vrs')
+    pd.DataFrame({'clinvar_variation_id': [1, 2, 3, 4], 'vrs_2_0_alpha_id': ['a', 'b', 'c', 'd']}).to_csv(
+        source.data_file(sourcefile), index=False)
+    parameters = scaling.load(sourcefile, ['clinvar_variation_id'], 3)
+    assert parameters['clinvar_variation_id']['mean'] == 2.5
+    assert os.path.isfile(source.data_file(sourcefile) + scaling.PARAMETERS_SUFFIX)
+    assert scaling.saved_parameters(sourcefile, ['clinvar_variation_id']) == parameters
+    # fitted again for other columns
+    assert scaling.saved_parameters(sourcefile, ['clinvar_variation_id', 'other']) is None
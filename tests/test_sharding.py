@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+
+import arguments
+import helper
+import sharding
+
+
+def dictionary():
+    return pd.DataFrame({'column': ['VariationID', 'GeneSymbol'], 'join-group': ['variation-id', 'gene-symbol']})
+
+
+def test_shard_filter_partitions_rows_by_key():
+    df = pd.DataFrame({'VariationID': [5, 6, 7, 5.0, 8, 9, 10, 6], 'GeneSymbol': list('ABCDEFGH')})
+    masks = [sharding.ShardFilter('variation-id', 3, index, 'variation-id').mask(df, dictionary())
+             for index in range(3)]
+    # every row is in exactly one shard
+    assert (sum(m.astype(int) for m in masks) == 1).all()
+    # the rows of a key are in the same shard, whether read as an integer or a float
+    shard = sum(index * m.astype(int) for index, m in enumerate(masks))
+    assert shard.iloc[0] == shard.iloc[3]
+    assert shard.iloc[1] == shard.iloc[7]
+    # sources without the key are not filtered
+    shard_filter = sharding.ShardFilter('variation-id', 3, 0, 'variation-id')
+    genes = pd.DataFrame({'GeneSymbol': ['A']})
+    assert not shard_filter.applies(genes, dictionary())
+    assert shard_filter.mask(genes, dictionary()) is None
+
+
+def test_shard_filter_by_chromosome():
+    df = pd.DataFrame({'VariationID': [1, 2, 3, 4]})
+    # variants 1 and 2 are located in the shard, 3 elsewhere, 4 nowhere and so sharded by its key
+    shard_filter = sharding.ShardFilter('variation-id', 2, 0, 'chromosome', shard_keys={'1', '2'},
+                                        located_keys={'1', '2', '3'})
+    mask = shard_filter.mask(df, dictionary())
+    assert mask.tolist()[:3] == [True, True, False]
+    assert mask.iloc[3] == (sharding.shard_of(pd.Series([4]), 2)[0] == 0)
+
+
+def test_merge_csv_fills_missing_columns(tmp_path):
+    first = tmp_path / 'first.csv'
+    second = tmp_path / 'second.csv'
+    pd.DataFrame({'VariationID': [5, 6], 'onehot_Type_SNV': [True, False], 'Name': ['a', 'b']}).to_csv(first,
+                                                                                                   index=False)
+    pd.DataFrame({'VariationID': [7], 'Name': ['c'], 'onehot_Type_Deletion': [True],
+                  'Comment': ['x, y']}).to_csv(second, index=False)
+    output_file = str(tmp_path / 'merged.csv')
+    sharding.merge_csv([str(first), str(second)], output_file)
+    merged = pd.read_csv(output_file, dtype=str, keep_default_na=False)
+    assert list(merged.columns) == ['VariationID', 'onehot_Type_SNV', 'Name', 'onehot_Type_Deletion', 'Comment']
+    assert merged['VariationID'].tolist() == ['5', '6', '7']
+    # one-hot columns missing from a shard are False, other columns empty
+    assert merged['onehot_Type_SNV'].tolist() == ['True', 'False', 'False']
+    assert merged['onehot_Type_Deletion'].tolist() == ['False', 'False', 'True']
+    assert merged['Comment'].tolist() == ['', '', 'x, y']
+
+
+def test_merge(tmp_path):
+    args = arguments.options(shards=2, shard_dir=str(tmp_path / 'shards'))
+    output_file = str(tmp_path / 'out.csv')
+    for index in range(2):
+        args.shard_index = index
+        part = sharding.part_file(args, output_file)
+        pd.DataFrame({'VariationID': [index]}).to_csv(part, index=False)
+        sharding.write_manifest(args, [{'output': output_file, 'part': part, 'kind': 'joined', 'source': None,
+                                        'sharded': True}])
+    args.shard_index = None
+    sharding.merge(args)
+    assert pd.read_csv(output_file)['VariationID'].tolist() == [0, 1]
+
+
+def test_merge_missing_shard(tmp_path):
+    args = arguments.options(shards=2, shard_dir=str(tmp_path / 'shards'), shard_index=0)
+    sharding.part_file(args, 'out.csv')
+    sharding.write_manifest(args, [])
+    args.shard_index = None
+    with pytest.raises(helper.PipelineError, match="shard 1 of 2 has not completed"):
+        sharding.merge(args)
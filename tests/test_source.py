@@ -0,0 +1,23 @@
+import pandas as pd
+
+import source
+
+
+def joined(compact):
+    left = pd.DataFrame({'VariationID': [1, 2, 3]})
+    right = pd.DataFrame({'clinvar_variation_id': [1, 2], 'score': [0.123456789, 0.5],
+                          'reviewed': [True, False]})
+    if compact:
+        right = source.compact(right)
+    return left.merge(right, how='left', left_on='VariationID', right_on='clinvar_variation_id')
+
+
+def test_compact_output_unchanged():
+    compact = joined(True)
+    assert str(compact['clinvar_variation_id'].dtype) == 'Int8'
+    assert source.as_written(compact).to_csv(index=False) == joined(False).to_csv(index=False)
+
+
+def test_compact_float_exact():
+    assert source.compact_float(pd.Series([0.123456789, 1.0])).dtype == 'float64'
+    assert source.compact_float(pd.Series([0.5, None, 10000.0])).dtype == 'float32'
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import source
+import store
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+# the vrs source with a data file whose columns parse as other types in later chunks of 3 rows
+@pytest.fixture
+def sourcefile(tmp_path):
+    shutil.copytree(os.path.join(SOURCES_PATH, 'vrs'), tmp_path / 'vrs', ignore=shutil.ignore_patterns('__pycache__'))
+    sourcefile = source.get(str(tmp_path), 'vrs')
+    pd.DataFrame({'clinvar_variation_id': [1, 2, 3, 4, 5, 6, 7],
+                  'vrs_2_0_alpha_id': ['ga4gh:VA.1', 'ga4gh:VA.2', None, 'ga4gh:VA.4', None, None, None],
+                  'int_then_text': [1, 2, 3, 4, 'x', 6, 7],
+                  'int_then_missing': [1, 2, 3, None, None, None, 7],
+                  'int_then_float': [1, 2, 3, 4.5, 5, 6, 7],
+                  'flag': [True, False, True, True, False, None, True],
+                  'empty': [None] * 7}).to_csv(source.data_file(sourcefile), index=False)
+    return sourcefile
+
+
+def whole(chunks):
+    return pd.concat(list(chunks))
+
+
+def test_column_types_are_unified_across_chunks(sourcefile):
+    schema = store.load(sourcefile, 3).schema
+    assert schema.field('clinvar_variation_id').type == pa.int64()
+    assert schema.field('int_then_text').type == pa.string()
+    assert schema.field('int_then_missing').type == pa.float64()
+    assert schema.field('int_then_float').type == pa.float64()
+    assert schema.field('vrs_2_0_alpha_id').type == pa.string()
+    assert schema.field('empty').type == pa.float64()
+    # flags with missing values in one chunk
+    assert schema.field('flag').type == pa.bool_()
+
+
+def test_read_equals_the_data_file_parsed_whole(sourcefile):
+    stored = whole(store.read(sourcefile, 3))
+    parsed = whole(source.read(sourcefile, 100))
+    pd.testing.assert_frame_equal(stored, parsed, check_dtype=False)
+    assert stored['int_then_text'].tolist() == ['1', '2', '3', '4', 'x', '6', '7']
+    assert [len(chunk) for chunk in store.read(sourcefile, 3)] == [3, 3, 1]
+    selected = whole(store.read(sourcefile, 3, columns=['clinvar_variation_id', 'flag']))
+    assert list(selected.columns) == ['clinvar_variation_id', 'flag']
+
+
+def test_store_is_rebuilt_when_the_data_file_changes(sourcefile):
+    store.load(sourcefile, 3)
+    assert store.stored(sourcefile) is not None
+    pd.DataFrame({'clinvar_variation_id': [8, 9], 'vrs_2_0_alpha_id': ['ga4gh:VA.8', 'ga4gh:VA.9']}).to_csv(
+        source.data_file(sourcefile), index=False)
+    assert store.stored(sourcefile) is None
+    assert whole(store.read(sourcefile, 3))['clinvar_variation_id'].tolist() == [8, 9]
+    assert store.stored(sourcefile) is not None
+    # built next to the data file, holding the download lock of the source
+    assert os.path.isfile(store.store_file(sourcefile))
+    assert os.path.isfile(os.path.join(sourcefile['data_path'], 'download.lock'))
@@ -0,0 +1,89 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+import source
+import templates
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+# the template and dictionary columns of each source shipped
+def shipped_templates():
+    return list(config_templates())
+
+
+def config_templates():
+    for config_file in sorted(glob.glob(os.path.join(SOURCES_PATH, '*', 'config.yml'))):
+        with open(config_file) as fp:
+            config = yaml.safe_load(fp)
+        dic = pd.read_csv(os.path.join(os.path.dirname(config_file), 'dictionary.csv'))
+        for sourcefile in config:
+            if sourcefile.get('template'):
+                yield pytest.param(sourcefile['template'], list(dic['column']), id=sourcefile['name'])
+
+
+# fixture rows of the columns: text, missing (NaN and None), empty text, numbers, a mix of them, and repeated rows for
+# the memoized rendering
+def fixture_rows(columns):
+    rows = [
+        {c: "{} value".format(c) for c in columns},
+        {c: np.nan for c in columns},
+        {c: None for c in columns},
+        {c: '' for c in columns},
+        {c: (42 if i % 2 else 1.5) for i, c in enumerate(columns)},
+        {c: (np.nan if i % 3 == 0 else '' if i % 3 == 1 else "{} other".format(c)) for i, c in enumerate(columns)},
+    ]
+    df = pd.DataFrame(rows + rows[:2] + rows[4:], columns=columns, dtype=object)
+    return df
+
+
+def genshi(template_text, df):
+    return templates.Template(template_text, 'genshi', memoize=False).render(df)
+
+
+def compiled(template_text, df, memoize=True):
+    template = templates.Template(template_text, 'compiled', memoize=memoize)
+    assert template.engine == 'compiled'
+    return template.render(df)
+
+
+@pytest.mark.parametrize('template_text, columns', shipped_templates())
+def test_engines_render_the_same(template_text, columns):
+    df = fixture_rows(columns)
+    expected = genshi(template_text, df)
+    assert compiled(template_text, df, memoize=False) == expected
+    assert compiled(template_text, df) == expected
+
+
+@pytest.mark.parametrize('template_text, columns', shipped_templates())
+def test_engines_render_categoricals_the_same(template_text, columns):
+    df = fixture_rows(columns)
+    df = df.astype({c: 'category' for c in columns if df[c].map(type).isin([str, float, type(None)]).all()})
+    assert compiled(template_text, df) == genshi(template_text, df)
+
+
+@pytest.mark.parametrize('template_text, columns', shipped_templates())
+def test_engines_render_numbers_the_same(template_text, columns):
+    df = pd.DataFrame({c: [1.0, np.nan, 2.5, 1.0] for c in columns})
+    assert compiled(template_text, df) == genshi(template_text, df)
+
+
+@pytest.mark.parametrize('template_text, columns', shipped_templates())
+def test_engines_render_compact_rows_the_same(template_text, columns):
+    df = templates.compact_rows(source.compact(fixture_rows(columns), categorical=columns[::2]))
+    assert compiled(template_text, df) == genshi(template_text, df)
+
+
+# the vars of a with reading a column, rendered by either engine first
+def test_with_over_a_column():
+    template_text = "{% with x = dict.A %}[${x}]{% end %}"
+    df = pd.DataFrame({'A': [1, 2, 1]})
+    assert compiled(template_text, df) == ['[1]', '[2]', '[1]']
+    assert compiled(template_text, df, memoize=False) == ['[1]', '[2]', '[1]']
+    template = templates.Template(template_text, 'compiled')
+    assert template.render(df) == genshi(template_text, df) == ['[1]', '[2]', '[1]']
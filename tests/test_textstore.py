@@ -0,0 +1,59 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import filters
+import source
+import templates
+import textstore
+
+SOURCES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sources')
+
+
+def vrs_rows():
+    return pd.DataFrame({'clinvar_variation_id': [1, 2, 3, 2],
+                         'vrs_2_0_alpha_id': ['ga4gh:VA.1010', 'ga4gh:VA.2020', 'ga4gh:VA.3030', 'ga4gh:VA.2021']})
+
+
+# the vrs source with a data file of vrs_rows
+@pytest.fixture
+def vrs(tmp_path):
+    shutil.copytree(os.path.join(SOURCES_PATH, 'vrs'), tmp_path / 'vrs', ignore=shutil.ignore_patterns('__pycache__'))
+    sourcefile = source.get(str(tmp_path), 'vrs')
+    vrs_rows().to_csv(source.data_file(sourcefile), index=False)
+    dic = pd.read_csv(os.path.join(sourcefile['path'], sourcefile['dictionary']))
+    return sourcefile, dic
+
+
+def test_texts_are_the_rendered_templates(vrs):
+    sourcefile, dic = vrs
+    rendered = templates.Template(sourcefile['template'], 'compiled').render(vrs_rows())
+    assert textstore.texts(sourcefile, dic, [], False, 2) == list(rendered)
+    variant = filters.join_group_filter('variation-id', ['2', '3'])
+    assert textstore.texts(sourcefile, dic, [variant], False, 2) == [rendered[1], rendered[2], rendered[3]]
+
+
+def test_store_is_reused(vrs):
+    sourcefile, dic = vrs
+    textstore.load(sourcefile, dic, 2).close()
+    modified = os.path.getmtime(textstore.store_file(sourcefile))
+    connection = textstore.stored(sourcefile)
+    assert connection is not None
+    connection.close()
+    textstore.load(sourcefile, dic, 2).close()
+    assert os.path.getmtime(textstore.store_file(sourcefile)) == modified
+
+
+def test_store_is_rebuilt_for_another_engine_or_template(vrs):
+    sourcefile, dic = vrs
+    textstore.load(sourcefile, dic, 2, 'compiled').close()
+    # another engine, templates.py or template gives another signature
+    assert textstore.stored(sourcefile, 'genshi') is None
+    assert textstore.signature(sourcefile, 'genshi') != textstore.signature(sourcefile, 'compiled')
+    assert textstore.file_hash(templates.__file__) in textstore.signature(sourcefile)
+    changed = sourcefile.copy()
+    changed['template'] = "VariationID ${dict.clinvar_variation_id}."
+    assert textstore.stored(changed) is None
+    assert textstore.texts(changed, dic, [filters.join_group_filter('variation-id', ['3'])], False, 2) == ['VariationID 3.']
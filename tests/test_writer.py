@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+import helper
+import writer
+
+
+def append(parts, text, seconds=0.0):
+    time.sleep(seconds)
+    parts.append(text)
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+@pytest.mark.parametrize('threads', [0, 1, 4])
+def test_jobs_after_others_run_in_order(threads):
+    parts = []
+    with writer.Writer(threads) as w:
+        job = None
+        # the first parts take longest, so without after they would be written last
+        for i in range(6):
+            job = w.submit("part {}".format(i), append, parts, i, (6 - i) * 0.01, after=job)
+    assert parts == list(range(6))
+
+
+def test_jobs_run_in_writer_threads():
+    names = []
+    with writer.Writer(2) as w:
+        for i in range(4):
+            w.submit("job {}".format(i), lambda: names.append(threading.current_thread().name))
+    assert set(names) <= {'writer-0', 'writer-1'} and len(names) == 4
+
+
+def test_error_is_raised_on_close():
+    w = writer.Writer(2)
+    w.submit("vrs-output.csv", fail, "disk full")
+    with pytest.raises(helper.PipelineError, match="writing vrs-output.csv failed: disk full"):
+        w.close()
+
+
+def test_error_is_raised_on_next_submit():
+    w = writer.Writer(1)
+    job = w.submit("vrs-output.csv", fail, "disk full")
+    job.done.wait()
+    with pytest.raises(helper.PipelineError, match="disk full"):
+        w.submit("genes-output.csv", append, [], 'x')
+    # and again once the other jobs are written
+    with pytest.raises(helper.PipelineError, match="disk full"):
+        w.close()
+
+
+def test_error_without_threads_is_raised_on_submit():
+    w = writer.Writer(0)
+    with pytest.raises(ValueError, match="disk full"):
+        w.submit("vrs-output.csv", fail, "disk full")
+
+
+def test_parts_after_a_failed_part_are_not_written():
+    parts = []
+    w = writer.Writer(2)
+    first = w.submit("part 0", fail, "disk full")
+    w.submit("part 1", append, parts, 1, after=first)
+    with pytest.raises(helper.PipelineError, match="part 0 failed: disk full"):
+        w.close()
+    assert parts == []
+
+
+def test_error_of_the_run_takes_precedence():
+    with pytest.raises(KeyError):
+        with writer.Writer(1) as w:
+            job = w.submit("vrs-output.csv", fail, "disk full")
+            job.done.wait()
+            raise KeyError('source')
@@ -0,0 +1,162 @@
+# local modules
+import download
+import helper
+import source
+import templates
+
+# other libraries
+import hashlib
+import json
+import os
+import sqlite3
+import pandas as pd
+
+#########################
+#
+# TEMPLATE TEXT STORE
+#
+# The template of a source rendered once for every row of its data file, including the rows created by expanding
+# lists of values, and saved next to the data file in an SQLite database indexed by the values of the join-group
+# columns of each row. With --text-store, --template-output is assembled by looking up the rows matching the --gene,
+# --variant and --region keys instead of reading the sources and rendering their templates, and gives the same text.
+#
+# A store is rebuilt when the data file, the template in config.yml, the dictionary, the --template-engine or the
+# template code in templates.py changes.
+#
+#########################
+
+STORE_SUFFIX = '.templates.sqlite'
+# limit on the number of key values in one query
+QUERY_KEYS = 500
+
+
+def store_file(sourcefile):
+    return source.data_file(sourcefile) + STORE_SUFFIX
+
+
+def file_hash(file_path):
+    with open(file_path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def signature(sourcefile, engine='compiled'):
+    data_file = source.data_file(sourcefile)
+    dictionary_hash = file_hash(os.path.join(sourcefile.get('path'), sourcefile.get('dictionary')))
+    template_hash = hashlib.sha256(str(sourcefile.get('template')).encode()).hexdigest()
+    return "{}-{}-{}-{}-{}".format(helper.file_signature(data_file), template_hash, dictionary_hash, engine,
+                                   file_hash(templates.__file__))
+
+
+# key values are compared as text, with whole numbers read as floats written as integers (8602.0 as 8602)
+def key(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def build(sourcefile, dic, chunksize, engine='compiled'):
+    helper.info("Building template text store for", sourcefile.get('name'))
+    file_path = store_file(sourcefile)
+    temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    if os.path.isfile(temp_path):
+        os.remove(temp_path)
+    template = templates.Template(sourcefile.get('template'), engine)
+    join_columns = dic.loc[dic['join-group'].notnull(), ['column', 'join-group']].values.tolist()
+    expand_columns = list(dic.loc[dic['expand'] == True, 'column'])
+
+    connection = sqlite3.connect(temp_path)
+    connection.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+    connection.execute("CREATE TABLE texts (id INTEGER PRIMARY KEY, expanded INTEGER, text TEXT)")
+    connection.execute("CREATE TABLE keys (join_group TEXT, key TEXT, id INTEGER)")
+    columns = []
+    rows = 0
+    for chunk in source.read(sourcefile, chunksize):
+        columns = list(chunk.columns)
+        # originals and expanded rows of the chunk, ordered by (expanded, id) as --expand orders them
+        for expanded, df in [(0, chunk)] + [(1, e) for e in source.expand(chunk, expand_columns)]:
+            if len(df) == 0:
+                continue
+            texts = template.render(df)
+            ids = range(rows, rows + len(df))
+            connection.executemany("INSERT INTO texts VALUES (?, ?, ?)", zip(ids, [expanded] * len(df), texts))
+            for c, g in join_columns:
+                if c in df:
+                    connection.executemany("INSERT INTO keys VALUES (?, ?, ?)",
+                                           [(g, key(v), i) for v, i in zip(df[c], ids) if not pd.isna(v)])
+            rows += len(df)
+    connection.execute("CREATE INDEX keys_index ON keys (join_group, key)")
+    connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                           [('signature', signature(sourcefile, engine)), ('columns', json.dumps(columns))])
+    connection.commit()
+    connection.close()
+    os.replace(temp_path, file_path)
+    helper.info("Saved template text store", file_path, "with", rows, "rows")
+
+
+# a connection to the text store of a source, if saved for the current data file, template, dictionary and engine
+def stored(sourcefile, engine='compiled'):
+    file_path = store_file(sourcefile)
+    if not os.path.isfile(file_path):
+        return None
+    connection = sqlite3.connect(file_path)
+    meta = dict(connection.execute("SELECT name, value FROM meta").fetchall())
+    if meta.get('signature') == signature(sourcefile, engine):
+        helper.debug("Using template text store", file_path)
+        return connection
+    connection.close()
+    helper.info("Template text store", file_path, "is out of date")
+    return None
+
+
+# open the text store of a source, building it first if missing or out of date; one run builds it holding the
+# download lock of the source while the others wait for it
+def load(sourcefile, dic, chunksize, engine='compiled'):
+    connection = stored(sourcefile, engine)
+    if connection is not None:
+        return connection
+    with download.locked(sourcefile):
+        connection = stored(sourcefile, engine)
+        if connection is None:
+            build(sourcefile, dic, chunksize, engine)
+            connection = stored(sourcefile, engine)
+    return connection
+
+
+# ids of the rows with any of the values in a join-group column
+def key_ids(connection, join_group, values):
+    ids = set()
+    values = sorted(set(key(v) for v in values))
+    for i in range(0, len(values), QUERY_KEYS):
+        batch = values[i:i + QUERY_KEYS]
+        query = "SELECT id FROM keys WHERE join_group = ? AND key IN ({})".format(','.join('?' * len(batch)))
+        ids |= set(r[0] for r in connection.execute(query, [join_group] + batch))
+    return ids
+
+
+# rendered template texts of the rows of a source matching all the key filters that apply to it
+def texts(sourcefile, dic, key_filters, expand, chunksize, engine='compiled'):
+    connection = load(sourcefile, dic, chunksize, engine)
+    columns = json.loads(connection.execute("SELECT value FROM meta WHERE name = 'columns'").fetchone()[0])
+    header = pd.DataFrame(columns=columns)
+    ids = None
+    for f in key_filters:
+        if not f.applies(header, dic):
+            continue
+        f = f.choice(header, dic) if hasattr(f, 'choice') else f
+        join_group = f.names()[0]
+        matched = key_ids(connection, join_group, f.keys(join_group, dic))
+        ids = matched if ids is None else ids & matched
+    max_expanded = 1 if expand else 0
+    if ids is None:
+        query = "SELECT expanded, id, text FROM texts WHERE expanded <= ?"
+        rows = connection.execute(query, (max_expanded,)).fetchall()
+    else:
+        rows = []
+        ids = sorted(ids)
+        for i in range(0, len(ids), QUERY_KEYS):
+            batch = ids[i:i + QUERY_KEYS]
+            query = "SELECT expanded, id, text FROM texts WHERE id IN ({}) AND expanded <= ?".format(
+                ','.join('?' * len(batch)))
+            rows.extend(connection.execute(query, batch + [max_expanded]).fetchall())
+    connection.close()
+    return [text for expanded, i, text in sorted(rows)]
@@ -0,0 +1,121 @@
+# local modules
+import helper
+
+# other libraries
+import queue
+import threading
+
+#########################
+#
+# BACKGROUND OUTPUT WRITING
+#
+# With --writers, the output files of each source are written by that many background threads while the next source
+# is read, encoded and templated, instead of all at the end in the main thread. The writes wait in a queue of at most
+# --writers jobs: when it is full, the main thread waits for a write to start before processing the next source, so
+# no more than twice --writers finished sources wait to be written. A job drops its rows once written, so a source no
+# longer needed for the joined output or the packed output is freed as soon as it is written. Jobs appending to the
+# same file (the text of each source in --template-output) run after the job before them, in --sources order.
+#
+# With --writers=0 each job is run in the main thread when submitted, as the outputs were always written.
+#
+#########################
+
+
+class Job:
+
+    def __init__(self, name, function, arguments, after):
+        self.name = name
+        self.function = function
+        self.arguments = arguments
+        # the job to finish before this one starts, for jobs writing to the same file
+        self.after = after
+        self.done = threading.Event()
+        self.failed = False
+
+    def run(self):
+        try:
+            if self.after is not None:
+                self.after.done.wait()
+                # the rest of a file is not written after a part that failed
+                if self.after.failed:
+                    raise helper.PipelineError("{} was not written".format(self.after))
+            self.function(*self.arguments)
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            # release the rows held by the job as soon as they are written
+            self.function = None
+            self.arguments = None
+            self.after = None
+            self.done.set()
+
+    def __repr__(self):
+        return self.name
+
+
+class Writer:
+
+    def __init__(self, threads):
+        self.threads = []
+        self.queue = queue.Queue(maxsize=max(1, threads))
+        self.errors = []
+        self.lock = threading.Lock()
+        for i in range(threads):
+            thread = threading.Thread(target=self.work, name="writer-{}".format(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                job.run()
+            except Exception as exc:
+                helper.critical("Writing", job, "failed:", exc)
+                with self.lock:
+                    self.errors.append((job, exc))
+
+    # run function(*arguments) in a writer thread, waiting while the queue is full; returns the job, to give as the
+    # after job of the next job writing to the same file
+    def submit(self, name, function, *arguments, after=None):
+        self.check()
+        job = Job(name, function, arguments, after)
+        if len(self.threads) == 0:
+            job.run()
+            return job
+        helper.debug("Queueing write of", name)
+        self.queue.put(job)
+        return job
+
+    # raise the first error of the jobs run so far
+    def check(self):
+        with self.lock:
+            if len(self.errors) > 0:
+                job, exc = self.errors[0]
+                raise helper.PipelineError("writing {} failed: {}".format(job, exc))
+
+    # wait for the jobs submitted to be written
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # the error raised while the jobs were written takes precedence over any of theirs
+            try:
+                self.close()
+            except helper.PipelineError:
+                pass
+        return False